@@ -0,0 +1,126 @@
+# End-to-end benchmark: a synthetic chart repo on a local HTTP server, an in-process fake OCI registry (with optional
+# latency, 429s and failures), and `tooci/cli.py process` driving the lot. Reports versions/sec and per-version latency.
+# python bench/bench_e2e.py --charts 20 --versions 25 --runs 2 [--processors] [--registry-latency 0.05] [--rate-limit-rate 0.02]
+# The first run starts with an empty cache dir; later runs reuse it (blob cache, index cache), but push to a fresh registry
+# namespace with fresh state, so every run does the full push work.
+
+import argparse
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from chart_server import ChartRepoServer
+from fake_registry import FakeRegistry
+from fake_registry import FaultInjection
+from synthetic import make_chart_repo
+
+CLI = f"{os.path.dirname(os.path.abspath(__file__))}/../tooci/cli.py"
+SERVICE_STAGES = ("fetch", "transform", "push")  # see tooci/timings.py; shell/retry spans are nested inside these
+
+
+def percentile(values: list[float], p: int) -> float:
+	values = sorted(values)
+	return values[max(0, math.ceil(p / 100 * len(values)) - 1)] if values else 0.0
+
+
+def run_once(args, work_dir: str, repo_url: str, registry_address: str, run: int) -> dict:
+	run_dir = f"{work_dir}/run-{run}"
+	os.makedirs(run_dir)
+	processors = '\n    processors: [ "bitnami_legacy_process" ]' if args.processors else ""
+	with open(f"{run_dir}/repos.yaml", "w") as f:
+		f.write(f'hash: "bench"\nrepositories:\n  "bench":\n    source: "{repo_url}"{processors}\n')
+	env = dict(os.environ)
+	env.update({
+		"BASE_OCI_REF": f"{registry_address}/bench-run-{run}",
+		"TOOCI_CACHE_DIR": f"{work_dir}/cache",
+		"REPORT_DIR": f"{run_dir}/report",
+		"ENGINE": args.engine,
+		"RECONCILE": "false",
+	})
+	if args.max_workers:
+		env["MAX_WORKERS"] = str(args.max_workers)
+	env.pop("GITHUB_STEP_SUMMARY", None)
+	if args.cold and os.path.isdir(f"{work_dir}/cache"):
+		subprocess.run(["rm", "-rf", f"{work_dir}/cache"], check=True)
+
+	start = time.perf_counter()
+	proc = subprocess.run([sys.executable, CLI, "process", "--repo-id", "bench", "--force"], cwd=run_dir, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+	wall = time.perf_counter() - start
+	if proc.returncode != 0:
+		print(proc.stdout.decode("utf-8", errors="replace")[-4000:])
+		print(f"run {run}: cli.py process exited with {proc.returncode}")
+
+	with open(f"{run_dir}/report/run-report.json") as f:
+		report = json.load(f)
+	processed = [v for v in report["versions"] if v["outcome"] == "processed"]
+	service = [sum(v["seconds"].get(s, 0.0) for s in SERVICE_STAGES) for v in processed]
+	end_to_end = [sum(v["seconds"].get(s, 0.0) for s in SERVICE_STAGES + ("queue_wait",)) for v in processed]
+	counts = report["repos"].get("bench", {}).get("counts", {})
+	return {
+		"run": run,
+		"exit_code": proc.returncode,
+		"wall_seconds": wall,
+		"processed": len(processed),
+		"failed": len([v for v in report["versions"] if v["outcome"] == "failed"]),
+		"versions_per_second": len(processed) / wall if wall else 0.0,
+		"latency_p50": percentile(service, 50),
+		"latency_p99": percentile(service, 99),
+		"end_to_end_p50": percentile(end_to_end, 50),
+		"end_to_end_p99": percentile(end_to_end, 99),
+		"retries": sum(v for k, v in counts.items() if k.endswith("_retries")),
+		"blob_cache_hits": counts.get("blob_cache_hits", 0),
+		"blobs_mounted": counts.get("blobs_mounted", 0),
+	}
+
+
+def main():
+	parser = argparse.ArgumentParser(description="End-to-end tooci benchmark against local fakes")
+	parser.add_argument("--charts", type=int, default=10)
+	parser.add_argument("--versions", type=int, default=20, help="Versions per chart")
+	parser.add_argument("--templates", type=int, default=20, help="Template files per chart")
+	parser.add_argument("--padding-bytes", type=int, default=16 * 1024, help="Extra values.yaml bytes per chart")
+	parser.add_argument("--subcharts", type=int, default=1)
+	parser.add_argument("--processors", action="store_true", help="Configure the repo with the bitnami_legacy_process processor")
+	parser.add_argument("--runs", type=int, default=2)
+	parser.add_argument("--cold", action="store_true", help="Empty the cache dir before every run, not just the first")
+	parser.add_argument("--engine", choices=["pipeline", "threads"], default="pipeline")
+	parser.add_argument("--max-workers", type=int, default=None)
+	parser.add_argument("--upstream-latency", type=float, default=0.0, help="Seconds added to every chart repo response")
+	parser.add_argument("--registry-latency", type=float, default=0.0, help="Seconds added to every registry API request")
+	parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Share of registry API requests answered with 429")
+	parser.add_argument("--failure-rate", type=float, default=0.0, help="Share of registry API requests answered with 500")
+	parser.add_argument("--retry-after", type=float, default=1.0)
+	parser.add_argument("--json", help="Also write the results to this file")
+	args = parser.parse_args()
+
+	with tempfile.TemporaryDirectory() as work_dir:
+		start = time.perf_counter()
+		total_bytes = make_chart_repo(f"{work_dir}/repo", args.charts, args.versions, args.templates, args.padding_bytes, args.subcharts)
+		print(f"Synthetic repo: {args.charts} charts x {args.versions} versions, {total_bytes} bytes, generated in {time.perf_counter() - start:.1f}s")
+
+		chart_server = ChartRepoServer(f"{work_dir}/repo", latency=args.upstream_latency).start()
+		faults = FaultInjection(args.registry_latency, args.rate_limit_rate, args.failure_rate, args.retry_after)
+		registry = FakeRegistry(require_auth=True, faults=faults).start()
+		try:
+			results = [run_once(args, work_dir, chart_server.url, registry.address, run) for run in range(1, args.runs + 1)]
+		finally:
+			chart_server.stop()
+			registry.stop()
+
+	print(f"{'run':>3} {'versions':>8} {'failed':>6} {'wall s':>8} {'ver/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'e2e p50':>8} {'e2e p99':>8} {'retries':>7} {'cache':>6} {'mounted':>7}")
+	for r in results:
+		print(f"{r['run']:>3} {r['processed']:>8} {r['failed']:>6} {r['wall_seconds']:>8.2f} {r['versions_per_second']:>8.1f} "
+			f"{r['latency_p50'] * 1000:>8.1f} {r['latency_p99'] * 1000:>8.1f} {r['end_to_end_p50'] * 1000:>8.1f} {r['end_to_end_p99'] * 1000:>8.1f} "
+			f"{r['retries']:>7g} {r['blob_cache_hits']:>6g} {r['blobs_mounted']:>7g}")
+	print(f"Registry faults injected: {faults.injected}")
+	if args.json:
+		with open(args.json, "w") as f:
+			json.dump({"args": vars(args), "results": results, "faults_injected": faults.injected}, f, indent=1)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,73 @@
+# Memory benchmark: footprint of a parsed index and of the in-memory plan (HelmChartInfo/HelmChartVersion objects)
+# for a bitnami-scale repo, measured with tracemalloc.
+# python bench/bench_memory.py [--charts 500] [--versions 100]   (default: 50k versions)
+
+import argparse
+import gc
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, f"{os.path.dirname(os.path.abspath(__file__))}/../tooci")
+
+from synthetic import synthetic_index_entries  # noqa: E402
+
+
+def measure(fn) -> tuple[any, int, float]:
+	# (result, bytes still allocated once fn returned, seconds)
+	gc.collect()
+	before = tracemalloc.get_traced_memory()[0]
+	start = time.perf_counter()
+	result = fn()
+	elapsed = time.perf_counter() - start
+	gc.collect()
+	return result, tracemalloc.get_traced_memory()[0] - before, elapsed
+
+
+def main():
+	parser = argparse.ArgumentParser(description="tooci index/plan memory benchmark")
+	parser.add_argument("--charts", type=int, default=500)
+	parser.add_argument("--versions", type=int, default=100, help="Versions per chart")
+	args = parser.parse_args()
+	total = args.charts * args.versions
+
+	with tempfile.TemporaryDirectory() as work_dir:
+		os.chdir(work_dir)
+		os.environ["TOOCI_CACHE_DIR"] = f"{work_dir}/cache"
+		with open("repos.yaml", "w") as f:
+			f.write('hash: "bench"\nrepositories:\n  "bench":\n    source: "https://charts.example.com"\n')
+
+		from helm import Inventory
+		from index import IndexCache
+		from index import slim_entries
+		from utils import setup_logging
+		setup_logging("bench").root.setLevel("WARNING")
+
+		# the slimmed index as an unchanged (304) run loads it from the index cache
+		repo = Inventory("registry.example.com/bench").charts["bench"]
+		repo.index_cache = IndexCache(repo.source)
+		repo.index_cache.store(slim_entries(synthetic_index_entries(args.charts, args.versions)), None, None)
+		repo.index_cache.entries = None
+
+		tracemalloc.start()
+		entries, entries_bytes, entries_seconds = measure(repo.index_cache.load_entries)
+		repo.index_entries = entries
+
+		def plan():
+			repo.get_chart_info()
+			return repo.pending_versions(repo.versions_to_process())
+
+		pending, plan_bytes, plan_seconds = measure(plan)
+		peak = tracemalloc.get_traced_memory()[1]
+		tracemalloc.stop()
+
+	print(f"{args.charts} charts x {args.versions} versions = {total} versions; {len(pending)} pending")
+	print(f"{'index entries (cached)':<24} {entries_bytes / 2**20:>8.1f} MiB {entries_bytes / total:>7.0f} B/version {entries_seconds:>6.2f}s")
+	print(f"{'plan (charts+versions)':<24} {plan_bytes / 2**20:>8.1f} MiB {plan_bytes / total:>7.0f} B/version {plan_seconds:>6.2f}s")
+	print(f"{'peak traced':<24} {peak / 2**20:>8.1f} MiB")
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,101 @@
+# Benchmark: legacy subprocess processor path (tar xzf / sed / diff / tar czf) vs tooci's streaming tarfile rewrite.
+# python bench/bench_processors.py [--chart-tgz some-bitnami-chart.tgz] [--iterations 20] [--gzip-level 6] [--gzip-threads 4]
+
+import argparse
+import functools
+import glob
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+
+sys.path.insert(0, f"{os.path.dirname(os.path.abspath(__file__))}/../tooci")
+
+from processors import GZIP_LEVEL  # noqa: E402
+from processors import get_processors  # noqa: E402
+from processors import rewrite_chart_tgz  # noqa: E402
+from synthetic import make_chart_tgz  # noqa: E402
+
+
+def legacy_bitnami_process(chart_tgz_fullpath: str, tmp_dir_name: str):
+	# The pre-streaming implementation, kept here as the baseline: extract to disk, 2x sed + diff per values.yaml, repack
+	extracted_dir = f"{tmp_dir_name}/{os.path.basename(chart_tgz_fullpath)[:-4]}"
+	os.makedirs(extracted_dir)
+	subprocess.run(["tar", "xzf", chart_tgz_fullpath, "-C", extracted_dir, "--strip-components=0"], check=True)
+	os.remove(chart_tgz_fullpath)
+	for values_yaml_file in glob.glob(f"{extracted_dir}/**/values.yaml", recursive=True):
+		subprocess.run(["sed", "--in-place=.bkp.pre.bitnami.hack", "-e", "s|repository: bitnami/|repository: bitnamilegacy/|g", values_yaml_file], check=True)
+		subprocess.run(["sed", "--in-place", "-e", "s|allowInsecureImages: false|allowInsecureImages: true|g", values_yaml_file], check=True)
+		subprocess.run(["diff", "-U", "1", f"{values_yaml_file}.bkp.pre.bitnami.hack", values_yaml_file], stdout=subprocess.DEVNULL)
+		os.remove(f"{values_yaml_file}.bkp.pre.bitnami.hack")
+	target_dir = os.listdir(extracted_dir)[0]
+	subprocess.run(["tar", "czf", chart_tgz_fullpath, "-C", extracted_dir, target_dir], check=True)
+
+
+def streaming_bitnami_process(chart_tgz_fullpath: str, tmp_dir_name: str, level: int, threads: int):
+	rewrite_chart_tgz(chart_tgz_fullpath, chart_tgz_fullpath, get_processors(["bitnami_legacy_process"]), level, threads)
+
+
+def member_contents(chart_tgz_fullpath: str) -> dict[str, bytes]:
+	with tarfile.open(chart_tgz_fullpath, "r:gz") as tar:
+		return {m.name: tar.extractfile(m).read() for m in tar if m.isfile()}
+
+
+def run(implementation, source_tgz: str, iterations: int) -> tuple[list[float], dict[str, bytes], set[str]]:
+	timings = []
+	contents = {}
+	digests = set()
+	for _ in range(iterations):
+		with tempfile.TemporaryDirectory() as tmp_dir_name:
+			chart_tgz = f"{tmp_dir_name}/{os.path.basename(source_tgz)}"
+			shutil.copyfile(source_tgz, chart_tgz)
+			start = time.perf_counter()
+			implementation(chart_tgz, tmp_dir_name)
+			timings.append(time.perf_counter() - start)
+			contents = member_contents(chart_tgz)
+			with open(chart_tgz, "rb") as f:
+				digests.add(hashlib.sha256(f.read()).hexdigest())
+	return timings, contents, digests
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark legacy vs streaming chart processors")
+	parser.add_argument("--chart-tgz", help="A real chart to use, eg a bitnami chart fetched with `helm fetch`; default is a synthetic one")
+	parser.add_argument("--iterations", type=int, default=20)
+	parser.add_argument("--gzip-level", type=int, default=GZIP_LEVEL)
+	parser.add_argument("--gzip-threads", type=int, default=4, help="Threads for the block-parallel gzip run; 1 to skip it")
+	args = parser.parse_args()
+
+	logging.basicConfig(level="WARNING")
+
+	with tempfile.TemporaryDirectory() as work_dir:
+		source_tgz = args.chart_tgz
+		if not source_tgz:
+			source_tgz = f"{work_dir}/synthetic-1.0.0.tgz"
+			make_chart_tgz(source_tgz, "synthetic", "1.0.0", templates=60, padding_bytes=64 * 1024, subcharts=3)
+		print(f"Chart: {source_tgz} ({os.path.getsize(source_tgz)} bytes), {args.iterations} iterations each")
+
+		implementations = [
+			("legacy (tar/sed/diff)", legacy_bitnami_process),
+			(f"streaming gzip -{args.gzip_level}", functools.partial(streaming_bitnami_process, level=args.gzip_level, threads=1)),
+		]
+		if args.gzip_threads > 1:
+			implementations.append((f"streaming gzip -{args.gzip_level} x{args.gzip_threads}", functools.partial(streaming_bitnami_process, level=args.gzip_level, threads=args.gzip_threads)))
+		results = {}
+		for name, implementation in implementations:
+			timings, contents, digests = run(implementation, source_tgz, args.iterations)
+			results[name] = contents
+			timings.sort()
+			print(f"{name:28s} mean {sum(timings) / len(timings) * 1000:8.1f} ms   p50 {timings[len(timings) // 2] * 1000:8.1f} ms   min {timings[0] * 1000:8.1f} ms   distinct outputs {len(digests)}")
+
+		legacy, *streaming = results.values()
+		print(f"Outputs identical (member contents): {all(legacy == s for s in streaming)}")
+
+
+if __name__ == '__main__':
+	main()
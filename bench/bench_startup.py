@@ -0,0 +1,87 @@
+# Startup benchmark: how long until a CLI invocation has its inventory and the ChartRepo it works on, before any network.
+# Each sample is a fresh interpreter (that's what every GHA job and matrix step pays), against a synthetic repos.yaml.
+# python bench/bench_startup.py [--repos 300] [--samples 15]
+# Reports, in ms: bare interpreter, `cli.py --help`, and "inventory": import cli + Inventory(None) + one repo lookup, both
+# cold (no inventory snapshot in the cache dir) and warm; the in-process share of the latter is reported separately.
+
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+TOOCI = f"{os.path.dirname(os.path.abspath(__file__))}/../tooci"
+
+INVENTORY_PROBE = """
+import sys, time
+start = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+sys.argv = ["cli.py"]
+import cli
+imported = time.perf_counter()
+repos = cli.Inventory(None)
+repo = repos.charts["repo-0"]
+done = time.perf_counter()
+print(f"{(imported - start) * 1000:.2f} {(done - imported) * 1000:.2f}")
+"""
+
+
+def write_repos_yaml(path: str, count: int):
+	with open(path, "w") as f:
+		f.write('hash: "bench"\nrepositories:\n')
+		for i in range(count):
+			f.write(f'  "repo-{i}":\n    source: "https://charts.example.com/repo-{i}"\n')
+			if i % 3 == 0:
+				f.write('    latest-n: 5\n    only-charts: [ "one", "two", "three" ]\n')
+			if i % 7 == 0:
+				f.write('    processors: [ "bitnami_legacy_process" ]\n    skip-chart-versions:\n      one: [ "1.0.0", "1.0.1" ]\n')
+
+
+def sample(argv: list[str], cwd: str, env: dict) -> tuple[float, str]:
+	start = time.perf_counter()
+	proc = subprocess.run(argv, cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+	return (time.perf_counter() - start) * 1000, proc.stdout.decode("utf-8")
+
+
+def summary(name: str, values: list[float]):
+	values = sorted(values)
+	print(f"{name:<28} median {statistics.median(values):>7.1f}  min {values[0]:>7.1f}  max {values[-1]:>7.1f}")
+
+
+def main():
+	parser = argparse.ArgumentParser(description="tooci CLI startup benchmark")
+	parser.add_argument("--repos", type=int, default=300, help="Repositories in the synthetic repos.yaml")
+	parser.add_argument("--samples", type=int, default=15)
+	args = parser.parse_args()
+
+	with tempfile.TemporaryDirectory() as work_dir:
+		write_repos_yaml(f"{work_dir}/repos.yaml", args.repos)
+		env = dict(os.environ)
+		env["TOOCI_CACHE_DIR"] = f"{work_dir}/cache"
+		env.pop("GITHUB_ACTIONS", None)
+		probe = [sys.executable, "-c", INVENTORY_PROBE, TOOCI]
+
+		sample([sys.executable, "-c", "pass"], work_dir, env)  # warm the OS page cache; bytecode is compiled by now too
+		results: dict[str, list[float]] = {}
+		for _ in range(args.samples):
+			results.setdefault("interpreter", []).append(sample([sys.executable, "-c", "pass"], work_dir, env)[0])
+			results.setdefault("cli.py --help", []).append(sample([sys.executable, f"{TOOCI}/cli.py", "--help"], work_dir, env)[0])
+			for state in ("cold", "warm"):
+				if state == "cold":
+					shutil.rmtree(f"{work_dir}/cache", ignore_errors=True)
+				wall, out = sample(probe, work_dir, env)
+				import_ms, inventory_ms = (float(x) for x in out.split())
+				results.setdefault(f"inventory {state}", []).append(wall)
+				results.setdefault(f"  imports ({state})", []).append(import_ms)
+				results.setdefault(f"  Inventory + lookup ({state})", []).append(inventory_ms)
+
+	print(f"{args.repos} repos, {args.samples} samples, ms per process")
+	for name, values in results.items():
+		summary(name, values)
+
+
+if __name__ == '__main__':
+	main()
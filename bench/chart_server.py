@@ -0,0 +1,52 @@
+# Serves a directory (eg: a synthetic Helm repo from synthetic.make_chart_repo) over HTTP, with optional injected latency.
+# Run standalone: python bench/chart_server.py --directory /tmp/repo --port 8080
+
+import argparse
+import functools
+import threading
+import time
+from http.server import SimpleHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+
+class ChartRepoHandler(SimpleHTTPRequestHandler):
+	latency: float = 0.0  # set on the per-server subclass
+
+	def log_message(self, format, *args):
+		pass
+
+	def send_head(self):
+		if self.latency:
+			time.sleep(self.latency)
+		return super().send_head()
+
+
+class ChartRepoServer:
+	def __init__(self, directory: str, port: int = 0, latency: float = 0.0):
+		handler = type("BoundChartRepoHandler", (ChartRepoHandler,), {"latency": latency})
+		self.server = ThreadingHTTPServer(("127.0.0.1", port), functools.partial(handler, directory=directory))
+		self.server.daemon_threads = True
+		self.thread = threading.Thread(target=self.server.serve_forever, name="chart-server", daemon=True)
+
+	@property
+	def url(self) -> str:
+		return f"http://localhost:{self.server.server_address[1]}"
+
+	def start(self) -> "ChartRepoServer":
+		self.thread.start()
+		return self
+
+	def stop(self):
+		self.server.shutdown()
+		self.server.server_close()
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Static Helm chart repo server")
+	parser.add_argument("--directory", required=True)
+	parser.add_argument("--port", type=int, default=8080)
+	parser.add_argument("--latency", type=float, default=0.0, help="Seconds to sleep before each response")
+	args = parser.parse_args()
+	server = ChartRepoServer(args.directory, args.port, args.latency)
+	print(f"Serving '{args.directory}' at {server.url}")
+	server.server.serve_forever()
@@ -0,0 +1,216 @@
+# A small in-memory stand-in for an OCI distribution registry (ghcr.io), good enough for tooci's push path.
+# Run standalone: python bench/fake_registry.py --port 5000 ; then BASE_OCI_REF=localhost:5000/helm-oci
+# Faults can be injected for the benchmarks: latency on every request, and a share of 429s (with Retry-After) or 500s.
+
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
+
+RE_UPLOAD_START = re.compile(r"^/v2/(?P<name>.+)/blobs/uploads/?$")
+RE_UPLOAD = re.compile(r"^/v2/(?P<name>.+)/blobs/uploads/(?P<upload_id>[^/]+)$")
+RE_BLOB = re.compile(r"^/v2/(?P<name>.+)/blobs/(?P<digest>sha256:[a-f0-9]{64})$")
+RE_MANIFEST = re.compile(r"^/v2/(?P<name>.+)/manifests/(?P<reference>[^/]+)$")
+RE_TAGS = re.compile(r"^/v2/(?P<name>.+)/tags/list$")
+
+
+class FaultInjection:
+	def __init__(self, latency: float = 0.0, rate_limit_rate: float = 0.0, failure_rate: float = 0.0, retry_after: float = 1.0, seed: int = 0):
+		self.latency = latency  # seconds added to every /v2/ request
+		self.rate_limit_rate = rate_limit_rate  # share of /v2/ requests answered 429 + Retry-After
+		self.failure_rate = failure_rate  # share of /v2/ requests answered 500
+		self.retry_after = retry_after
+		self.random = random.Random(seed)
+		self.injected = {"429": 0, "500": 0}
+
+
+class FakeRegistryState:
+	def __init__(self, require_auth: bool = False, faults: FaultInjection | None = None):
+		self.lock = threading.Lock()
+		self.require_auth = require_auth
+		self.faults = faults or FaultInjection()
+		self.blobs: dict[str, dict[str, bytes]] = {}  # repository -> digest -> content
+		self.manifests: dict[str, dict[str, bytes]] = {}  # repository -> tag or digest -> manifest
+		self.uploads: dict[str, bytearray] = {}
+		self.mounts = 0
+		self.requests: list[tuple[str, str]] = []
+
+
+class FakeRegistryHandler(BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+	state: FakeRegistryState  # set on the per-server subclass
+
+	def log_message(self, format, *args):
+		pass
+
+	def reply(self, status: int, body: bytes = b"", headers: dict[str, str] | None = None):
+		self.send_response(status)
+		for key, value in (headers or {}).items():
+			self.send_header(key, value)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		if self.command != "HEAD":
+			self.wfile.write(body)
+
+	def read_body(self) -> bytes:
+		length = int(self.headers.get("Content-Length", "0"))
+		return self.rfile.read(length) if length else b""
+
+	def authorized(self) -> bool:
+		if not self.state.require_auth or self.path.startswith("/token"):
+			return True
+		if self.headers.get("Authorization", "").startswith("Bearer fake-token-"):
+			return True
+		host = self.headers.get("Host")
+		self.reply(401, b'{"errors":[{"code":"UNAUTHORIZED"}]}', {"WWW-Authenticate": f'Bearer realm="http://{host}/token",service="fake-registry"'})
+		return False
+
+	def inject_fault(self) -> bool:
+		# never on the token endpoint or the /v2/ ping; only on the distribution API calls proper
+		faults = self.state.faults
+		if not self.path.startswith("/v2/") or self.path == "/v2/":
+			return False
+		if faults.latency:
+			time.sleep(faults.latency)
+		with self.state.lock:
+			roll = faults.random.random()
+			if roll < faults.rate_limit_rate:
+				faults.injected["429"] += 1
+				kind = 429
+			elif roll < faults.rate_limit_rate + faults.failure_rate:
+				faults.injected["500"] += 1
+				kind = 500
+			else:
+				return False
+		if kind == 429:
+			self.reply(429, b'{"errors":[{"code":"TOOMANYREQUESTS"}]}', {"Retry-After": f"{faults.retry_after:g}"})
+		else:
+			self.reply(500, b'{"errors":[{"code":"UNKNOWN","message":"injected failure"}]}')
+		return True
+
+	def handle_any(self):
+		url = urlparse(self.path)
+		query = parse_qs(url.query)
+		with self.state.lock:
+			self.state.requests.append((self.command, url.path))
+		body = self.read_body() if self.command in ("PUT", "POST", "PATCH") else b""
+		if not self.authorized() or self.inject_fault():
+			return
+
+		if url.path == "/token":
+			return self.reply(200, json.dumps({"token": f"fake-token-{uuid.uuid4()}"}).encode())
+		if url.path in ("/v2", "/v2/"):
+			return self.reply(200, b"{}")
+
+		if (m := RE_UPLOAD_START.match(url.path)) and self.command == "POST":
+			if "mount" in query and "from" in query:  # cross-repository blob mount
+				digest = query["mount"][0]
+				with self.state.lock:
+					content = self.state.blobs.get(query["from"][0], {}).get(digest)
+					if content is not None:
+						self.state.blobs.setdefault(m["name"], {})[digest] = content
+						self.state.mounts += 1
+				if content is not None:
+					return self.reply(201, headers={"Location": f"/v2/{m['name']}/blobs/{digest}", "Docker-Content-Digest": digest})
+			upload_id = str(uuid.uuid4())
+			with self.state.lock:
+				self.state.uploads[upload_id] = bytearray(body)
+			return self.reply(202, headers={"Location": f"/v2/{m['name']}/blobs/uploads/{upload_id}", "Docker-Upload-UUID": upload_id})
+
+		if m := RE_UPLOAD.match(url.path):
+			with self.state.lock:
+				if m["upload_id"] not in self.state.uploads:
+					return self.reply(404, b'{"errors":[{"code":"BLOB_UPLOAD_UNKNOWN"}]}')
+				self.state.uploads[m["upload_id"]].extend(body)
+				if self.command == "PATCH":
+					return self.reply(202, headers={"Location": url.path})
+				content = bytes(self.state.uploads.pop(m["upload_id"]))
+			digest = query.get("digest", [""])[0]
+			if digest != f"sha256:{hashlib.sha256(content).hexdigest()}":
+				return self.reply(400, b'{"errors":[{"code":"DIGEST_INVALID"}]}')
+			with self.state.lock:
+				self.state.blobs.setdefault(m["name"], {})[digest] = content
+			return self.reply(201, headers={"Location": f"/v2/{m['name']}/blobs/{digest}", "Docker-Content-Digest": digest})
+
+		if m := RE_BLOB.match(url.path):
+			with self.state.lock:
+				content = self.state.blobs.get(m["name"], {}).get(m["digest"])
+			if content is None:
+				return self.reply(404, b'{"errors":[{"code":"BLOB_UNKNOWN"}]}')
+			return self.reply(200, content, {"Docker-Content-Digest": m["digest"], "Content-Type": "application/octet-stream"})
+
+		if m := RE_TAGS.match(url.path):
+			with self.state.lock:
+				if m["name"] not in self.state.manifests:
+					return self.reply(404, b'{"errors":[{"code":"NAME_UNKNOWN"}]}')
+				tags = sorted(ref for ref in self.state.manifests[m["name"]] if not ref.startswith("sha256:"))
+			last = query.get("last", [""])[0]
+			page_size = int(query.get("n", ["100"])[0])
+			page = [tag for tag in tags if tag > last][:page_size]
+			headers = {"Content-Type": "application/json"}
+			if page and page[-1] != tags[-1]:
+				headers["Link"] = f'</v2/{m["name"]}/tags/list?n={page_size}&last={page[-1]}>; rel="next"'
+			return self.reply(200, json.dumps({"name": m["name"], "tags": page}).encode(), headers)
+
+		if m := RE_MANIFEST.match(url.path):
+			if self.command == "PUT":
+				digest = f"sha256:{hashlib.sha256(body).hexdigest()}"
+				with self.state.lock:
+					manifests = self.state.manifests.setdefault(m["name"], {})
+					manifests[m["reference"]] = body
+					manifests[digest] = body
+				return self.reply(201, headers={"Location": f"/v2/{m['name']}/manifests/{digest}", "Docker-Content-Digest": digest})
+			with self.state.lock:
+				content = self.state.manifests.get(m["name"], {}).get(m["reference"])
+			if content is None:
+				return self.reply(404, b'{"errors":[{"code":"MANIFEST_UNKNOWN"}]}')
+			digest = f"sha256:{hashlib.sha256(content).hexdigest()}"
+			return self.reply(200, content, {"Docker-Content-Digest": digest, "Content-Type": json.loads(content).get("mediaType", "application/vnd.oci.image.manifest.v1+json")})
+
+		return self.reply(404, b'{"errors":[{"code":"NAME_UNKNOWN"}]}')
+
+	do_GET = do_HEAD = do_PUT = do_POST = do_PATCH = handle_any
+
+
+class FakeRegistry:
+	def __init__(self, port: int = 0, require_auth: bool = False, faults: FaultInjection | None = None):
+		self.state = FakeRegistryState(require_auth=require_auth, faults=faults)
+		handler = type("BoundFakeRegistryHandler", (FakeRegistryHandler,), {"state": self.state})
+		self.server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+		self.server.daemon_threads = True
+		self.thread = threading.Thread(target=self.server.serve_forever, name="fake-registry", daemon=True)
+
+	@property
+	def address(self) -> str:
+		return f"localhost:{self.server.server_address[1]}"
+
+	def start(self) -> "FakeRegistry":
+		self.thread.start()
+		return self
+
+	def stop(self):
+		self.server.shutdown()
+		self.server.server_close()
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="In-memory stand-in OCI registry")
+	parser.add_argument("--port", type=int, default=5000)
+	parser.add_argument("--auth", action="store_true", help="Require (fake) bearer tokens, like ghcr.io")
+	parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every registry API request")
+	parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Share of registry API requests answered with 429")
+	parser.add_argument("--failure-rate", type=float, default=0.0, help="Share of registry API requests answered with 500")
+	parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After seconds sent with injected 429s")
+	args = parser.parse_args()
+	faults = FaultInjection(args.latency, args.rate_limit_rate, args.failure_rate, args.retry_after)
+	registry = FakeRegistry(args.port, require_auth=args.auth, faults=faults)
+	print(f"Fake OCI registry listening on {registry.address}")
+	registry.server.serve_forever()
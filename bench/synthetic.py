@@ -0,0 +1,99 @@
+# Synthetic Helm charts for the benchmarks; bitnami-style, so processors have something to chew on.
+
+import hashlib
+import io
+import os
+import random
+import tarfile
+
+import yaml
+
+BITNAMI_VALUES_YAML = """global:
+  imageRegistry: ""
+  security:
+    allowInsecureImages: false
+image:
+  registry: docker.io
+  repository: bitnami/{name}
+  tag: {app_version}
+metrics:
+  image:
+    registry: docker.io
+    repository: bitnami/{name}-exporter
+volumePermissions:
+  image:
+    repository: bitnami/os-shell
+"""
+
+
+def add_file(tar: tarfile.TarFile, name: str, content: bytes):
+	info = tarfile.TarInfo(name)
+	info.size = len(content)
+	info.mode = 0o644
+	info.mtime = 1700000000
+	tar.addfile(info, io.BytesIO(content))
+
+
+def make_chart_tgz(path: str, name: str, version: str, app_version: str = "1.0.0", templates: int = 20, padding_bytes: int = 0, subcharts: int = 1, seed: int = 0):
+	# chart dir layout as produced by `helm package`: <name>/Chart.yaml, values.yaml, templates/, charts/<sub>/...
+	rnd = random.Random(f"{seed}-{name}-{version}")
+	with tarfile.open(path, "w:gz") as tar:
+		add_file(tar, f"{name}/Chart.yaml", f"apiVersion: v2\nname: {name}\nversion: {version}\nappVersion: \"{app_version}\"\ndescription: Synthetic {name} chart\n".encode())
+		values = BITNAMI_VALUES_YAML.format(name=name, app_version=app_version)
+		# padding, as comment lines; sizable values.yaml files are the norm for bitnami
+		values += "".join(f"# {rnd.getrandbits(256):064x}\n" for _ in range(padding_bytes // 67))
+		add_file(tar, f"{name}/values.yaml", values.encode())
+		for i in range(templates):
+			body = "".join(f"{{{{- /* {rnd.getrandbits(128):032x} */ -}}}}\n" for _ in range(40))
+			add_file(tar, f"{name}/templates/template-{i}.yaml", f"apiVersion: v1\nkind: ConfigMap\n{body}".encode())
+		for s in range(subcharts):
+			sub = "common" if s == 0 else f"sub{s}"
+			add_file(tar, f"{name}/charts/{sub}/Chart.yaml", f"apiVersion: v2\nname: {sub}\nversion: 2.0.0\n".encode())
+			add_file(tar, f"{name}/charts/{sub}/values.yaml", BITNAMI_VALUES_YAML.format(name=sub, app_version="2.0.0").encode())
+	return os.path.getsize(path)
+
+
+def synthetic_version(i: int) -> str:
+	# 1.0.0, 1.1.0, ... 1.9.0, 2.0.0, ...; every 7th one a prerelease, like real repos have
+	version = f"{1 + i // 10}.{i % 10}.0"
+	return f"{version}-rc.1" if i % 7 == 6 else version
+
+
+def synthetic_index_entries(charts: int, versions_per_chart: int) -> dict[str, list[dict]]:
+	# index.yaml 'entries' only, no tarballs: for benchmarks of index parsing and planning at bitnami scale.
+	# Like real repos, every version of a chart repeats the chart's (long) description, and carries annotations
+	entries = {}
+	for c in range(charts):
+		name = f"chart{c:03d}"
+		description = f"Synthetic {name} is a chart for benchmarks. " * 4
+		entries[name] = [{
+			"apiVersion": "v2", "name": name, "version": synthetic_version(v), "appVersion": f"{3 + v // 10}.{v % 10}.{c}",
+			"description": description, "digest": hashlib.sha256(f"{name}-{v}".encode("utf-8")).hexdigest(),
+			"urls": [f"https://charts.example.com/{name}-{synthetic_version(v)}.tgz"], "created": "2024-01-01T00:00:00Z",
+			"annotations": {"category": "Infrastructure", "licenses": "Apache-2.0"}, "home": f"https://example.com/{name}",
+		} for v in reversed(range(versions_per_chart))]
+	return entries
+
+
+def make_chart_repo(directory: str, charts: int, versions_per_chart: int, templates: int = 20, padding_bytes: int = 0, subcharts: int = 1, seed: int = 0) -> int:
+	# a static Helm repo: <directory>/index.yaml + <directory>/charts/<name>-<version>.tgz, with digests; returns total bytes
+	os.makedirs(f"{directory}/charts", exist_ok=True)
+	entries = {}
+	total_bytes = 0
+	for c in range(charts):
+		name = f"chart{c:03d}"
+		entries[name] = []
+		for v in range(versions_per_chart):
+			version = synthetic_version(v)
+			app_version = f"{3 + v // 10}.{v % 10}.{c}"
+			tgz = f"{directory}/charts/{name}-{version}.tgz"
+			total_bytes += make_chart_tgz(tgz, name, version, app_version, templates=templates, padding_bytes=padding_bytes, subcharts=subcharts, seed=seed)
+			with open(tgz, "rb") as f:
+				digest = hashlib.sha256(f.read()).hexdigest()
+			entries[name].insert(0, {
+				"apiVersion": "v2", "name": name, "version": version, "appVersion": app_version, "description": f"Synthetic {name} chart",
+				"digest": digest, "urls": [f"charts/{name}-{version}.tgz"], "created": "2024-01-01T00:00:00Z",
+			})
+	with open(f"{directory}/index.yaml", "w") as f:
+		yaml.dump({"apiVersion": "v1", "entries": entries, "generated": "2024-01-01T00:00:00Z"}, f, Dumper=getattr(yaml, "CSafeDumper", yaml.SafeDumper))
+	return total_bytes
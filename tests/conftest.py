@@ -0,0 +1,27 @@
+import os
+import sys
+
+import pytest
+
+# the CLI runs as `python tooci/cli.py`, so its modules import each other flat; bench/ has the test servers
+sys.path.insert(0, f"{os.path.dirname(os.path.abspath(__file__))}/../tooci")
+sys.path.insert(0, f"{os.path.dirname(os.path.abspath(__file__))}/../bench")
+
+from chart_server import ChartRepoServer  # noqa: E402
+
+
+@pytest.fixture
+def chart_server(tmp_path):
+	# serves tmp_path/www over HTTP; tests drop their files in there
+	os.makedirs(f"{tmp_path}/www")
+	server = ChartRepoServer(f"{tmp_path}/www").start()
+	yield server
+	server.stop()
+
+
+@pytest.fixture
+def registry():
+	from fake_registry import FakeRegistry
+	server = FakeRegistry().start()
+	yield server
+	server.stop()
@@ -0,0 +1,55 @@
+import hashlib
+import os
+
+import pytest
+
+from blobcache import BlobCache
+from utils import DigestMismatchError
+
+
+def serve_blob(www: str, name: str, size: int) -> str:
+	data = name.encode("utf-8") * (size // len(name))
+	with open(f"{www}/{name}", "wb") as f:
+		f.write(data)
+	return hashlib.sha256(data).hexdigest()
+
+
+@pytest.fixture
+def cache(tmp_path) -> BlobCache:
+	os.makedirs(f"{tmp_path}/blobs")
+	return BlobCache(f"{tmp_path}/blobs", max_bytes=10_000)
+
+
+def test_fetch_downloads_once(cache, chart_server, tmp_path):
+	digest = serve_blob(f"{tmp_path}/www", "a.tgz", 1000)
+	assert cache.fetch(f"{chart_server.url}/a.tgz", digest, f"{tmp_path}/one.tgz") is False
+	os.remove(f"{tmp_path}/www/a.tgz")  # a hit never goes upstream
+	assert cache.fetch(f"{chart_server.url}/a.tgz", f"sha256:{digest}", f"{tmp_path}/two.tgz") is True
+	with open(f"{tmp_path}/two.tgz", "rb") as f:
+		assert hashlib.sha256(f.read()).hexdigest() == digest
+
+
+def test_fetch_over_existing_dest(cache, chart_server, tmp_path):
+	# a run killed after the fetch but before the journal recorded it resumes into the same work dir
+	digest = serve_blob(f"{tmp_path}/www", "a.tgz", 1000)
+	cache.fetch(f"{chart_server.url}/a.tgz", digest, f"{tmp_path}/a.tgz")
+	assert cache.fetch(f"{chart_server.url}/a.tgz", digest, f"{tmp_path}/a.tgz") is True
+	assert os.path.getsize(f"{tmp_path}/a.tgz") == 1000
+
+
+def test_eviction_least_recently_used(cache, chart_server, tmp_path):
+	digests = [serve_blob(f"{tmp_path}/www", f"{name}.tgz", 4000) for name in ("a", "b", "c")]
+	cache.fetch(f"{chart_server.url}/a.tgz", digests[0], f"{tmp_path}/a.tgz")
+	cache.fetch(f"{chart_server.url}/b.tgz", digests[1], f"{tmp_path}/b.tgz")
+	cache.fetch(f"{chart_server.url}/a.tgz", digests[0], f"{tmp_path}/a2.tgz")  # a is now the most recently used
+	cache.fetch(f"{chart_server.url}/c.tgz", digests[2], f"{tmp_path}/c.tgz")
+	assert sorted(os.listdir(f"{tmp_path}/blobs")) == sorted([digests[0], digests[2]])
+	# the LRU order survives a restart, via mtimes
+	assert list(BlobCache(f"{tmp_path}/blobs", max_bytes=10_000).entries) == list(cache.entries)
+
+
+def test_digest_mismatch_not_cached(cache, chart_server, tmp_path):
+	serve_blob(f"{tmp_path}/www", "a.tgz", 1000)
+	with pytest.raises(DigestMismatchError):
+		cache.fetch(f"{chart_server.url}/a.tgz", "00" * 32, f"{tmp_path}/a.tgz")
+	assert os.listdir(f"{tmp_path}/blobs") == []
@@ -0,0 +1,69 @@
+import subprocess
+
+import pytest
+
+from checkpoint import CHECKPOINT_BRANCH_PREFIX
+from checkpoint import StateCheckpointer
+from checkpoint import commit_state
+from state import ProcessedState
+
+
+def record(repo_id: str, chart: str, version: str) -> dict:
+	return {"chart.name_target": f"{repo_id}/{chart}", "version": version}
+
+
+def test_close_reports_failed_checkpoint(tmp_path):
+	# not a git repo: the final checkpoint can't be pushed, and the caller must know (see cli.finish_repo)
+	state = ProcessedState(str(tmp_path), "test")
+	checkpointer = StateCheckpointer(str(tmp_path), state, every_versions=100, every_seconds=3600)
+	state.add(record("test", "cilium", "1.16.0"))
+	assert checkpointer.close() is False
+
+
+def test_close_without_new_records(tmp_path):
+	state = ProcessedState(str(tmp_path), "test")
+	assert StateCheckpointer(str(tmp_path), state, every_versions=100, every_seconds=3600).close() is True
+
+
+def git(*args: str) -> str:
+	return subprocess.run(["git"] + list(args), check=True, capture_output=True, text=True).stdout
+
+
+@pytest.fixture
+def clones(tmp_path, monkeypatch):
+	# a bare "origin" with info/test.jsonl on main, and a function to clone it
+	for name in ("AUTHOR", "COMMITTER"):
+		monkeypatch.setenv(f"GIT_{name}_NAME", "test")
+		monkeypatch.setenv(f"GIT_{name}_EMAIL", "test@example.com")
+	git("init", "--quiet", "--bare", "--initial-branch=main", f"{tmp_path}/origin.git")
+	git("clone", "--quiet", f"{tmp_path}/origin.git", f"{tmp_path}/seed")
+	state = ProcessedState(f"{tmp_path}/seed", "test")
+	state.add(record("test", "argo", "1.0.0"))
+	git("-C", f"{tmp_path}/seed", "add", "info")
+	git("-C", f"{tmp_path}/seed", "commit", "--quiet", "-m", "seed")
+	git("-C", f"{tmp_path}/seed", "push", "--quiet", "origin", "HEAD:main")
+
+	def clone(name: str) -> str:
+		git("clone", "--quiet", f"{tmp_path}/origin.git", f"{tmp_path}/{name}")
+		return f"{tmp_path}/{name}"
+
+	return clone
+
+
+def test_commit_state_merges_checkpoints_over_a_concurrent_commit(clones):
+	job, merger, other = clones("job"), clones("merger"), clones("other")
+	state = ProcessedState(job, "test")
+	checkpointer = StateCheckpointer(job, state, every_versions=100, every_seconds=3600)
+	state.add(record("test", "cilium", "1.16.0"))
+	assert checkpointer.close() is True
+	# someone else commits to main after the merger's checkout: its first push is rejected
+	ProcessedState(other, "other").add(record("other", "redis", "7.0.0"))
+	git("-C", other, "add", "info")
+	git("-C", other, "commit", "--quiet", "-m", "other")
+	git("-C", other, "push", "--quiet", "origin", "HEAD:main")
+
+	assert commit_state(merger, ["test", "other"]) == 1
+	git("-C", other, "pull", "--quiet", "origin", "main")
+	assert "cilium--1.16.0" in ProcessedState(other, "test") and "argo--1.0.0" in ProcessedState(other, "test")
+	assert "redis--7.0.0" in ProcessedState(other, "other")
+	assert git("-C", other, "ls-remote", "origin", f"refs/heads/{CHECKPOINT_BRANCH_PREFIX}*") == ""  # merged, deleted
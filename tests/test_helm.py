@@ -0,0 +1,136 @@
+import os
+
+import pytest
+
+import cli
+from fake_registry import FaultInjection
+from helm import Inventory
+from index import IndexCache
+from limiter import AdaptiveLimiter
+
+
+def index_entries(chart: str, versions: list[str]) -> dict[str, list[dict]]:
+	return {chart: [{"name": chart, "version": v, "appVersion": v, "description": chart, "digest": f"sha-{v}", "urls": [f"https://charts.example.com/{chart}-{v}.tgz"]} for v in versions]}
+
+
+@pytest.fixture
+def plan(tmp_path, monkeypatch):
+	# a fresh Inventory per call, as each run is; the processed state (info/) and cache dir persist between calls
+	monkeypatch.chdir(tmp_path)
+	monkeypatch.setenv("TOOCI_CACHE_DIR", f"{tmp_path}/cache")
+	(tmp_path / "repos.yaml").write_text('hash: "test"\nrepositories:\n  "test":\n    source: "https://charts.example.com"\n')
+
+	def plan_run(entries: dict[str, list[dict]], process: bool) -> list[str]:
+		repo = Inventory("registry.example.com/test").charts["test"]
+		repo.index_entries = entries
+		repo.get_chart_info()
+		pending = repo.pending_versions(repo.versions_to_process())
+		if process:
+			for version in pending:
+				version.record()
+			repo.state.compact()
+		return [v.version for v in pending]
+
+	return plan_run
+
+
+def test_pending_versions_newest_first(plan):
+	assert plan(index_entries("cilium", ["1.15.0", "1.16.1", "1.16.0"]), process=False) == ["1.16.1", "1.16.0", "1.15.0"]
+
+
+def test_pending_versions_picks_up_backports(plan):
+	# a backport published after a newer release is still new
+	assert plan(index_entries("cilium", ["1.15.0", "1.16.0", "1.16.1"]), process=True) == ["1.16.1", "1.16.0", "1.15.0"]
+	assert plan(index_entries("cilium", ["1.15.0", "1.15.1", "1.16.0", "1.16.1", "1.16.2"]), process=True) == ["1.16.2", "1.15.1"]
+	assert plan(index_entries("cilium", ["1.15.0", "1.15.1", "1.16.0", "1.16.1", "1.16.2"]), process=False) == []
+
+
+@pytest.fixture
+def new_repo(tmp_path, monkeypatch):
+	# a repo as a fresh run sees it: index (ETag "v1") from the index cache, processed state from info/
+	monkeypatch.chdir(tmp_path)
+	monkeypatch.setenv("TOOCI_CACHE_DIR", f"{tmp_path}/cache")
+	(tmp_path / "repos.yaml").write_text('hash: "test"\nrepositories:\n  "test":\n    source: "https://charts.example.com"\n')
+
+	def make(entries: dict[str, list[dict]], shard: tuple[int, int] | None = None, base_oci_ref: str = "registry.example.com/test"):
+		repo = Inventory(base_oci_ref).charts["test"]
+		if shard is not None:
+			repo.set_shard(*shard)
+		repo.index_cache = IndexCache(repo.source)
+		if not repo.index_cache.meta:
+			repo.index_cache.store(entries, "v1", None)
+		repo.index_not_modified = True
+		repo.index_entries = entries
+		repo.get_chart_info()
+		return repo
+
+	return make
+
+
+def process_all_versions(repo):
+	versions = repo.versions_to_process()
+	for version in repo.pending_versions(versions):
+		version.record()
+	repo.state.compact()
+	repo.mark_processed(versions)
+
+
+def test_processed_marker_short_circuits(new_repo):
+	entries = index_entries("cilium", ["1.15.0", "1.16.0"])
+	process_all_versions(new_repo(entries))
+	repo = new_repo(entries)
+	assert repo.index_unchanged_since_processed()
+	assert repo.plan_unchanged_since_processed(repo.versions_to_process())
+
+
+def test_processed_marker_void_without_state(new_repo, tmp_path):
+	# records that never made it to info/ (failed checkpoint or commit), or info/ reset on purpose: plan again
+	entries = index_entries("cilium", ["1.15.0", "1.16.0"])
+	process_all_versions(new_repo(entries))
+	os.remove(f"{tmp_path}/info/test.jsonl")
+	repo = new_repo(entries)
+	assert not repo.index_unchanged_since_processed()
+	assert not repo.plan_unchanged_since_processed(repo.versions_to_process())
+	assert [v.version for v in repo.pending_versions(repo.versions_to_process())] == ["1.16.0", "1.15.0"]
+
+
+def test_processed_marker_of_shard_ignores_other_shards(new_repo):
+	entries = index_entries("cilium", [f"1.{i}.0" for i in range(20)])
+	process_all_versions(new_repo(entries, (0, 2)))
+	other = new_repo(entries, (1, 2))
+	for version in other.versions_to_process()[:3]:
+		version.record()  # the other shard makes progress
+	assert new_repo(entries, (0, 2)).index_unchanged_since_processed()
+
+
+def test_record_after_journal_closed_dropped(new_repo):
+	# a push abandoned at the drain deadline finishing after finish_repo: not recorded, reconcile backfills it next run
+	repo = new_repo(index_entries("cilium", ["1.16.0"]))
+	repo.open_journal()
+	repo.journal.close(lambda key: key in repo.state)
+	version = repo.versions_to_process()[0]
+	version.record_stage()
+	assert version.state_key not in repo.state
+
+
+def reconciling_repo(new_repo, registry):
+	repo = new_repo(index_entries("cilium", ["1.15.0", "1.16.0"]), base_oci_ref=f"{registry.address}/charts")
+	repo.inventory.push_limiter = AdaptiveLimiter("push", max_limit=2, attempts=2, backoff_base=0.0)
+	return repo
+
+
+def test_reconcile_backfills_versions_in_registry(new_repo, registry):
+	registry.state.manifests["charts/test/cilium"] = {"1.16.0": b"{}"}
+	repo = reconciling_repo(new_repo, registry)
+	pending = cli.pending_versions(repo, repo.versions_to_process(), reconcile=True, verify_digests=False, checkpoint=None)
+	assert [v.version for v in pending] == ["1.15.0"]
+	assert "cilium--1.16.0" in repo.state
+
+
+def test_reconcile_failure_processes_all_pending(new_repo, registry):
+	# reconciling is only an optimization: a registry that can't list tags doesn't fail the repo
+	registry.state.faults = FaultInjection(failure_rate=1.0)
+	repo = reconciling_repo(new_repo, registry)
+	pending = cli.pending_versions(repo, repo.versions_to_process(), reconcile=True, verify_digests=False, checkpoint=None)
+	assert [v.version for v in pending] == ["1.16.0", "1.15.0"]
+	assert len(repo.state) == 0
@@ -0,0 +1,51 @@
+from journal import FETCHED
+from journal import PUSHED
+from journal import RECORDED
+from journal import WorkJournal
+
+
+def fetched_journal(tmp_path) -> tuple[WorkJournal, str]:
+	journal = WorkJournal(str(tmp_path), "test")
+	artifact = f"{journal.work_dir('cilium-1.16.0')}/cilium-1.16.0.tgz"
+	with open(artifact, "wb") as f:
+		f.write(b"chart")
+	journal.log("cilium-1.16.0", FETCHED, artifact)
+	return journal, artifact
+
+
+def test_resume_point_reuses_fetched_artifact(tmp_path):
+	journal, artifact = fetched_journal(tmp_path)
+	assert WorkJournal(str(tmp_path), "test").resume_point("cilium-1.16.0") == (FETCHED, artifact)
+
+
+def test_resume_point_changed_artifact(tmp_path):
+	journal, artifact = fetched_journal(tmp_path)
+	with open(artifact, "wb") as f:
+		f.write(b"truncated")
+	assert WorkJournal(str(tmp_path), "test").resume_point("cilium-1.16.0") == (None, None)
+
+
+def test_resume_point_missing_artifact(tmp_path):
+	journal, artifact = fetched_journal(tmp_path)
+	journal.discard("cilium-1.16.0")
+	assert WorkJournal(str(tmp_path), "test").resume_point("cilium-1.16.0") == (None, None)
+
+
+def test_truncated_line_ignored(tmp_path):
+	journal = WorkJournal(str(tmp_path), "test")
+	journal.log("cilium-1.16.0", PUSHED)
+	with open(journal.path, "a") as f:
+		f.write('{"key":"cilium-1.16.1","sta')  # killed mid-write
+	resumed = WorkJournal(str(tmp_path), "test")
+	assert resumed.resume_point("cilium-1.16.0") == (PUSHED, None)
+	assert resumed.resume_point("cilium-1.16.1") == (None, None)
+
+
+def test_writes_after_close_dropped(tmp_path):
+	# a thread abandoned at the drain deadline must not write to (or reopen) a closed, compacted journal
+	journal = WorkJournal(str(tmp_path), "test")
+	journal.log("cilium-1.16.0", PUSHED)
+	journal.close(lambda key: False)
+	journal.log("cilium-1.16.0", RECORDED)
+	assert journal.closed
+	assert WorkJournal(str(tmp_path), "test").resume_point("cilium-1.16.0") == (PUSHED, None)
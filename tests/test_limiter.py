@@ -0,0 +1,45 @@
+import tarfile
+
+import requests
+import yaml
+
+from limiter import AdaptiveLimiter
+from limiter import FATAL
+from limiter import RATE_LIMITED
+from limiter import RETRYABLE
+from limiter import classify_error
+from utils import DigestMismatchError
+from utils import HttpError
+from utils import ShellError
+
+
+def test_classify_error():
+	assert classify_error(HttpError("too many", 429)) == RATE_LIMITED
+	assert classify_error(HttpError("bad gateway", 502)) == RETRYABLE
+	assert classify_error(HttpError("not found", 404)) == FATAL
+	assert classify_error(requests.ConnectionError("reset")) == RETRYABLE
+	assert classify_error(ShellError("shell command failed: ['helm', 'push'] with return code 1", 1)) == RETRYABLE
+
+
+def test_digest_mismatch_is_not_retried():
+	assert classify_error(DigestMismatchError("Digest mismatch", "00" * 32)) == FATAL
+
+
+def test_bad_input_is_not_retried():
+	for e in (ValueError("No download URLs in index"), KeyError("version"), tarfile.ReadError("not a gzip file"), yaml.YAMLError("bad Chart.yaml"), Exception("bug")):
+		assert classify_error(e) == FATAL, e
+
+
+def test_fatal_error_called_once():
+	calls = []
+
+	def broken():
+		calls.append(1)
+		raise ValueError("No download URLs in index")
+
+	limiter = AdaptiveLimiter("test", max_limit=2, backoff_base=0.0)
+	try:
+		limiter.call("broken", broken)
+	except ValueError:
+		pass
+	assert len(calls) == 1
@@ -0,0 +1,36 @@
+import hashlib
+
+import requests
+
+from oci import BlobLocations
+from oci import OciClient
+
+DATA = b"chart tarball"
+DIGEST = f"sha256:{hashlib.sha256(DATA).hexdigest()}"
+
+
+def test_upload_blob_mounts_from_known_location(registry):
+	client = OciClient(requests.Session())
+	assert client.upload_blob(registry.address, "charts/a/cilium", DIGEST, DATA) == "uploaded"
+	assert client.upload_blob(registry.address, "charts/b/cilium", DIGEST, DATA, mount_from="charts/a/cilium") == "mounted"
+	assert client.upload_blob(registry.address, "charts/b/cilium", DIGEST, DATA, mount_from="charts/a/cilium") == "present"
+	assert registry.state.mounts == 1
+
+
+def test_upload_blob_stale_location_falls_back_to_upload(registry):
+	# the location is wrong (eg: package deleted): the mount is refused, and the blob uploaded as usual
+	client = OciClient(requests.Session())
+	assert client.upload_blob(registry.address, "charts/b/cilium", DIGEST, DATA, mount_from="charts/gone/cilium") == "uploaded"
+	assert registry.state.blobs["charts/b/cilium"][DIGEST] == DATA
+	assert registry.state.mounts == 0
+
+
+def test_blob_locations_persist(tmp_path):
+	locations = BlobLocations(f"{tmp_path}/locations.jsonl")
+	locations.add("ghcr.io", DIGEST, "charts/a/cilium")
+	locations.add("ghcr.io", DIGEST, "charts/b/cilium")  # the first known location is kept
+	with open(f"{tmp_path}/locations.jsonl", "a") as f:
+		f.write('{"registry": "ghcr.io", "dig')  # a line cut short by a killed run
+	reloaded = BlobLocations(f"{tmp_path}/locations.jsonl")
+	assert reloaded.find("ghcr.io", DIGEST, "charts/b/cilium") == "charts/a/cilium"
+	assert reloaded.find("ghcr.io", DIGEST, "charts/a/cilium") is None  # never mount a repository from itself
@@ -0,0 +1,62 @@
+import pytest
+
+from semver import is_prerelease
+from semver import satisfies
+from semver import version_key
+
+
+def test_version_key_precedence():
+	ordered = ["1.0.0-alpha", "1.0.0-alpha.1", "1.0.0-alpha.beta", "1.0.0-beta", "1.0.0-beta.2", "1.0.0-beta.11", "1.0.0-rc.1", "1.0.0", "1.0.1", "1.2.0", "1.10.0", "2.0.0"]
+	assert sorted(reversed(ordered), key=version_key) == ordered
+
+
+def test_version_key_loose_forms():
+	assert version_key("v1.2.3") == version_key("1.2.3")
+	assert version_key("1.2")[:3] == version_key("1.2.0")[:3]
+	assert version_key("1")[:3] == version_key("1.0.0")[:3]
+
+
+def test_version_key_invalid_sorts_first():
+	assert version_key("latest") < version_key("0.0.1")
+	assert version_key("banana") < version_key("latest")  # among themselves, by string
+
+
+def test_is_prerelease():
+	assert is_prerelease("1.0.0-rc.1")
+	assert not is_prerelease("1.0.0")
+	assert not is_prerelease("1.0.0+build.5")
+	assert not is_prerelease("not-a-version")
+
+
+@pytest.mark.parametrize("version, constraint, expected", [
+	("1.2.3", ">=1.2.0 <2", True),
+	("2.0.0", ">=1.2.0 <2", False),
+	("2.0.0-rc.1", ">=1.2.0 <2", False),
+	("1.2.3", ">=1.2.0, <2", True),
+	("1.2.3", ">= 1.2", True),
+	("1.1.0", ">= 1.2", False),
+	("1.2.3", ">= 1.2, < 2", True),
+	("2.1.0", ">= 1.2, < 2", False),
+	("1.9.4", "^ 2.1 || ~ 1.9.4", True),
+	("1.16.0", "!=1.16.0", False),
+	("1.9.4", "^2.1 || ~1.9.4", True),
+	("1.10.0", "~1.9.4", False),
+	("2.5.0", "^2.1", True),
+	("3.0.0", "^2.1", False),
+	("0.2.9", "^0.2.3", True),
+	("0.3.0", "^0.2.3", False),
+	("0.0.4", "^0.0.3", False),
+	("1.9.0", "~1", True),
+	("2.0.0", "~1", False),
+	("1.2.0", "=1.2", True),
+	("latest", ">=0", False),
+])
+def test_satisfies(version, constraint, expected):
+	assert satisfies(version, constraint) is expected
+
+
+def test_satisfies_invalid_constraint():
+	with pytest.raises(Exception):
+		satisfies("1.0.0", ">=banana")
+	with pytest.raises(Exception):
+		satisfies("1.0.0", ">= ")
@@ -0,0 +1,63 @@
+import json
+import os
+
+from state import ProcessedState
+
+
+def record(chart: str, version: str, repo_id: str = "test") -> dict:
+	return {"chart.name_target": f"{repo_id}/{chart}", "version": version}
+
+
+def lines(path) -> list[dict]:
+	with open(path) as f:
+		return [json.loads(line) for line in f]
+
+
+def test_add_and_load(tmp_path):
+	state = ProcessedState(str(tmp_path), "test")
+	state.add(record("cilium", "1.16.0"))
+	state.add(record("cilium", "1.16.0"))  # a retried version, appended twice
+	reloaded = ProcessedState(str(tmp_path), "test")
+	assert "cilium--1.16.0" in reloaded
+	assert len(reloaded) == 1
+
+
+def test_compact_sorts_and_folds_segments(tmp_path):
+	ProcessedState(str(tmp_path), "test", segment="shard-1-of-2").add(record("cilium", "1.16.0"))
+	main = ProcessedState(str(tmp_path), "test")
+	main.add(record("argo", "2.0.0"))
+	main.add(record("argo", "1.0.0"))
+	main.compact()
+	assert [r["version"] for r in lines(main.main_file)] == ["1.0.0", "2.0.0", "1.16.0"]
+	assert main.segment_files() == []
+
+
+def test_segment_compacts_only_its_own_records(tmp_path):
+	ProcessedState(str(tmp_path), "test").add(record("argo", "1.0.0"))
+	shard = ProcessedState(str(tmp_path), "test", segment="shard-1-of-2")
+	assert "argo--1.0.0" in shard  # sees everything...
+	shard.add(record("cilium", "1.16.0"))
+	shard.compact()
+	assert lines(shard.state_file) == [record("cilium", "1.16.0")]  # ...writes only its own
+
+
+def test_merge_keeps_existing_records(tmp_path):
+	state = ProcessedState(str(tmp_path), "test")
+	state.add(dict(record("cilium", "1.16.0"), description="ours"))
+	incoming = [dict(record("cilium", "1.16.0"), description="theirs"), record("cilium", "1.16.1")]
+	assert state.merge(incoming) == 1
+	assert state.merge(incoming) == 0  # the same records again: nothing new
+	state.compact()
+	assert [r.get("description") for r in lines(state.main_file)] == ["ours", None]
+
+
+def test_migrate_legacy(tmp_path):
+	os.makedirs(f"{tmp_path}/info/test")
+	for version in ("1.0.0", "1.1.0"):
+		with open(f"{tmp_path}/info/test/cilium--{version}.json", "w") as f:
+			json.dump(record("cilium", version), f)
+	state = ProcessedState(str(tmp_path), "test")
+	assert "cilium--1.1.0" in state  # known from the file name alone, before migrating
+	assert state.migrate_legacy() == 2
+	assert not os.path.exists(f"{tmp_path}/info/test")
+	assert [r["version"] for r in lines(state.main_file)] == ["1.0.0", "1.1.0"]
@@ -0,0 +1,116 @@
+import collections
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+from utils import cache_dir
+from utils import http_download
+
+log = logging.getLogger("blobcache")
+
+singleton_blob_cache: "BlobCache | None" = None
+singleton_blob_cache_lock = threading.Lock()
+
+
+class BlobCache:
+	# Content-addressed cache of chart tarballs: <cache>/blobs/sha256/<hex digest>, keyed by the index.yaml 'digest'.
+	# A tarball is downloaded once, however many repos (eg: bitnami-classic + bitnami-relic), processors or retries
+	# consume it. Writes are atomic (temp file + rename, after digest verification); size is bounded with LRU eviction,
+	# tracked in memory (scanned once at startup) so there's no stat() storm on every insert.
+	root: str
+	max_bytes: int
+	entries: collections.OrderedDict[str, int]  # hex digest -> size; least recently used first
+
+	def __init__(self, root: str, max_bytes: int):
+		self.root = root
+		self.max_bytes = max_bytes
+		self.lock = threading.Lock()
+		self.digest_locks: dict[str, threading.Lock] = {}
+		self.entries = collections.OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		scanned = []
+		for name in os.listdir(self.root):
+			if name.startswith("."):  # leftover temp file of an interrupted download
+				os.remove(f"{self.root}/{name}")
+				continue
+			stat = os.stat(f"{self.root}/{name}")
+			scanned.append((stat.st_mtime, name, stat.st_size))
+		for _, name, size in sorted(scanned):
+			self.entries[name] = size
+		log.info(f"Blob cache '{self.root}': {len(self.entries)} blobs, {sum(self.entries.values())} bytes (max {self.max_bytes})")
+
+	def path(self, hex_digest: str) -> str:
+		return f"{self.root}/{hex_digest}"
+
+	def lock_for(self, hex_digest: str) -> threading.Lock:
+		with self.lock:
+			return self.digest_locks.setdefault(hex_digest, threading.Lock())
+
+	def fetch(self, url: str, digest: str, dest_path: str) -> bool:
+		# Places the blob at dest_path (hard link, or copy across filesystems); returns True on a cache hit.
+		# Callers must never modify dest_path in place (processors write a new file and rename over it).
+		hex_digest = digest.removeprefix("sha256:")
+		with self.lock_for(hex_digest):  # concurrent consumers of the same blob wait for one download
+			with self.lock:
+				hit = hex_digest in self.entries
+				if hit:
+					self.entries.move_to_end(hex_digest)
+					self.hits += 1
+				else:
+					self.misses += 1
+			if hit:
+				os.utime(self.path(hex_digest))  # persist recency for the next run's LRU order
+				log.info(f"Blob cache hit for '{url}' ({hex_digest[:12]})")
+			else:
+				fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix=f".{hex_digest[:12]}.")
+				os.close(fd)
+				try:
+					size = http_download(url, tmp_path, hex_digest)
+					os.replace(tmp_path, self.path(hex_digest))
+				except:
+					os.remove(tmp_path)
+					raise
+				with self.lock:
+					self.entries[hex_digest] = size
+			try:
+				os.remove(dest_path)  # a resumed run's work dir may still have it from a fetch the journal never recorded
+			except FileNotFoundError:
+				pass
+			try:
+				os.link(self.path(hex_digest), dest_path)
+			except OSError:
+				shutil.copyfile(self.path(hex_digest), dest_path)
+		if not hit:
+			self.evict()
+		return hit
+
+	def evict(self):
+		with self.lock:
+			total = sum(self.entries.values())
+			evicted = []
+			for hex_digest in list(self.entries):  # least recently used first
+				if total <= self.max_bytes:
+					break
+				if hex_digest in self.digest_locks and self.digest_locks[hex_digest].locked():
+					continue  # being placed for a consumer right now
+				total -= self.entries.pop(hex_digest)
+				evicted.append(hex_digest)
+		for hex_digest in evicted:
+			try:
+				os.remove(self.path(hex_digest))
+			except FileNotFoundError:
+				pass
+		if evicted:
+			log.info(f"Blob cache evicted {len(evicted)} least recently used blobs; now {total} bytes")
+
+
+def blob_cache() -> BlobCache:
+	global singleton_blob_cache
+	with singleton_blob_cache_lock:
+		if singleton_blob_cache is None:
+			max_bytes = int(os.environ.get("BLOB_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+			singleton_blob_cache = BlobCache(cache_dir("blobs/sha256"), max_bytes)
+		return singleton_blob_cache
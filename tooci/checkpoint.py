@@ -0,0 +1,182 @@
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from state import ProcessedState
+from utils import JsonStreamDecoder
+from utils import shell
+from utils import shell_stream
+
+log = logging.getLogger("checkpoint")
+
+CHECKPOINT_BRANCH_PREFIX = "tooci-state/"
+PUSH_ATTEMPTS = 5
+
+
+def git(base_path: str, args: list[str], env: dict[str, str] | None = None) -> str:
+	return shell(["git", "-C", base_path] + args, env).strip()
+
+
+def git_ok(base_path: str, args: list[str]) -> bool:
+	# for commands whose failure is an answer, not an error (a lost push race, a lease that no longer holds)
+	result = shell_stream(["git", "-C", base_path] + args)
+	if result.returncode != 0:
+		log.info(f"git {args[0]} exited {result.returncode}: {result.stderr_tail.strip()}")
+	return result.returncode == 0
+
+
+class StateCheckpointer:
+	# Publishes a job's processed state while it runs: every `every_versions` new records or `every_seconds` (whichever
+	# comes first), the state file is committed onto a branch of its own, tooci-state/<file name>, and force-pushed.
+	# One writer per branch, so no races and no rebases however many jobs run; a job killed at the timeout loses at
+	# most one interval. Only plumbing is used (hash-object, a throwaway index, commit-tree): the checkout's branch,
+	# index and working tree are left alone. `commit-state` folds the branches into info/ on the main branch.
+	state: ProcessedState
+	branch: str
+	path: str  # the state file, relative to the repo root
+	every_versions: int
+	every_seconds: float
+	pending: int  # records added since the last successful checkpoint
+
+	def __init__(self, base_path: str, state: ProcessedState, every_versions: int, every_seconds: float, remote: str = "origin"):
+		self.base_path = base_path
+		self.state = state
+		self.path = os.path.relpath(state.state_file, base_path)
+		self.branch = f"{CHECKPOINT_BRANCH_PREFIX}{os.path.basename(state.state_file)[:-len('.jsonl')]}"
+		self.every_versions = every_versions
+		self.every_seconds = every_seconds
+		self.remote = remote
+		self.pending = 0
+		self.last = time.monotonic()
+		self.lock = threading.Lock()
+		self.due = threading.Event()
+		self.closed = False
+		self.thread = threading.Thread(target=self.loop, name=f"Checkpoint-{state.repo_id}", daemon=True)
+		self.thread.start()
+		state.on_add = self.added
+		log.info(f"Checkpointing '{self.path}' to branch '{self.branch}' every {every_versions} versions or {every_seconds:.0f}s")
+
+	def added(self):
+		with self.lock:
+			self.pending += 1
+			if self.pending >= self.every_versions:
+				self.due.set()
+
+	def loop(self):
+		# git runs here, never on a worker thread
+		while True:
+			self.due.wait(timeout=self.every_seconds)
+			self.due.clear()
+			if self.closed:
+				return  # close() does the last one
+			with self.lock:
+				due = self.pending >= self.every_versions or (self.pending and time.monotonic() - self.last >= self.every_seconds)
+			if due:
+				self.checkpoint()
+
+	def checkpoint(self) -> bool:
+		with self.lock:
+			count, self.pending = self.pending, 0
+		try:
+			self.push_snapshot(self.state.read_state_file())
+			self.last = time.monotonic()
+			return True
+		except Exception as e:
+			# never fails the run: the records are still on disk, and the next checkpoint gets them
+			log.warning(f"Checkpoint of '{self.path}' to '{self.branch}' failed: {e}")
+			with self.lock:
+				self.pending += count
+			return False
+
+	def push_snapshot(self, data: bytes):
+		start = time.monotonic()
+		with tempfile.TemporaryDirectory(prefix="tooci-checkpoint-") as tmp_dir:
+			with open(f"{tmp_dir}/state.jsonl", "wb") as f:
+				f.write(data)
+			env = dict(os.environ, GIT_INDEX_FILE=f"{tmp_dir}/index")
+			blob = git(self.base_path, ["hash-object", "-w", f"{tmp_dir}/state.jsonl"])
+			git(self.base_path, ["update-index", "--add", "--cacheinfo", f"100644,{blob},{self.path}"], env)
+			tree = git(self.base_path, ["write-tree"], env)
+			lines = data.count(b"\n")
+			commit = git(self.base_path, ["commit-tree", tree, "-m", f"Checkpoint of {self.path}: {lines} versions"])
+			git(self.base_path, ["push", "--force", "--quiet", self.remote, f"{commit}:refs/heads/{self.branch}"])
+		log.info(f"Checkpointed '{self.path}' ({lines} versions) to branch '{self.branch}' in {time.monotonic() - start:.1f}s")
+
+	def close(self) -> bool:
+		# final checkpoint; call after the state is compacted. False if records are left that never made it to a branch
+		self.closed = True
+		self.due.set()
+		self.thread.join()
+		self.state.on_add = None
+		return self.checkpoint() if self.pending else True
+
+
+def read_checkpoint(base_path: str, commit: str) -> list[dict]:
+	# all records in a checkpoint commit's info/*.jsonl files, streamed straight from git into the JSON decoder
+	records = []
+	for path in git(base_path, ["ls-tree", "-r", "--name-only", commit]).splitlines():
+		if not (path.startswith("info/") and path.endswith(".jsonl")):
+			continue
+		decoder = JsonStreamDecoder(records.append)
+		result = shell_stream(["git", "-C", base_path, "cat-file", "blob", f"{commit}:{path}"], decoder)
+		if result.returncode != 0:
+			raise Exception(f"Reading '{path}' from checkpoint {commit} failed: {result.stderr_tail}")
+		decoder.close()
+	return records
+
+
+def fold_records(base_path: str, repo_ids: list[str], records_by_repo: dict[str, list[dict]]) -> int:
+	# union by version key into the checkout's info/, sorted; the same result whatever the order, and however often it's redone
+	merged = 0
+	for repo_id in sorted(set(repo_ids) | set(records_by_repo)):
+		state = ProcessedState(base_path, repo_id)
+		new = state.merge(records_by_repo.get(repo_id, []))
+		if new or state.segment_files():
+			state.compact(force=True)
+		if new:
+			log.info(f"Repo '{repo_id}': merged {new} versions from checkpoints")
+		merged += new
+	return merged
+
+
+def commit_state(base_path: str, repo_ids: list[str], push: bool = True, remote: str = "origin") -> int:
+	# Folds every checkpoint branch, and any shard segment files, into info/<repo-id>.jsonl (see fold_records), commits
+	# once and pushes once. If the push is rejected (someone else committed meanwhile), the checkout is reset to the remote
+	# branch and the fold redone on top of it: never a textual rebase of the sorted state files, which could conflict.
+	# Then the merged branches are deleted, each only if it still points at what was merged (a job still running may have
+	# pushed a newer checkpoint meanwhile).
+	git(base_path, ["fetch", "--prune", "--quiet", remote, f"+refs/heads/{CHECKPOINT_BRANCH_PREFIX}*:refs/remotes/{remote}/{CHECKPOINT_BRANCH_PREFIX}*"])
+	listing = git(base_path, ["for-each-ref", "--format=%(refname) %(objectname)", f"refs/remotes/{remote}/{CHECKPOINT_BRANCH_PREFIX}"])
+	checkpoints = sorted(tuple(line.split(" ")) for line in listing.splitlines() if line)
+	log.info(f"Found {len(checkpoints)} state checkpoint branches")
+
+	records_by_repo: dict[str, list[dict]] = {}
+	for _, commit in checkpoints:
+		for record in read_checkpoint(base_path, commit):
+			records_by_repo.setdefault(record["chart.name_target"].split("/", 1)[0], []).append(record)
+
+	branch = git(base_path, ["rev-parse", "--abbrev-ref", "HEAD"])
+	for attempt in range(1, PUSH_ATTEMPTS + 1):
+		merged = fold_records(base_path, repo_ids, records_by_repo)
+		git(base_path, ["add", "--all", "info"])
+		if git_ok(base_path, ["diff", "--cached", "--quiet"]):
+			log.info("Processed state unchanged; nothing to commit")
+			break
+		git(base_path, ["commit", "--quiet", "-m", f"Update info: {merged} versions from {len(checkpoints)} checkpoints"])
+		if not push or git_ok(base_path, ["push", "--quiet", remote, f"HEAD:refs/heads/{branch}"]):
+			break
+		if attempt == PUSH_ATTEMPTS:
+			raise Exception(f"Pushing the merged state failed {PUSH_ATTEMPTS} times")
+		log.warning(f"Push of merged state rejected (attempt {attempt}); merging again on top of the remote '{branch}'")
+		git(base_path, ["fetch", "--quiet", remote, f"+refs/heads/{branch}:refs/remotes/{remote}/{branch}"])
+		git(base_path, ["reset", "--hard", "--quiet", f"refs/remotes/{remote}/{branch}"])
+
+	if push:
+		for ref, commit in checkpoints:
+			state_branch = ref.removeprefix(f"refs/remotes/{remote}/")
+			if not git_ok(base_path, ["push", "--quiet", f"--force-with-lease=refs/heads/{state_branch}:{commit}", remote, f":refs/heads/{state_branch}"]):
+				log.warning(f"Keeping checkpoint branch '{state_branch}': it moved since it was merged")
+	return merged
+
@@ -1,16 +1,27 @@
-import concurrent.futures
+import hashlib
 import json
 import logging
-import multiprocessing
+import math
 import os
+import signal
 import sys
 
 import click
-from rich.pretty import pretty_repr
 
 import helm
 import utils
+from checkpoint import commit_state
 from helm import Inventory
+from pipeline import Pipeline
+from scheduler import ScheduleResult
+from scheduler import Scheduler
+from scheduler import default_max_workers
+from scheduler import graceful_shutdown
+from state import ProcessedState
+from timings import markdown_summary
+from timings import run_timings
+from timings import write_report
+from utils import pretty
 from utils import setup_logging
 
 log: logging.Logger = setup_logging("cli")
@@ -21,69 +32,270 @@ def cli():
 	pass
 
 
-@cli.command(help="Produce GHA matrix from the inventory of repos")
-def gha_matrix():
+def parse_shard(ctx, param, value) -> tuple[int, int] | None:
+	if value is None:
+		return None
+	try:
+		index, count = (int(x) for x in value.split("/"))
+	except ValueError:
+		raise click.BadParameter(f"expected <index>/<count>, eg 0/4; got '{value}'")
+	if count < 1 or not (0 <= index < count):
+		raise click.BadParameter(f"shard index must be in [0, count); got '{value}'")
+	return index, count
+
+
+@cli.command(help="Produce GHA matrix from the inventory of repos; repos are split into shards by pending work")
+@click.option('--shard-size', envvar="SHARD_SIZE", type=int, default=500, help='Target number of pending chart versions per job')
+@click.option('--max-shards', envvar="MAX_SHARDS", type=int, default=8, help='Maximum number of jobs (shards) per repo')
+def gha_matrix(shard_size, max_shards):
 	repos = Inventory(None)
-	contents = [{"id": chart.repo_id} for chart in repos.charts.values()]
+	repos.refresh_indexes(list(repos.charts.values()))
+	contents = []
+	for repo in repos.charts.values():
+		try:
+			repo.update_index()  # no-op, unless the concurrent refresh failed for this repo: then retry, and raise
+			repo.get_chart_info()
+			pending = len(repo.pending_versions(repo.versions_to_process()))
+		except:
+			# let the repo's own job run and surface the error
+			log.exception(f"Failed computing pending versions for repo '{repo.repo_id}'; giving it a single job")
+			pending = None
+		if pending == 0:
+			log.info(f"Repo '{repo.repo_id}' has no pending versions; no job needed")
+			continue
+		shards = 1 if pending is None else min(max_shards, math.ceil(pending / shard_size))
+		log.info(f"Repo '{repo.repo_id}': {pending} pending versions in {shards} shards")
+		# the chart blob cache lineage: repos with the same upstream (eg: bitnami-classic and bitnami-relic) share one
+		blob_key = hashlib.sha256(repo.source.rstrip("/").encode("utf-8")).hexdigest()[:16]
+		for index in range(shards):
+			contents.append({"id": repo.repo_id, "shard": f"{index}/{shards}", "shard_key": f"{index}-of-{shards}", "blob_key": blob_key, "pending": (pending or 0) // shards})
+
+	contents.sort(key=lambda entry: entry["pending"], reverse=True)  # biggest jobs first
 	utils.set_gha_output("jsonmatrix", json.dumps(contents))
 
 
+def plan_repo(repo: helm.ChartRepo, force: bool) -> list[helm.HelmChartVersion] | None:
+	# fetch the index and work out the versions to process; None if the repo is unchanged since its last complete run
+	log.info(f"Processing repo '{repo.repo_id}' at '{repo.source}'")
+	if log.isEnabledFor(logging.DEBUG):
+		log.debug(pretty(repo))
+
+	repo.update_index()
+	if repo.index_unchanged_since_processed() and not force:
+		log.info(f"Index for repo '{repo.repo_id}' not modified since last complete run; nothing to do.")
+		print(f"\n::notice::{repo.repo_id} unchanged upstream; nothing to process.\n")
+		return None
+
+	repo.get_chart_info()
+
+	chart_versions: list[helm.HelmChartVersion] = repo.versions_to_process()
+	if repo.plan_unchanged_since_processed(chart_versions) and not force:
+		log.info(f"Versions for repo '{repo.repo_id}' identical to last complete run; nothing to do.")
+		print(f"\n::notice::{repo.repo_id} has no new versions upstream; nothing to process.\n")
+		return None
+
+	return chart_versions
+
+
+def pending_versions(repo: helm.ChartRepo, chart_versions: list[helm.HelmChartVersion], reconcile: bool, verify_digests: bool, checkpoint: tuple[int, float] | None) -> list[helm.HelmChartVersion]:
+	if checkpoint is not None:  # before reconciling, which records versions too
+		repo.open_checkpointer(*checkpoint)
+	pending = repo.pending_versions(chart_versions)
+	if reconcile and pending:
+		try:
+			pending = repo.reconcile_with_registry(pending, verify_digests)
+		except Exception as e:
+			# only an optimization: process the unreconciled list (versions it did backfill are skipped as already processed)
+			log.warning(f"Reconciling repo '{repo.repo_id}' with the registry failed; processing all {len(pending)} pending versions: {e}")
+	repo.open_journal()
+	repo.journal.log_planned([v.state_key for v in pending])
+	return pending
+
+
+def finish_repo(repo: helm.ChartRepo, chart_versions: list[helm.HelmChartVersion], result: ScheduleResult):
+	repo.journal.close(lambda key: key in repo.state)  # first: from here on, abandoned threads record nothing (see record_stage)
+	repo.state.compact()
+	checkpointed = repo.checkpointer.close() if repo.checkpointer is not None else True
+	counts = result.repo_counts(repo.repo_id)
+	log.info(f"Finished repo '{repo.repo_id}': {len(chart_versions)} chart versions; {counts}")
+	if result.repo_complete(repo.repo_id) and checkpointed:
+		repo.mark_processed(chart_versions)
+	elif not checkpointed:
+		# not marked: the next run plans again, and reconciling backfills what was pushed but never reached info/
+		print(f"\n::warning::{repo.repo_id} processed state was not checkpointed; the next run will reconcile it.\n")
+
+	# Site a GitHub Actions "notice" output to stdout
+	print(f"\n::notice::{repo.repo_id} processed  {counts['processed']} new chart versions.\n")
+	if counts["failed"]:
+		print(f"\n::error::{repo.repo_id} failed {counts['failed']} chart versions.\n")
+	if counts["not_started"]:
+		print(f"\n::warning::{repo.repo_id} ran out of time with {counts['not_started']} chart versions not started.\n")
+
+
+def install_shutdown_handler(drain_seconds: float):
+	# GitHub Actions sends SIGINT when a step times out or the run is cancelled, SIGTERM ~7.5s later, then SIGKILL.
+	# The first signal starts a graceful shutdown (see scheduler.GracefulShutdown); later ones don't cut the drain short.
+	# Only a flag is set here; the schedulers notice and log it.
+	def request_shutdown(signum, frame):
+		graceful_shutdown().request(drain_seconds)
+
+	signal.signal(signal.SIGINT, request_shutdown)
+	signal.signal(signal.SIGTERM, request_shutdown)
+
+
+def run_versions(chart_versions: list[helm.HelmChartVersion], time_budget: float | None, engine: str) -> ScheduleResult:
+	if engine == "pipeline":
+		return Pipeline(default_max_workers(), time_budget).run(chart_versions)
+	return Scheduler(default_max_workers(), time_budget).run(chart_versions)
+
+
+def report_run(result: ScheduleResult, report_dir: str | None):
+	# per-stage timings of the run: JSON + OpenMetrics files (if asked for), and a percentile table in the GHA step summary
+	report = run_timings().report(result)
+	if report_dir:
+		os.makedirs(report_dir, exist_ok=True)
+		write_report(report, report_dir)
+	utils.add_gha_step_summary(markdown_summary(report))
+
+
+def checkpoint_settings(checkpoint: bool, every_versions: int, every_seconds: float) -> tuple[int, float] | None:
+	return (every_versions, every_seconds) if checkpoint else None
+
+
+def log_limiters(repos: Inventory):
+	for limiter in (repos.fetch_limiter, repos.push_limiter):
+		log.info(limiter.summary())
+
+
 @cli.command(help="Get all charts and all versions from a Helm repo and push them to an OCI registry")
 @click.option('--repo-id', envvar="HELM_REPO_ID", help='Id of the the repo in repos.yaml, repositories.<id>', required=True)
 @click.option('--base-oci-ref', envvar="BASE_OCI_REF", help='Base OCI reference to push to; do NOT include oci://', required=True)
-def process(repo_id, base_oci_ref):
+@click.option('--push-mode', envvar="PUSH_MODE", type=click.Choice(["native", "helm"]), default="native", help='Push with the in-process OCI client (native) or with `helm push` (helm)')
+@click.option('--force', envvar="FORCE_PROCESS", is_flag=True, default=False, help='Process even if the index is unchanged since the last complete run')
+@click.option('--time-budget', envvar="TIME_BUDGET_SECONDS", type=float, default=None, help='Stop starting new versions after this many seconds; in-flight ones finish and are recorded')
+@click.option('--shard', envvar="SHARD", callback=parse_shard, default=None, help='Only process this slice of the repo, as <index>/<count>; see gha-matrix')
+@click.option('--reconcile/--no-reconcile', envvar="RECONCILE", default=True, help='List registry tags first; skip (and record) versions already there')
+@click.option('--verify-digests', envvar="RECONCILE_VERIFY_DIGESTS", is_flag=True, default=False, help='When reconciling, also compare the registry chart layer digest to the index digest')
+@click.option('--engine', envvar="ENGINE", type=click.Choice(["pipeline", "threads"]), default="pipeline", help='Staged fetch/transform/push pipeline, or one thread per version doing all three')
+@click.option('--report-dir', envvar="REPORT_DIR", default=None, help='Write the run report (run-report.json, run-report.om.txt) to this directory')
+@click.option('--drain-seconds', envvar="DRAIN_SECONDS", type=float, default=7.0, help='On SIGINT/SIGTERM, wait this long for in-flight pushes to finish and be recorded')
+@click.option('--checkpoint/--no-checkpoint', envvar="STATE_CHECKPOINT", default=False, help='Push the processed state to a tooci-state/* git branch while running; see commit-state')
+@click.option('--checkpoint-every', envvar="CHECKPOINT_EVERY", type=int, default=200, help='Checkpoint after this many newly processed versions')
+@click.option('--checkpoint-seconds', envvar="CHECKPOINT_SECONDS", type=float, default=300.0, help='Checkpoint at least this often (seconds) while there are new versions')
+def process(repo_id, base_oci_ref, push_mode, force, time_budget, shard, reconcile, verify_digests, engine, report_dir, drain_seconds, checkpoint, checkpoint_every, checkpoint_seconds):
 	try:
+		install_shutdown_handler(drain_seconds)
 		log.info(f"to-oci running with id: {repo_id}")
 		log.info(f"to-oci running with base_oci_ref: {base_oci_ref}")
+		log.info(f"to-oci running with push_mode: {push_mode}")
 
-		repos = Inventory(base_oci_ref)  # reads repos.yaml
-		log.debug(pretty_repr(repos))
+		repos = Inventory(base_oci_ref, push_mode)  # reads repos.yaml
+		if log.isEnabledFor(logging.DEBUG):
+			log.debug(pretty(repos))
 
 		repo = repos.charts[repo_id]
-		log.info(f"Processing repo '{repo.repo_id}' at '{repo.source}'")
-		log.info(pretty_repr(repo))
-
-		repo.helm_update()
-		repo.helm_get_chart_info()
-
-		# So now's the time to process the chartversions, lets do it one by one first, then make it parallel later
-		chart_versions: list[helm.HelmChartVersion] = repo.versions_to_process()
-		log.info(f"Processing {len(chart_versions)} chart versions")
-		log.debug(pretty_repr(chart_versions))
-
-		# Use a parallel pool to process the chart versions, use double the number of cpu cores, but not more than 16
-		max_workers = 16 if ((multiprocessing.cpu_count() * 2) > 16) else (multiprocessing.cpu_count() * 2)
-		max_workers = int(os.getenv("MAX_WORKERS", max_workers))
-		if max_workers > 1:
-			log.info(f"Using {max_workers} workers for parallel processing.")
-			with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-				def in_process(cv: helm.HelmChartVersion):
-					log.info(f"Processing target '{cv.oci_target_version}'")
-					ret = cv.process()
-					log.info(f"Processed target '{cv.oci_target_version}' OK")
-					return ret
-
-				results = list(executor.map(in_process, chart_versions))
-		else:
-			log.info(f"Using single-threaded processing.")
-			results = []
-			for cv in chart_versions:
-				log.info(f"Processing target '{cv.oci_target_version}'")
-				ret = cv.process()
-				log.info(f"Processed target '{cv.oci_target_version}' OK")
-				results.append(ret)
-
-		new_versions = len([x for x in results if x])
-		log.info(f"Finished processing {len(chart_versions)} chart versions; {new_versions} new versions were processed")
-
-		# Site a GitHub Actions "notice" output to stdout
-		print(f"\n::notice::{repo_id} processed  {new_versions} new chart versions.\n")
+		if shard is not None:
+			log.info(f"to-oci running with shard: {shard[0]}/{shard[1]}")
+			repo.set_shard(*shard)
+		chart_versions = plan_repo(repo, force)
+		if chart_versions is None:
+			return
+
+		pending = pending_versions(repo, chart_versions, reconcile, verify_digests, checkpoint_settings(checkpoint, checkpoint_every, checkpoint_seconds))
+		log.info(f"Processing {len(pending)} pending of {len(chart_versions)} chart versions")
+		if log.isEnabledFor(logging.DEBUG):
+			log.debug(pretty(pending))
+
+		result = run_versions(pending, time_budget, engine)
+		finish_repo(repo, chart_versions, result)
+		log_limiters(repos)
+		report_run(result, report_dir)
+		if result.failed:
+			raise Exception(f"{len(result.failed)} chart versions failed processing")
+
+	except:
+		log.exception("CLI failed")
+		sys.exit(1)
+
+
+@cli.command(help="Process all repos in the inventory, with one global queue on one shared worker pool")
+@click.option('--base-oci-ref', envvar="BASE_OCI_REF", help='Base OCI reference to push to; do NOT include oci://', required=True)
+@click.option('--push-mode', envvar="PUSH_MODE", type=click.Choice(["native", "helm"]), default="native", help='Push with the in-process OCI client (native) or with `helm push` (helm)')
+@click.option('--force', envvar="FORCE_PROCESS", is_flag=True, default=False, help='Process even if the index is unchanged since the last complete run')
+@click.option('--time-budget', envvar="TIME_BUDGET_SECONDS", type=float, default=None, help='Stop starting new versions after this many seconds; in-flight ones finish and are recorded')
+@click.option('--reconcile/--no-reconcile', envvar="RECONCILE", default=True, help='List registry tags first; skip (and record) versions already there')
+@click.option('--verify-digests', envvar="RECONCILE_VERIFY_DIGESTS", is_flag=True, default=False, help='When reconciling, also compare the registry chart layer digest to the index digest')
+@click.option('--engine', envvar="ENGINE", type=click.Choice(["pipeline", "threads"]), default="pipeline", help='Staged fetch/transform/push pipeline, or one thread per version doing all three')
+@click.option('--report-dir', envvar="REPORT_DIR", default=None, help='Write the run report (run-report.json, run-report.om.txt) to this directory')
+@click.option('--drain-seconds', envvar="DRAIN_SECONDS", type=float, default=7.0, help='On SIGINT/SIGTERM, wait this long for in-flight pushes to finish and be recorded')
+@click.option('--checkpoint/--no-checkpoint', envvar="STATE_CHECKPOINT", default=False, help='Push the processed state to a tooci-state/* git branch while running; see commit-state')
+@click.option('--checkpoint-every', envvar="CHECKPOINT_EVERY", type=int, default=200, help='Checkpoint after this many newly processed versions')
+@click.option('--checkpoint-seconds', envvar="CHECKPOINT_SECONDS", type=float, default=300.0, help='Checkpoint at least this often (seconds) while there are new versions')
+def process_all(base_oci_ref, push_mode, force, time_budget, reconcile, verify_digests, engine, report_dir, drain_seconds, checkpoint, checkpoint_every, checkpoint_seconds):
+	try:
+		install_shutdown_handler(drain_seconds)
+		log.info(f"to-oci running for all repos with base_oci_ref: {base_oci_ref}")
+		repos = Inventory(base_oci_ref, push_mode)  # reads repos.yaml
+
+		planned: dict[str, list[helm.HelmChartVersion]] = {}
+		planning_failures: list[str] = []
+		pending_by_repo: dict[str, list[helm.HelmChartVersion]] = {}
+		repos.refresh_indexes(list(repos.charts.values()))
+		for repo in repos.charts.values():
+			try:
+				chart_versions = plan_repo(repo, force)
+				if chart_versions is None:
+					continue
+				pending = pending_versions(repo, chart_versions, reconcile, verify_digests, checkpoint_settings(checkpoint, checkpoint_every, checkpoint_seconds))
+			except:
+				log.exception(f"Failed planning repo '{repo.repo_id}'; skipping it")
+				print(f"\n::error::{repo.repo_id} failed planning.\n")
+				planning_failures.append(repo.repo_id)
+				continue
+			planned[repo.repo_id] = chart_versions
+			pending_by_repo[repo.repo_id] = pending
+			log.info(f"Repo '{repo.repo_id}': {len(pending_by_repo[repo.repo_id])} pending of {len(chart_versions)} chart versions")
 
+		result = run_versions(Scheduler.fair_order(pending_by_repo), time_budget, engine)
+		for repo_id, chart_versions in planned.items():
+			finish_repo(repos.charts[repo_id], chart_versions, result)
+		log_limiters(repos)
+		report_run(result, report_dir)
+		if result.failed or planning_failures:
+			raise Exception(f"{len(result.failed)} chart versions failed processing; repos failed planning: {planning_failures}")
 
 	except:
 		log.exception("CLI failed")
 		sys.exit(1)
 
 
+@cli.command(help="One-time migration of info/<repo-id>/<chart>--<version>.json files into info/<repo-id>.jsonl")
+@click.option('--repo-id', help='Only migrate this repo id; default is all repos in repos.yaml')
+@click.option('--keep-legacy', is_flag=True, default=False, help='Keep the legacy per-version files after migrating')
+def migrate_info(repo_id, keep_legacy):
+	try:
+		repos = Inventory(None)
+		repo_ids = [repo_id] if repo_id else list(repos.charts.keys())
+		for one_repo_id in repo_ids:
+			state = ProcessedState(repos.base_path, one_repo_id)
+			migrated = state.migrate_legacy(delete_legacy=not keep_legacy)
+			log.info(f"Repo '{one_repo_id}': migrated {migrated} versions, {len(state)} total in '{state.state_file}'")
+	except:
+		log.exception("CLI failed")
+		sys.exit(1)
+
+
+@cli.command("commit-state", help="Merge the tooci-state/* checkpoint branches (and shard segments) into info/, commit and push once, then delete the merged branches")
+@click.option('--push/--no-push', envvar="COMMIT_STATE_PUSH", default=True, help='Push the commit and delete the merged branches; --no-push only merges and commits locally')
+def commit_state_cmd(push):
+	try:
+		repos = Inventory(None)
+		merged = commit_state(repos.base_path, list(repos.charts.keys()), push)
+		print(f"\n::notice::Merged {merged} processed versions from state checkpoints.\n")
+	except:
+		log.exception("CLI failed")
+		sys.exit(1)
+
+
 if __name__ == '__main__':
 	cli()
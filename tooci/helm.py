@@ -1,44 +1,100 @@
+import collections.abc
+import concurrent.futures
 import glob
+import hashlib
 import json
 import logging
 import os
 import string
-import tempfile
-import time
+import sys
+import threading
+import zlib
 from urllib.parse import ParseResult
+from urllib.parse import urljoin
 from urllib.parse import urlparse
 
-import yaml
-from rich.pretty import pretty_repr
-
+from blobcache import blob_cache
+from checkpoint import StateCheckpointer
+from index import IndexCache
+from index import fetch_index
+from oci import oci_client
+from oci import split_oci_ref
+from oci import version_to_tag
+from processors import MemberProcessor
+from processors import get_processors
+from processors import rewrite_chart_tgz
+from journal import FETCHED
+from journal import PUSHED
+from journal import RECORDED
+from journal import TRANSFORMED
+from journal import WorkJournal
+from limiter import AdaptiveLimiter
+from scheduler import HostLimits
+from scheduler import ShutdownRequested
+from scheduler import graceful_shutdown
+from scheduler import default_max_workers
+from semver import is_prerelease
+from semver import satisfies
+from semver import version_key
+from state import ProcessedState
+from timings import run_timings
+from utils import DigestMismatchError
+from utils import atomic_write
+from utils import cache_dir
+from utils import http_download
+from utils import load_yaml
+from utils import pretty
 from utils import shell
 from utils import shell_passthrough
 
 log = logging.getLogger("utils")
 
 
+def key_in_shard(state_key: str, index: int, count: int) -> bool:
+	# stable hash of the version's key; the same version always lands in the same shard, whatever else is pending
+	return zlib.crc32(state_key.encode("utf-8")) % count == index
+
+
 class HelmChartVersion:
+	# Big repos have tens of thousands of these, so: slots instead of a __dict__, strings shared with the (interned, see
+	# index.slim_entries) index entries, and everything derivable (repo, targets, state key) derived when asked for.
+	__slots__ = ("chart", "version", "app_version", "description", "urls", "digest", "filename")
 	chart: "HelmChartInfo"
-	repo: "ChartRepo"
-	inv: "Inventory"
 	version: str
 	app_version: str
 	description: str
-	filename: str
+	urls: list[str]
+	digest: str | None  # sha256 of the chart tarball, as published in index.yaml (not all repos have it)
+	filename: str | None
 
 	def __init__(self, chart: "HelmChartInfo", chart_json: any):
 		self.chart = chart
-		self.repo = chart.repo
-		self.inv = chart.repo.inventory
-		self.version = chart_json["version"]
-		self.app_version = chart_json["app_version"]
-		self.description = chart_json["description"]
+		self.version = str(chart_json["version"])
+		self.app_version = str(chart_json.get("appVersion", ""))
+		self.description = chart_json.get("description", "")
+		self.urls = chart_json.get("urls", [])
+		self.digest = chart_json.get("digest")
+		self.filename = None
+
+	@property
+	def repo(self) -> "ChartRepo":
+		return self.chart.repo
+
+	@property
+	def inv(self) -> "Inventory":
+		return self.chart.inventory
 
-		self.oci_target = f"{self.inv.base_oci_ref}/{self.repo.repo_id}"
-		self.oci_target_version = f"{self.oci_target}/{self.chart.name_in_repo}:{self.version}"
+	@property
+	def oci_target(self) -> str:
+		return self.chart.repo.oci_target
 
-		self.info_dir = f"{self.inv.base_path}/info/{self.repo.repo_id}"
-		self.info_file = f"{self.info_dir}/{self.chart.name_in_repo}--{self.version}.json"
+	@property
+	def oci_target_version(self) -> str:
+		return f"{self.chart.repo.oci_target}/{self.chart.name_in_repo}:{self.version}"
+
+	@property
+	def state_key(self) -> str:
+		return f"{self.chart.name_in_repo}--{self.version}"
 
 	def __rich_repr__(self):
 		yield "chart.name_target", self.chart.name_target
@@ -46,73 +102,149 @@ class HelmChartVersion:
 		yield "version", self.version
 		yield "app_version", self.app_version
 		yield "description", self.description
-		yield "info_file", self.info_file
+		yield "urls", self.urls
+		yield "digest", self.digest
+		yield "state_key", self.state_key
 		yield "oci_target", self.oci_target
 		yield "oci_target_version", self.oci_target_version
 
+	def already_processed(self) -> bool:
+		# If already in the repo's processed state, skip the processing
+		if self.state_key in self.repo.state:
+			log.info(f"Skipping processing of '{self.state_key}', info found/cache hit.")
+			return True
+		return False
+
 	def process(self):
-		# If the info file exists, skip the processing
-		if os.path.exists(self.info_file):
-			log.info(f"Skipping processing of '{self.info_file}', info found/cache hit.")
+		# fetch -> processors -> push, serially in the calling thread; see pipeline.py for the staged alternative.
+		# Every stage is journaled (see journal.py); an interrupted run resumes after the last completed stage.
+		if self.already_processed():
 			return False  # skipped
 
-		log.info(pretty_repr(self))
-
-		with tempfile.TemporaryDirectory() as tmp_dir_name:
-			log.info(f'created temporary directory: "{tmp_dir_name}"')
-			shell(["timeout", "60", "helm", "fetch", f"{self.chart.name_in_helm}", "--version", self.version, "--destination", tmp_dir_name])
-
-			tgz_files = glob.glob(f"{tmp_dir_name}/*.tgz")
-			if len(tgz_files) != 1:
-				raise Exception(f"Expected 1 tgz file, found {len(tgz_files)}: {tgz_files}")
-			self.filename = tgz_files[0]
-
-			# process callbacks, if any; those should modify the tgz file in place, using tmp_dir_name as a working directory
-			if self.repo.processors:
-				for processor_str in self.repo.processors:
-					# each processor should be a method of this class
-					if not hasattr(self, processor_str):
-						raise Exception(f"Processor '{processor_str}' not found in HelmChartVersion class")
-					processor = getattr(self, processor_str)
-					if not callable(processor):
-						raise Exception(f"Processor '{processor_str}' is not callable in HelmChartVersion class")
-					log.info(f"Running processor '{processor_str}' for chart '{self.chart.name_in_helm}' version '{self.version}'")
-					processor(self.filename, tmp_dir_name)
-
-			# push the tgz file to the OCI registry
-			log.info(f"Pushing '{self.filename}' to '{self.oci_target}'")
-			# retry pushes up to 3 times; sleep 10 seconds between retries
-			for attempt in range(1, 4):
+		log.info(pretty(self))
+		journal = self.repo.journal
+		stage, self.filename = self.resume()
+		if stage is None:
+			self.check_shutdown()
+			self.filename = self.fetch_stage(journal.work_dir(self.state_key))
+			journal.log(self.state_key, FETCHED, self.filename)
+			stage = FETCHED
+
+		# processors, if any, rewrite matching members of the tgz in a streaming fashion, see processors.py
+		if self.repo.processors and stage == FETCHED:
+			self.run_processors(self.filename)
+			journal.log(self.state_key, TRANSFORMED, self.filename)
+			stage = TRANSFORMED
+
+		if stage in (FETCHED, TRANSFORMED):
+			self.check_shutdown()
+			self.push_stage(self.filename)
+			journal.log(self.state_key, PUSHED)
+
+		self.record_stage()
+		return True  # processed
+
+	def resume(self) -> tuple[str | None, str | None]:
+		stage, artifact = self.repo.journal.resume_point(self.state_key)
+		if stage is not None:
+			log.info(f"Resuming '{self.state_key}' from the work journal: already {stage}")
+		return stage, artifact
+
+	def check_shutdown(self):
+		if graceful_shutdown().requested():
+			raise ShutdownRequested(f"Shutdown requested; not starting the next stage of '{self.state_key}'")
+
+	def record_stage(self):
+		# a thread abandoned at the drain deadline can get here after finish_repo closed the journal: the record would never
+		# be compacted nor checkpointed, so it's dropped; the version is in the registry, and the next run's reconcile backfills it
+		if self.repo.journal.closed:
+			log.warning(f"Not recording '{self.state_key}': repo '{self.repo.repo_id}' already finished")
+			return
+		self.record()
+		self.repo.journal.log(self.state_key, RECORDED)
+		self.repo.journal.discard(self.state_key)
+
+	def fetch_stage(self, tmp_dir_name: str) -> str:
+		with run_timings().stage(self, "fetch"):
+			return self.inv.fetch_limiter.call(f"fetch of '{self.state_key}'", self.fetch, tmp_dir_name)
+
+	def push_stage(self, chart_tgz_fullpath: str):
+		# push the tgz file to the OCI registry
+		log.info(f"Pushing '{chart_tgz_fullpath}' to '{self.oci_target}' (push mode: {self.inv.push_mode})")
+		# retries (jittered exponential backoff, Retry-After, global pause on 429) are handled by the shared limiter
+		with run_timings().stage(self, "push"):
+			self.inv.push_limiter.call(f"push of '{self.oci_target_version}'", self.push, chart_tgz_fullpath)
+		run_timings().count(self, "bytes_pushed", os.path.getsize(chart_tgz_fullpath))
+
+	def record(self, reconciled: bool = False):
+		# Append the record to the repo's processed state (info/<repo-id>.jsonl)
+		record = {
+			"chart.name_target": self.chart.name_target,
+			"chat.repo.source": self.chart.repo.source,
+			"version": self.version,
+			"app_version": self.app_version,
+			"description": self.description,
+			"oci_target": self.oci_target,
+			"oci_target_version": self.oci_target_version
+		}
+		if reconciled:
+			record["reconciled"] = True  # found already in the registry, not pushed by us
+		self.repo.state.add(record)
+		log.info(f"Recorded '{self.state_key}' in '{self.repo.state.state_file}'")
+
+	def registry_copy_matches(self) -> bool:
+		# the registry has our tag; does its chart layer have the same digest as the upstream tarball?
+		# processors rewrite the tarball, and not all indexes carry digests: presence of the tag is all we can check then
+		if self.repo.processors or not self.digest:
+			return True
+		registry, repository = split_oci_ref(f"{self.oci_target}/{self.chart.name_in_repo}")
+		manifest = self.inv.push_limiter.call(f"manifest of '{self.oci_target_version}'", oci_client().get_manifest, registry, repository, version_to_tag(self.version))
+		layers = (manifest or {}).get("layers", [])
+		return bool(layers) and layers[0]["digest"] == f"sha256:{self.digest.removeprefix('sha256:')}"
+
+	def in_shard(self, index: int, count: int) -> bool:
+		return key_in_shard(self.state_key, index, count)
+
+	def chart_url(self) -> str:
+		if not self.urls:
+			raise ValueError(f"No download URLs in index for chart '{self.chart.name_in_repo}' version '{self.version}'")
+		# index.yaml urls can be absolute or relative to the repo URL
+		return urljoin(f"{self.repo.source.rstrip('/')}/", self.urls[0])
+
+	def fetch(self, tmp_dir_name: str) -> str:
+		chart_tgz_fullpath = f"{tmp_dir_name}/{self.chart.name_in_repo}-{self.version}.tgz"
+		url = self.chart_url()
+		with self.inv.upstream_limits.slot(urlparse(url).netloc):
+			if self.digest:
 				try:
-					shell(["timeout", "60", "helm", "push", self.filename, f"oci://{self.oci_target}"])
-					break
-				except Exception as e:
-					log.warning(f"Attempt {attempt} to push '{self.filename}' to '{self.oci_target}' failed: {e}")
-					if attempt < 3:
-						log.info(f"Retrying in 10 seconds...")
-						time.sleep(10)
-					else:
-						log.error(f"Failed to push '{self.filename}' to '{self.oci_target}' after 3 attempts")
-						raise e
-
-		# Make sure self.info_dir exists, mkdir recursively
-		os.makedirs(self.info_dir, exist_ok=True)
-
-		# Write JSON to self.info_file
-		with open(self.info_file, "w") as f:
-			json.dump({
-				"chart.name_target": self.chart.name_target,
-				"chat.repo.source": self.chart.repo.source,
-				"version": self.version,
-				"app_version": self.app_version,
-				"description": self.description,
-				"oci_target": self.oci_target,
-				"oci_target_version": self.oci_target_version
-			}, f, indent=2)
-
-		log.info(f"Wrote '{self.info_file}'")
+					if blob_cache().fetch(url, self.digest, chart_tgz_fullpath):  # downloaded once per digest, across repos & runs
+						run_timings().count(self, "blob_cache_hits")
+				except DigestMismatchError as e:
+					# a stale index digest: `helm fetch` never checked, and these charts were always pushed; keep pushing them,
+					# as long as a second download gets the same bytes (else it raises again: a flapping upstream, not pushed)
+					log.warning(f"{e}; pushing '{self.oci_target_version}' as downloaded, uncached")
+					run_timings().count(self, "digest_mismatches")
+					http_download(url, chart_tgz_fullpath, e.actual_sha256)
+			else:
+				http_download(url, chart_tgz_fullpath)
+		return chart_tgz_fullpath
+
+	def run_processors(self, chart_tgz_fullpath: str):
+		names = ", ".join(p.name for p in self.repo.processors)
+		log.info(f"Running processors '{names}' for chart '{self.chart.name_in_helm}' version '{self.version}'")
+		with run_timings().stage(self, "transform"):
+			changed = rewrite_chart_tgz(chart_tgz_fullpath, chart_tgz_fullpath, self.repo.processors)
+		if changed:
+			log.info(f"Processors rewrote '{chart_tgz_fullpath}'")
+		else:
+			log.info(f"Processors made no changes to '{chart_tgz_fullpath}'; keeping it as-is")
 
-		return True  # processed
+	def push(self, chart_tgz_fullpath: str):
+		with self.inv.registry_limits.slot(self.oci_target.split("/")[0]):
+			if self.inv.push_mode == "helm":
+				shell(["timeout", "60", "helm", "push", chart_tgz_fullpath, f"oci://{self.oci_target}"])
+			else:
+				oci_client().push_chart(chart_tgz_fullpath, self.oci_target)
 
 	# self.fetch_chart_contents(tmp_dir_name)
 	# chart_temp_dir_name = f"{tmp_dir_name}/{self.chart.name_in_repo}"
@@ -132,7 +264,7 @@ class HelmChartVersion:
 			log.info(f"Found Chart.yaml: '{chart_yaml_file}'")
 			# shell_passthrough(["bat", chart_yaml_file])
 			with open(chart_yaml_file) as f:
-				chart_yaml = yaml.load(f, Loader=yaml.FullLoader)
+				chart_yaml = load_yaml(f)
 				# log.debug(f"Chart.yaml: {chart_yaml}")
 				self.process_chart_descriptor(chart_yaml_file, chart_yaml)
 
@@ -142,66 +274,6 @@ class HelmChartVersion:
 		log.info(f"Processing Chart.yaml: {chart_yaml}")
 		pass
 
-	def bitnami_legacy_process(self, chart_tgz_fullpath: str, tmp_dir_name: str):
-		log.info(f"Running bitnami_legacy_process on '{chart_tgz_fullpath}' vs tmp dir '{tmp_dir_name}' for chart '{self.chart.name_in_helm}' version '{self.version}'")
-		extracted_dir = self.extract_tgz(chart_tgz_fullpath, tmp_dir_name)
-
-		# Main bit of hackery; use gnu sed, as some old charts have not-really-YAML values.yaml files
-		values_yaml_files = glob.glob(f"{extracted_dir}/**/values.yaml", recursive=True)
-		if len(values_yaml_files) == 0:
-			raise Exception(f"No values.yaml files found in '{extracted_dir}'")
-		for values_yaml_file in values_yaml_files:
-			log.info(f"Processing values.yaml: '{values_yaml_file}'")
-			shell(["sed", "--in-place=.bkp.pre.bitnami.hack", "-e", "s|repository: bitnami/|repository: bitnamilegacy/|g", values_yaml_file])
-			shell(["sed", "--in-place", "-e", "s|allowInsecureImages: false|allowInsecureImages: true|g", values_yaml_file])
-			# diff the file vs the bkp; show colorized diff, ignore exit code
-			shell_passthrough(["diff", "-U", "1", "--color=always", f"{values_yaml_file}.bkp.pre.bitnami.hack", values_yaml_file], ignore_exit_code=True)
-			# remove the bkp file
-			os.remove(f"{values_yaml_file}.bkp.pre.bitnami.hack")
-
-		self.repack_tgz(extracted_dir, chart_tgz_fullpath)
-
-	def extract_tgz(self, chart_tgz_fullpath, tmp_dir_name):
-		# extract the tgz file to a directory named after the tgz file (without .tgz) in tmp_dir_name
-		if not chart_tgz_fullpath.endswith(".tgz"):
-			raise Exception(f"Expected .tgz file, got '{chart_tgz_fullpath}'")
-
-		# use tar to list each file (complete with path) in the tgz file
-		# shell_passthrough(["tar", "tzf", chart_tgz_fullpath])
-
-		base_name = os.path.basename(chart_tgz_fullpath)
-		dir_name = base_name[:-4]
-		extracted_dir = f"{tmp_dir_name}/{dir_name}"
-		os.makedirs(extracted_dir, exist_ok=False)
-		shell(["tar", "xzf", chart_tgz_fullpath, "-C", extracted_dir, "--strip-components=0"])
-		log.info(f"Extracted '{chart_tgz_fullpath}' to '{extracted_dir}'")
-
-		# shell_passthrough(["tree", extracted_dir])
-
-		# remove the tgz file
-		os.remove(chart_tgz_fullpath)
-		return extracted_dir
-
-	def repack_tgz(self, dir_to_pack: str, output_tgz_fullpath: str):
-		# create a tgz file from the contents of dir_to_pack, output to output_tgz_fullpath
-		if not output_tgz_fullpath.endswith(".tgz"):
-			raise Exception(f"Expected .tgz file, got '{output_tgz_fullpath}'")
-
-		# find the single directory name in dir_to_pack
-		entries = os.listdir(dir_to_pack)
-		if len(entries) != 1:
-			raise Exception(f"Expected single directory in '{dir_to_pack}', found {len(entries)}: {entries}")
-		target_dir = entries[0]
-		log.info(f"Repacking '{output_tgz_fullpath}' from '{target_dir}' in '{dir_to_pack}'")
-
-		# use tar to create the tgz file
-		shell(["tar", "czf", output_tgz_fullpath, "-C", dir_to_pack, target_dir])
-
-		log.info(f"Repacked '{dir_to_pack}' to '{output_tgz_fullpath}'")
-
-		# use tar to list each file (complete with path) in the tgz file
-		# shell_passthrough(["tar", "tzf", output_tgz_fullpath])
-
 
 class HelmChartInfo:
 	repo: "ChartRepo"
@@ -209,21 +281,27 @@ class HelmChartInfo:
 	name_in_helm: str  # includes tooci repo name
 	name_in_repo: str
 	name_target: str
-	versions: list[HelmChartVersion]
-	latest_version: HelmChartVersion
+	versions: list[HelmChartVersion]  # oldest first, by semver precedence
+	latest_version: HelmChartVersion  # newest non-prerelease version, if any; what `helm install` would pick
 
-	def __init__(self, repo: "ChartRepo", chart_json: any, all_versions: list[any]):
+	def __init__(self, repo: "ChartRepo", chart_name: str, all_versions: list[any]):
 		self.versions = []
 		self.repo = repo
 		self.inventory = repo.inventory
-		self.name_in_helm = chart_json["name"]
-		self.name_in_repo = self.name_in_helm.split("/")[1]
+		self.name_in_repo = sys.intern(chart_name)
+		self.name_in_helm = f"{self.repo.helm_repo_id}/{chart_name}"
 		self.name_target = f"{self.repo.repo_id}/{self.name_in_repo}"
 		for version_json in all_versions:
 			version = HelmChartVersion(self, version_json)
 			self.versions.append(version)
-		self.versions = list(reversed(self.versions))  # reverse the versions list, so newer come later, this is unproven; SemVer?
-		self.latest_version = self.versions[-1]  # latest version is the last in the list
+		# index.yaml order is whatever the repo's tooling wrote (usually, but not always, newest first); sort by semver
+		self.versions.sort(key=lambda v: version_key(v.version))
+		self.latest_version = self.latest(1)[0]
+
+	def latest(self, count: int) -> list[HelmChartVersion]:
+		# the newest `count` releases; prereleases only count if the chart has no release at all
+		releases = [v for v in self.versions if not is_prerelease(v.version)]
+		return (releases or self.versions)[-count:]
 
 	def __rich_repr__(self):
 		yield "name_in_helm", self.name_in_helm
@@ -239,25 +317,42 @@ class ChartRepo:
 	source_url: ParseResult
 	charts: dict[str, HelmChartInfo]
 	chart_all_versions: list[HelmChartVersion]
-	chart_latest_versions: list[HelmChartVersion]
-	latest_only: bool
+	latest_count: int | None  # 'latest-n: N' (or 'latest-only: true', N=1): only the newest N releases of each chart
+	version_ranges: dict[str, str]  # 'version-range': chart name -> semver range; "*" for all charts
 	only_charts: list[str] | None
 	skip_chart_versions: dict[str, list[str]]
-	processors: list[str] | None
+	processors: list[MemberProcessor]
+	index_entries: dict[str, list[dict]] | None  # chart name -> version entries, as found in index.yaml
+	index_cache: IndexCache | None
+	state: ProcessedState | None
+	journal: WorkJournal | None  # write-ahead journal of this run's work, see journal.py
+	checkpointer: StateCheckpointer | None  # pushes the processed state to git while the run goes, see checkpoint.py
+	index_not_modified: bool
+	repo_yaml: dict
+	shard: tuple[int, int] | None  # (index, count): only process versions hashing into this shard
 
 	def __init__(self, inventory: "Inventory", repo_id: str, repo_yaml: any):
 		self.inventory = inventory
 		self.repo_id = repo_id
 		self.helm_repo_id = f"tooci-{self.repo_id}"  # prefix it for clarity
+		self.repo_yaml = repo_yaml
 		self.source = repo_yaml["source"]
 		self.source_url = urlparse(self.source)
 		self.charts = {}
+		self.index_entries = {}
+		self.index_cache = None
+		self.index_not_modified = False
+		self.state = None
+		self.journal = None
+		self.checkpointer = None
+		self.shard = None
 		self.chart_all_versions = []
-		self.chart_latest_versions = []
 		self.skip_chart_versions = {}
 		self.processors = []
 
-		self.latest_only = bool(repo_yaml.get("latest-only", False))
+		self.latest_count = int(repo_yaml["latest-n"]) if "latest-n" in repo_yaml else (1 if repo_yaml.get("latest-only", False) else None)
+		version_range = repo_yaml.get("version-range", {})
+		self.version_ranges = {"*": version_range} if isinstance(version_range, str) else dict(version_range)
 		self.only_charts = None
 		if "only-charts" in repo_yaml:
 			self.only_charts = [f"{self.helm_repo_id}/{chart}" for chart in repo_yaml["only-charts"]]
@@ -267,8 +362,8 @@ class ChartRepo:
 			log.debug(f"Found skip-chart-versions for repo '{self.repo_id}': '{self.skip_chart_versions}'")
 
 		if "processors" in repo_yaml:
-			self.processors = repo_yaml["processors"]
-			log.debug(f"Found processors for repo '{self.repo_id}': '{self.processors}'")
+			self.processors = get_processors(repo_yaml["processors"])
+			log.debug(f"Found processors for repo '{self.repo_id}': '{repo_yaml['processors']}'")
 
 		if not self.source_url.scheme:
 			raise Exception(f"Invalid URL: {self.source} for repo id {self.repo_id}")
@@ -276,99 +371,316 @@ class ChartRepo:
 	def __rich_repr__(self):
 		yield "id", self.repo_id
 		yield "source", self.source
-		yield "latest_only", self.latest_only
+		yield "latest_count", self.latest_count
+		yield "version_ranges", self.version_ranges
 		yield "only_charts", self.only_charts
 		yield "skip_chart_versions", self.skip_chart_versions
-		yield "processors", self.processors
+		yield "processors", [p.name for p in self.processors]
 		yield "inventory", self.inventory
 
-	def helm_update(self):
-		shell(["helm", "repo", "add", self.helm_repo_id, f"{self.source}"])
-		if os.environ.get("UPDATE_HELM", "no") == "yes":
-			log.info(f"Updating Helm repo: {self.repo_id} / {self.source}")
-			shell(["helm", "repo", "update", self.helm_repo_id])
-		else:
-			log.warning(f"Skipping Helm repo update: {self.repo_id} / {self.source}")
-
-	def helm_get_chart_info(self):  # HelmChartInfo
+	@property
+	def oci_target(self) -> str:
+		return f"{self.inventory.base_oci_ref}/{self.repo_id}"
+
+	def update_index(self):
+		# fetch and parse <source>/index.yaml directly; no `helm repo add/update` round-trip through helm's cache
+		# conditional GET against the on-disk index cache; on 304 the (slim) entries are loaded lazily from the cache
+		# once per source per run: repos sharing a source share the fetch and the parsed index (see Inventory.fetch_index)
+		if self.index_cache is not None:
+			return  # already done, eg: by Inventory.refresh_indexes()
+		with run_timings().span(f"index {self.repo_id}"):
+			self.index_entries, self.index_not_modified = self.inventory.fetch_index(self.source)
+		self.index_cache = self.inventory.index_cache(self.source)
+
+	def config_fingerprint(self) -> str:
+		# anything that changes what/how we'd push: repos.yaml global hash, this repo's config, and the target
+		config = {"hash": self.inventory.hash, "repo": self.repo_yaml, "base_oci_ref": self.inventory.base_oci_ref}
+		return hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+	def plan_fingerprint(self, versions: list["HelmChartVersion"]) -> str:
+		keys = sorted(f"{v.chart.name_in_repo}--{v.version}" for v in versions)
+		return hashlib.sha256("\n".join([self.config_fingerprint()] + keys).encode("utf-8")).hexdigest()
+
+	def state_fingerprint(self) -> str:
+		# of the processed state this repo (or shard) is responsible for; see ProcessedState.fingerprint
+		self.load_state()
+		if self.shard is None or self.shard[1] == 1:
+			return self.state.fingerprint()
+		return self.state.fingerprint(lambda key: key_in_shard(key, *self.shard))
+
+	def index_unchanged_since_processed(self) -> bool:
+		# 304 Not Modified, and the last complete run was against this very index with the same config, and its records
+		# are all in info/: nothing to do
+		if not self.index_not_modified:
+			return False
+		return self.index_cache.unchanged_and_processed(self.processed_key(), self.config_fingerprint(), self.state_fingerprint())
+
+	def plan_unchanged_since_processed(self, versions: list["HelmChartVersion"]) -> bool:
+		# index was re-downloaded (eg: new ETag) but the set of versions we'd process is identical to the last complete run
+		return self.index_cache.processed_plan(self.processed_key(), self.config_fingerprint(), self.state_fingerprint()) == self.plan_fingerprint(versions)
+
+	def mark_processed(self, versions: list["HelmChartVersion"]):
+		self.index_cache.mark_processed(self.processed_key(), self.config_fingerprint(), self.plan_fingerprint(versions), self.state_fingerprint())
+
+	def load_state(self):
+		if self.state is None:
+			self.state = ProcessedState(self.inventory.base_path, self.repo_id, self.state_segment())
+
+	def get_chart_info(self):  # HelmChartInfo
 		log.info(f"Getting chart info for repo '{self.repo_id}'")
-		search_term = f"{self.helm_repo_id}/"  # Search for the repo id + slash
-		all_charts_versions_str = shell(["helm", "search", "repo", search_term, "--versions", "--devel", "-o", "json"])
-		all_charts_versions = json.loads(all_charts_versions_str)
-		log.info(f"Parsing {len(all_charts_versions)} charts+versions from {self.source}")
+		if self.index_entries is None:
+			self.index_entries = self.index_cache.load_entries()  # shared with other repos of this source; read-only
+		self.load_state()
+		log.info(f"Parsing {sum(len(v) for v in self.index_entries.values())} charts+versions from {self.source}")
 
-		# loop through all the charts and versions; group by chart name, then create HelmChartInfo objects with the versions
+		# loop through all the charts and versions; filter, then create HelmChartInfo objects with the versions
 		charts_and_versions: dict[str, list] = {}
-		for chart_json in all_charts_versions:
-			chart_name_full = chart_json["name"]
-			chart_name_base = chart_name_full.split("/")[1]
+		for chart_name_base, chart_versions in self.index_entries.items():
+			chart_name_full = f"{self.helm_repo_id}/{chart_name_base}"
 			log.debug(f"Checking chart '{chart_name_full}' in repo '{self.repo_id}' (base name: '{chart_name_base}')")
 
-			if not chart_name_full.startswith(search_term):
-				log.debug(f"Skipping chart '{chart_name_full}' not in repo '{self.repo_id}'")
-				continue
-
 			if self.only_charts and chart_name_full not in self.only_charts:
 				log.debug(f"Skipping chart '{chart_name_full}' not in only-charts for repo '{self.repo_id}'")
 				continue
 
-			if self.skip_chart_versions:
-				log.info(f"Checking skip-chart-versions for chart '{chart_name_full}' (base name: '{chart_name_base}')")
-				if chart_name_base in self.skip_chart_versions:
-					versions_to_skip = self.skip_chart_versions[chart_name_base]
-					if (chart_json["version"] in versions_to_skip) or ('all' in versions_to_skip):
-						log.warning(f"Skipping chart '{chart_name_full}' version '{chart_json['version']}' as per skip-chart-versions for repo '{self.repo_id}'")
-						continue
-					else:
-						log.info(f"Version '{chart_json['version']}' not in skip-chart-versions for chart '{chart_name_full}'")
-
-			if chart_name_full not in charts_and_versions:
-				charts_and_versions[chart_name_full] = []
-			charts_and_versions[chart_name_full].append(chart_json)
+			for chart_json in chart_versions:
+				if self.skip_chart_versions:
+					log.info(f"Checking skip-chart-versions for chart '{chart_name_full}' (base name: '{chart_name_base}')")
+					if chart_name_base in self.skip_chart_versions:
+						versions_to_skip = self.skip_chart_versions[chart_name_base]
+						if (chart_json["version"] in versions_to_skip) or ('all' in versions_to_skip):
+							log.warning(f"Skipping chart '{chart_name_full}' version '{chart_json['version']}' as per skip-chart-versions for repo '{self.repo_id}'")
+							continue
+						else:
+							log.info(f"Version '{chart_json['version']}' not in skip-chart-versions for chart '{chart_name_full}'")
+
+				version_range = self.version_ranges.get(chart_name_base, self.version_ranges.get("*"))
+				if version_range and not satisfies(str(chart_json["version"]), version_range):
+					log.debug(f"Skipping chart '{chart_name_full}' version '{chart_json['version']}' outside version-range '{version_range}'")
+					continue
+
+				if chart_name_base not in charts_and_versions:
+					charts_and_versions[chart_name_base] = []
+				charts_and_versions[chart_name_base].append(chart_json)
 
 		# loop over the grouped charts and versions, and create HelmChartInfo objects
 		for chart_name in charts_and_versions:
 			chart_versions = charts_and_versions[chart_name]
-			one_version = chart_versions[0]
 			log.info(f"Chart: '{chart_name}' with {len(chart_versions)} versions")
-			chart_info = HelmChartInfo(self, one_version, chart_versions)
-			self.charts[chart_name] = chart_info
+			chart_info = HelmChartInfo(self, chart_name, chart_versions)
+			self.charts[chart_info.name_in_helm] = chart_info
 
-		# aggregate all versions and latest versions for easy iteration
+		# aggregate all versions for easy iteration
 		for chart_name in self.charts:
-			chart_info = self.charts[chart_name]
-			self.chart_latest_versions.append(chart_info.latest_version)
-			self.chart_all_versions.extend(chart_info.versions)
+			self.chart_all_versions.extend(self.charts[chart_name].versions)
+
+	def pending_versions(self, versions: list[HelmChartVersion]) -> list[HelmChartVersion]:
+		# versions not processed yet, newest first; a state lookup per version, so backports published after a newer
+		# release (eg: 1.15.1 after 1.16.1) are picked up like any other new version
+		return self.newest_first([v for v in versions if v.state_key not in self.state])
+
+	@staticmethod
+	def newest_first(versions: list[HelmChartVersion]) -> list[HelmChartVersion]:
+		# the newest pending version of every chart, then the second newest of every chart, etc: fresh releases land in
+		# the registry before the backfill of old ones, and one chart's long history doesn't hold up the others
+		by_chart: dict[str, list[HelmChartVersion]] = {}
+		for version in versions:
+			by_chart.setdefault(version.chart.name_in_helm, []).append(version)
+		queues = [sorted(chart_versions, key=lambda v: version_key(v.version), reverse=True) for chart_versions in by_chart.values()]
+		return [q[i] for i in range(max((len(q) for q in queues), default=0)) for q in queues if i < len(q)]
+
+	def set_shard(self, index: int, count: int):
+		if count < 1 or not (0 <= index < count):
+			raise Exception(f"Invalid shard {index}/{count} for repo '{self.repo_id}'")
+		self.shard = (index, count)
+
+	def processed_key(self) -> str:
+		# key for the index cache's "processed" markers; a shard completing says nothing about the other shards
+		if self.shard is None or self.shard[1] == 1:
+			return self.repo_id
+		return f"{self.repo_id}@{self.shard[0]}/{self.shard[1]}"
+
+	def open_journal(self):
+		# one journal per repo, or per shard of a repo, like the processed state segments
+		segment = self.state_segment()
+		self.journal = WorkJournal(cache_dir("journal"), self.repo_id if segment is None else f"{self.repo_id}.{segment}")
+
+	def open_checkpointer(self, every_versions: int, every_seconds: float):
+		self.checkpointer = StateCheckpointer(self.inventory.base_path, self.state, every_versions, every_seconds)
+
+	def state_segment(self) -> str | None:
+		if self.shard is None or self.shard[1] == 1:
+			return None
+		return f"shard-{self.shard[0]}-of-{self.shard[1]}"
+
+	def reconcile_with_registry(self, pending: list[HelmChartVersion], verify_digests: bool) -> list[HelmChartVersion]:
+		# One tags/list (paginated) per chart with pending versions. Versions whose tag is already in the registry
+		# (and, with verify_digests, whose chart layer matches the index digest) are backfilled into the state and
+		# dropped before anything is downloaded.
+		by_chart: dict[str, list[HelmChartVersion]] = {}
+		for version in pending:
+			by_chart.setdefault(version.chart.name_in_repo, []).append(version)
+		if not by_chart:
+			return pending
+
+		client = oci_client()
+		registry, base_repository = split_oci_ref(f"{self.inventory.base_oci_ref}/{self.repo_id}")
+
+		def chart_tags(chart_name: str) -> set[str]:
+			return set(self.inventory.push_limiter.call(f"tags/list of '{chart_name}'", client.list_tags, registry, f"{base_repository}/{chart_name}"))
+
+		with concurrent.futures.ThreadPoolExecutor(max_workers=default_max_workers()) as executor:
+			tags_by_chart = dict(zip(by_chart, executor.map(chart_tags, by_chart)))
+			present = [v for v in pending if version_to_tag(v.version) in tags_by_chart[v.chart.name_in_repo]]
+			matches = list(executor.map(lambda v: v.registry_copy_matches(), present)) if verify_digests else [True] * len(present)
+
+		backfilled = set()
+		for version, match in zip(present, matches):
+			if match:
+				version.record(reconciled=True)
+				backfilled.add(version.state_key)
+			else:
+				log.warning(f"Registry has '{version.oci_target_version}' but with a different chart digest; will push again")
+		log.info(f"Reconciled repo '{self.repo_id}' with the registry: {len(backfilled)} of {len(pending)} pending versions already present, backfilled")
+		return [v for v in pending if v.state_key not in backfilled]
 
 	def versions_to_process(self) -> list[HelmChartVersion]:
-		if self.latest_only:
-			log.warning(f"Processing latest versions only for repo '{self.repo_id}'")
-			return self.chart_latest_versions
+		if self.latest_count:
+			log.warning(f"Processing the latest {self.latest_count} versions only for repo '{self.repo_id}'")
+			versions = [v for chart in self.charts.values() for v in chart.latest(self.latest_count)]
 		else:
 			log.warning(f"Processing all versions for repo '{self.repo_id}'")
-			return self.chart_all_versions
+			versions = self.chart_all_versions
+		if self.shard is not None:
+			versions = [v for v in versions if v.in_shard(*self.shard)]
+			log.info(f"Shard {self.shard[0]}/{self.shard[1]} of repo '{self.repo_id}' has {len(versions)} versions")
+		return versions
+
+
+def read_repos_yaml(path: str) -> dict:
+	# repos.yaml, parsed. The parsed form is snapshotted as JSON in the cache dir, keyed by the file's sha256: loading
+	# that is much cheaper than YAML parsing (PyYAML isn't even imported), and an edited repos.yaml just misses.
+	with open(path, "rb") as f:
+		data = f.read()
+	snapshot_dir = cache_dir("inventory")
+	snapshot = f"{snapshot_dir}/{hashlib.sha256(data).hexdigest()[:24]}.json"
+	if os.path.exists(snapshot):
+		try:
+			with open(snapshot) as f:
+				return json.load(f)
+		except json.JSONDecodeError:
+			log.warning(f"Ignoring unreadable inventory snapshot '{snapshot}'")
+
+	repos = load_yaml(data)
+	encoded = json.dumps(repos, separators=(",", ":"), default=str)
+	if json.loads(encoded) != repos:
+		return repos  # not plain JSON data (eg: non-string keys, dates); parse it every time rather than change its meaning
+	for old in os.listdir(snapshot_dir):  # snapshots of earlier repos.yaml versions
+		os.remove(f"{snapshot_dir}/{old}")
+	atomic_write(snapshot, encoded.encode("utf-8"))
+	log.debug(f"Wrote inventory snapshot '{snapshot}'")
+	return repos
+
+
+class LazyRepos(collections.abc.Mapping):
+	# repo id -> ChartRepo, each constructed on first access: a job working on one repo doesn't build all of them
+	inventory: "Inventory"
+	repos_yaml: dict[str, dict]
+	built: dict[str, ChartRepo]
+
+	def __init__(self, inventory: "Inventory", repos_yaml: dict[str, dict]):
+		self.inventory = inventory
+		self.repos_yaml = repos_yaml
+		self.built = {}
+
+	def __getitem__(self, repo_id: str) -> ChartRepo:
+		if repo_id not in self.built:
+			self.built[repo_id] = ChartRepo(self.inventory, repo_id, self.repos_yaml[repo_id])  # KeyError if unknown, like a dict
+		return self.built[repo_id]
+
+	def __iter__(self):
+		return iter(self.repos_yaml)
+
+	def __len__(self) -> int:
+		return len(self.repos_yaml)
 
 
 class Inventory:
-	charts: dict[string, ChartRepo]
-	by_url: dict[string, ChartRepo]
+	charts: LazyRepos  # repo id -> ChartRepo
 	base_oci_ref: string
 	base_path: string
-
-	def __init__(self, base_oci_ref):
+	hash: string  # repos.yaml top-level 'hash'; bump to re-process everything
+	push_mode: string  # "native" (in-process OCI client) or "helm" (`helm push` subprocess, fallback)
+	upstream_limits: HostLimits  # concurrent chart downloads per upstream host
+	registry_limits: HostLimits  # concurrent pushes per OCI registry
+	fetch_limiter: AdaptiveLimiter  # adaptive concurrency + retries for all chart downloads
+	push_limiter: AdaptiveLimiter  # adaptive concurrency + retries for all pushes
+	index_caches: dict[str, IndexCache]  # source -> its index cache, shared by the repos with that source
+	fetched_indexes: dict[str, tuple[dict[str, list[dict]] | None, bool]]  # source -> fetch_index() result, this run
+
+	def __init__(self, base_oci_ref, push_mode="native"):
 		self.base_oci_ref = base_oci_ref
-		self.charts = {}
-		self.by_url = {}
+		if push_mode not in ("native", "helm"):
+			raise Exception(f"Invalid push mode '{push_mode}'; expected 'native' or 'helm'")
+		self.push_mode = push_mode
+		self.upstream_limits = HostLimits("upstream", int(os.environ.get("MAX_PER_UPSTREAM_HOST", "8")))
+		self.registry_limits = HostLimits("registry", int(os.environ.get("MAX_PER_REGISTRY", "16")))
+		self.fetch_limiter = AdaptiveLimiter("fetch", max_limit=default_max_workers())
+		self.push_limiter = AdaptiveLimiter("push", max_limit=default_max_workers())
+		self.index_caches = {}
+		self.fetched_indexes = {}
+		self.index_lock = threading.Lock()
 
 		self.base_path = os.getcwd()
 
-		# read repos.yaml file and parse it with PyYAML
-		with open(f'{self.base_path}/repos.yaml') as f:
-			repos = yaml.load(f, Loader=yaml.FullLoader)
-			for repo_id in repos['repositories']:
-				repo_yaml = repos['repositories'][repo_id]
-				self.charts[repo_id] = ChartRepo(self, repo_id, repo_yaml)
-				self.by_url[self.charts[repo_id].source] = self.charts[repo_id]
+		repos = read_repos_yaml(f'{self.base_path}/repos.yaml')
+		self.hash = str(repos.get("hash", ""))
+		self.charts = LazyRepos(self, repos['repositories'])
+
+	def index_cache(self, source: str) -> IndexCache:
+		with self.index_lock:
+			if source not in self.index_caches:
+				self.index_caches[source] = IndexCache(source)
+			return self.index_caches[source]
+
+	def fetch_index(self, source: str) -> tuple[dict[str, list[dict]] | None, bool]:
+		# fetch_index() once per source per run; later callers (other repos with the same source) get the same result
+		with self.index_lock:
+			if source in self.fetched_indexes:
+				return self.fetched_indexes[source]
+		cache = self.index_cache(source)
+		with self.upstream_limits.slot(urlparse(source).netloc):
+			fetched = fetch_index(source, cache)
+		with self.index_lock:
+			self.fetched_indexes[source] = fetched
+		return fetched
+
+	def refresh_indexes(self, repos: list[ChartRepo]):
+		# Fetch the indexes of many repos concurrently, for gha-matrix and process-all: each distinct source once, all
+		# over the shared pooled (keep-alive) HTTP session, at most MAX_PER_UPSTREAM_HOST at a time per host.
+		# A source that fails is only logged here; the repo's own update_index() call retries it, and raises.
+		by_source: dict[str, list[ChartRepo]] = {}
+		for repo in repos:
+			by_source.setdefault(repo.source, []).append(repo)
+		workers = min(len(by_source), int(os.environ.get("INDEX_FETCH_WORKERS", "16"))) or 1
+		log.info(f"Refreshing {len(by_source)} indexes for {len(repos)} repos, {workers} at a time")
+
+		def refresh(sharing: list[ChartRepo]):
+			for repo in sharing:
+				repo.update_index()  # only the first one fetches
+
+		with concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="Index") as executor:
+			futures = {executor.submit(refresh, sharing): source for source, sharing in by_source.items()}
+			for future in concurrent.futures.as_completed(futures):
+				try:
+					future.result()
+				except Exception as e:
+					log.warning(f"Refreshing index '{futures[future]}' failed: {e}")
+
+	@property
+	def by_url(self) -> dict[str, ChartRepo]:
+		return {repo.source: repo for repo in self.charts.values()}
 
 	def __rich_repr__(self):
-		yield "charts", self.charts
+		yield "repo_ids", list(self.charts)
+		yield "charts", self.charts.built  # only the ones in use
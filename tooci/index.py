@@ -0,0 +1,148 @@
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+from utils import atomic_write
+from utils import cache_dir
+from utils import http_session
+from utils import load_yaml
+
+log = logging.getLogger("index")
+
+# Only these keys of each index.yaml entry are used downstream; everything else (maintainers, annotations, ...) is dropped
+KEPT_ENTRY_KEYS = ("name", "version", "appVersion", "description", "urls", "digest")
+# Values repeated across versions (every version of a chart carries its name and, usually, the same description);
+# interned, so a 50k-version index holds each once
+INTERNED_ENTRY_KEYS = ("name", "version", "appVersion", "description")
+
+index_cache_lock = threading.Lock()
+
+
+def index_url(source: str) -> str:
+	return f"{source.rstrip('/')}/index.yaml"
+
+
+def slim_entries(raw_entries: dict[str, list[dict]]) -> dict[str, list[dict]]:
+	entries: dict[str, list[dict]] = {}
+	for chart_name, chart_versions in (raw_entries or {}).items():
+		entries[sys.intern(chart_name)] = [slim_entry(v) for v in (chart_versions or [])]
+	return entries
+
+
+def slim_entry(raw_entry: dict) -> dict:
+	return intern_entry({k: raw_entry[k] for k in KEPT_ENTRY_KEYS if k in raw_entry})
+
+
+def intern_entry(entry: dict) -> dict:
+	for k in INTERNED_ENTRY_KEYS:
+		if type(entry.get(k)) is str:
+			entry[k] = sys.intern(entry[k])
+	return entry
+
+
+def parse_index(stream) -> dict[str, list[dict]]:
+	# stream is anything yaml.load accepts: bytes, str or a file-like object with read()
+	# load_yaml uses the libyaml-backed loader, an order of magnitude faster on multi-megabyte index.yaml files
+	index = load_yaml(stream)
+	if not isinstance(index, dict) or "entries" not in index:
+		raise Exception("Not a Helm repo index: no 'entries' key")
+	return slim_entries(index["entries"])
+
+
+class IndexCache:
+	# On-disk cache of one repo index, keyed by ChartRepo.source; survives between runs via actions/cache.
+	# <key>.json holds the validators (ETag/Last-Modified) and per-repo-id "processed" fingerprints; it is tiny,
+	# so an unchanged repo can be decided on without loading <key>.entries.json (the slimmed index itself).
+	# One instance per source per run (see Inventory.index_cache()), shared by all repos with that source: their
+	# "processed" marks land in the same meta file, and the entries are loaded (or parsed) once for all of them.
+	source: str
+	meta: dict
+	entries: dict[str, list[dict]] | None  # the slimmed index, once fetched or loaded
+
+	def __init__(self, source: str):
+		self.source = source
+		key = hashlib.sha256(source.encode("utf-8")).hexdigest()[:24]
+		base = cache_dir("index")
+		self.meta_file = f"{base}/{key}.json"
+		self.entries_file = f"{base}/{key}.entries.json"
+		self.meta = {}
+		self.entries = None
+		if os.path.exists(self.meta_file) and os.path.exists(self.entries_file):
+			with open(self.meta_file) as f:
+				self.meta = json.load(f)
+
+	def conditional_headers(self) -> dict[str, str]:
+		headers = {}
+		if self.meta.get("etag"):
+			headers["If-None-Match"] = self.meta["etag"]
+		if self.meta.get("last_modified"):
+			headers["If-Modified-Since"] = self.meta["last_modified"]
+		return headers
+
+	def load_entries(self) -> dict[str, list[dict]]:
+		with index_cache_lock:
+			if self.entries is None:
+				with open(self.entries_file) as f:
+					self.entries = {sys.intern(name): [intern_entry(v) for v in versions] for name, versions in json.load(f).items()}
+			return self.entries
+
+	def store(self, entries: dict[str, list[dict]], etag: str | None, last_modified: str | None):
+		with index_cache_lock:
+			self.entries = entries
+			atomic_write(self.entries_file, json.dumps(entries, separators=(",", ":"), default=str).encode("utf-8"))
+			self.meta = {"source": self.source, "etag": etag, "last_modified": last_modified, "processed": self.meta.get("processed", {})}
+			atomic_write(self.meta_file, json.dumps(self.meta, indent=2).encode("utf-8"))
+
+	def processed_marker(self, repo_id: str, config_fingerprint: str, state_fingerprint: str) -> dict | None:
+		# the last complete run's marker, if it was with the same config and ended with the processed state we have now:
+		# a state that didn't make it to info/ (failed checkpoint or commit), or was reset on purpose, voids it
+		processed = self.meta.get("processed", {}).get(repo_id)
+		if not processed or processed["config"] != config_fingerprint or processed.get("state") != state_fingerprint:
+			return None
+		return processed
+
+	def unchanged_and_processed(self, repo_id: str, config_fingerprint: str, state_fingerprint: str) -> bool:
+		# True if the last complete run of repo_id was against exactly the index we have cached, with the same config
+		processed = self.processed_marker(repo_id, config_fingerprint, state_fingerprint)
+		if not processed:
+			return False
+		return (processed["etag"], processed["last_modified"]) == (self.meta.get("etag"), self.meta.get("last_modified"))
+
+	def processed_plan(self, repo_id: str, config_fingerprint: str, state_fingerprint: str) -> str | None:
+		processed = self.processed_marker(repo_id, config_fingerprint, state_fingerprint)
+		return processed["plan"] if processed else None
+
+	def mark_processed(self, repo_id: str, config_fingerprint: str, plan_fingerprint: str, state_fingerprint: str):
+		with index_cache_lock:
+			self.meta.setdefault("processed", {})[repo_id] = {
+				"config": config_fingerprint, "plan": plan_fingerprint, "state": state_fingerprint,
+				"etag": self.meta.get("etag"), "last_modified": self.meta.get("last_modified")
+			}
+			atomic_write(self.meta_file, json.dumps(self.meta, indent=2).encode("utf-8"))
+
+
+def fetch_index(source: str, cache: IndexCache | None = None) -> tuple[dict[str, list[dict]] | None, bool]:
+	# Streams <source>/index.yaml straight into the YAML parser; returns ({chart name: [slim version entries]}, not_modified)
+	# With a cache, does a conditional GET; on 304 Not Modified the entries are NOT loaded (None), use cache.load_entries()
+	url = index_url(source)
+	headers = cache.conditional_headers() if cache else {}
+	log.info(f"Fetching index '{url}'{' (conditional)' if headers else ''}")
+	start = time.monotonic()
+	with http_session().get(url, stream=True, timeout=120, headers=headers) as response:
+		if response.status_code == 304:
+			log.info(f"Index '{url}' not modified since last fetch ({time.monotonic() - start:.2f}s)")
+			return None, True
+		if response.status_code != 200:
+			raise Exception(f"Fetching index '{url}' failed: {response.status_code} {response.reason}")
+		response.raw.decode_content = True  # let urllib3 gunzip on the fly
+		entries = parse_index(response.raw)
+		etag, last_modified = response.headers.get("ETag"), response.headers.get("Last-Modified")
+	versions = sum(len(v) for v in entries.values())
+	log.info(f"Parsed index '{url}': {len(entries)} charts, {versions} versions in {time.monotonic() - start:.2f}s")
+	if cache:
+		cache.store(entries, etag, last_modified)
+	return entries, False
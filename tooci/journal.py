@@ -0,0 +1,113 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from typing import Callable
+
+from utils import atomic_write
+
+log = logging.getLogger("journal")
+
+PLANNED = "planned"
+FETCHED = "fetched"
+TRANSFORMED = "transformed"  # processors ran; only for repos with processors
+PUSHED = "pushed"
+RECORDED = "recorded"  # in the processed state (info/); nothing left to do
+
+
+def file_sha256(path: str) -> str:
+	sha256 = hashlib.sha256()
+	with open(path, "rb") as f:
+		for chunk in iter(lambda: f.read(1024 * 1024), b""):
+			sha256.update(chunk)
+	return sha256.hexdigest()
+
+
+class WorkJournal:
+	# Write-ahead journal of one repo's (or shard's) work: <name>.jsonl, one line per stage a version reaches, fsynced
+	# before moving on. Fetched/transformed artifacts live in <name>.artifacts/<version key>/ until the version is recorded,
+	# so a run killed at the step timeout resumes where it stopped: pushed versions are only recorded, fetched ones
+	# reuse their (checksummed) artifact instead of being downloaded and transformed again.
+	path: str
+	artifacts_dir: str
+	entries: dict[str, dict]  # version key -> its latest entry
+	closed: bool  # see close(); later writes (from threads abandoned at the drain deadline) are dropped
+
+	def __init__(self, directory: str, name: str):
+		self.path = f"{directory}/{name}.jsonl"
+		self.artifacts_dir = f"{directory}/{name}.artifacts"
+		self.entries = {}
+		self.closed = False
+		self.lock = threading.Lock()
+		if os.path.exists(self.path):
+			with open(self.path) as f:
+				for line in f:
+					try:
+						entry = json.loads(line)
+					except json.JSONDecodeError:
+						continue  # a line cut short by a killed run; fsync only covers whole lines
+					self.entries[entry["key"]] = entry
+		resumable = len([e for e in self.entries.values() if e["stage"] != RECORDED])
+		log.info(f"Work journal '{self.path}': {resumable} versions with unfinished work from earlier runs")
+		self.file = open(self.path, "a")
+
+	def append(self, entries: list[dict]):
+		lines = "".join(json.dumps(entry, separators=(",", ":")) + "\n" for entry in entries)
+		with self.lock:
+			if self.closed:
+				log.warning(f"Work journal '{self.path}' already closed; dropping {len(entries)} entries")
+				return
+			self.file.write(lines)
+			self.file.flush()
+			os.fsync(self.file.fileno())
+			for entry in entries:
+				self.entries[entry["key"]] = entry
+
+	def log(self, key: str, stage: str, artifact: str | None = None):
+		entry = {"key": key, "stage": stage, "time": time.time()}
+		if artifact is not None:
+			entry["artifact"] = os.path.basename(artifact)
+			entry["sha256"] = file_sha256(artifact)
+		self.append([entry])
+
+	def log_planned(self, keys: list[str]):
+		# one fsync for the whole plan; versions with progress from an earlier run keep it
+		now = time.time()
+		self.append([{"key": key, "stage": PLANNED, "time": now} for key in keys if key not in self.entries])
+
+	def work_dir(self, key: str) -> str:
+		path = f"{self.artifacts_dir}/{key}"
+		os.makedirs(path, exist_ok=True)
+		return path
+
+	def resume_point(self, key: str) -> tuple[str | None, str | None]:
+		# (stage reached, artifact path); fetched/transformed only count if the artifact is still there, unchanged
+		entry = self.entries.get(key)
+		if entry is None or entry["stage"] == PLANNED:
+			return None, None
+		if entry["stage"] in (FETCHED, TRANSFORMED):
+			artifact = f"{self.artifacts_dir}/{key}/{entry['artifact']}"
+			if not os.path.exists(artifact) or file_sha256(artifact) != entry["sha256"]:
+				log.warning(f"Journaled artifact for '{key}' missing or changed; starting over")
+				return None, None
+			return entry["stage"], artifact
+		return entry["stage"], None
+
+	def discard(self, key: str):
+		shutil.rmtree(f"{self.artifacts_dir}/{key}", ignore_errors=True)
+
+	def close(self, is_done: Callable[[str], bool]):
+		# compact: drop finished versions (recorded, or found in the state some other way) and their artifacts
+		with self.lock:
+			self.closed = True
+			self.file.close()
+			kept = {key: entry for key, entry in self.entries.items() if entry["stage"] != RECORDED and not is_done(key)}
+			atomic_write(self.path, "".join(json.dumps(kept[key], separators=(",", ":")) + "\n" for key in sorted(kept)).encode("utf-8"))
+			if os.path.isdir(self.artifacts_dir):
+				for key in os.listdir(self.artifacts_dir):
+					if key not in kept:
+						shutil.rmtree(f"{self.artifacts_dir}/{key}", ignore_errors=True)
+		log.info(f"Work journal '{self.path}' closed; {len(kept)} versions left to resume")
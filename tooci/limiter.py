@@ -0,0 +1,153 @@
+import logging
+import random
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable
+
+import requests
+
+from timings import run_timings
+from utils import DigestMismatchError
+from utils import HttpError
+from utils import ShellError
+
+log = logging.getLogger("limiter")
+
+RETRYABLE = "retryable"
+RATE_LIMITED = "rate_limited"
+FATAL = "fatal"
+
+
+def classify_error(e: Exception) -> str:
+	if isinstance(e, HttpError) and e.status_code is not None:
+		if e.status_code == 429:
+			return RATE_LIMITED
+		if e.status_code in (408, 409, 425) or e.status_code >= 500:
+			return RETRYABLE
+		if e.status_code == 403 and e.retry_after is not None:
+			return RATE_LIMITED  # some registries signal abuse limits with 403 + Retry-After
+		return FATAL  # 401/403/404/400...: retrying won't help
+	if isinstance(e, DigestMismatchError):
+		return FATAL  # the same bytes again; see HelmChartVersion.fetch
+	if isinstance(e, (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError, subprocess.TimeoutExpired, ConnectionError, TimeoutError)):
+		return RETRYABLE
+	if isinstance(e, ShellError):
+		return RETRYABLE  # a `helm push` exiting non-zero: mostly the network or the registry, it tells us no more
+	# anything else is a bug or bad input (a chart without URLs, a broken tarball or Chart.yaml...): the same every attempt
+	return FATAL
+
+
+class AdaptiveLimiter:
+	# AIMD concurrency limiter shared by all threads doing one kind of operation (fetches, or pushes):
+	# each success raises the limit by ~1 per "window" of limit successes (additive increase); a rate-limit signal
+	# halves it (multiplicative decrease, at most once per cooldown) and pauses *all* callers until Retry-After or
+	# the backoff elapses, so threads don't keep hammering a registry that already said 429.
+	# Failed calls are retried with full-jitter exponential backoff, outside of the concurrency slot.
+	name: str
+	min_limit: int
+	max_limit: int
+	limit: float
+	in_flight: int
+	paused_until: float
+	metrics: dict[str, int]
+
+	def __init__(self, name: str, max_limit: int, min_limit: int = 1, initial_limit: int | None = None,
+			attempts: int = 5, backoff_base: float = 1.0, backoff_cap: float = 60.0, decrease_cooldown: float = 2.0):
+		self.name = name
+		self.min_limit = min_limit
+		self.max_limit = max_limit
+		self.limit = float(initial_limit or max(min_limit, max_limit // 2))
+		self.in_flight = 0
+		self.paused_until = 0.0
+		self.last_decrease = 0.0
+		self.attempts = attempts
+		self.backoff_base = backoff_base
+		self.backoff_cap = backoff_cap
+		self.decrease_cooldown = decrease_cooldown
+		self.metrics = {"calls": 0, "successes": 0, "retries": 0, "rate_limited": 0, "fatal": 0, "gave_up": 0, "decreases": 0, "pauses": 0}
+		self.condition = threading.Condition()
+
+	def count(self, metric: str):
+		with self.condition:
+			self.metrics[metric] += 1
+
+	@contextmanager
+	def slot(self):
+		with self.condition:
+			while True:
+				pause = self.paused_until - time.monotonic()
+				if pause <= 0 and self.in_flight < int(self.limit):
+					break
+				self.condition.wait(timeout=pause if pause > 0 else None)
+			self.in_flight += 1
+		try:
+			yield
+		finally:
+			with self.condition:
+				self.in_flight -= 1
+				self.condition.notify_all()
+
+	def on_success(self):
+		with self.condition:
+			self.metrics["successes"] += 1
+			if self.limit < self.max_limit:
+				previous = int(self.limit)
+				self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+				if int(self.limit) > previous:
+					log.info(f"{self.name} limiter: increased concurrency to {int(self.limit)}")
+			self.condition.notify_all()
+
+	def on_rate_limited(self, pause_seconds: float):
+		now = time.monotonic()
+		with self.condition:
+			self.metrics["rate_limited"] += 1
+			if now - self.last_decrease >= self.decrease_cooldown:
+				self.last_decrease = now
+				self.limit = max(float(self.min_limit), self.limit / 2)
+				self.metrics["decreases"] += 1
+				log.warning(f"{self.name} limiter: rate limited; decreased concurrency to {int(self.limit)}")
+			if now + pause_seconds > self.paused_until:
+				self.paused_until = now + pause_seconds
+				self.metrics["pauses"] += 1
+				log.warning(f"{self.name} limiter: pausing all {self.name} operations for {pause_seconds:.1f}s")
+
+	def backoff(self, attempt: int, retry_after: float | None) -> float:
+		# full jitter: uniform(0, min(cap, base * 2^attempt)); never less than what the server asked for
+		delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * (2 ** attempt)))
+		if retry_after is not None:
+			delay = max(delay, min(retry_after, self.backoff_cap * 5))
+		return delay
+
+	def call(self, description: str, fn: Callable, *args, **kwargs):
+		self.count("calls")
+		for attempt in range(1, self.attempts + 1):
+			try:
+				with self.slot():
+					ret = fn(*args, **kwargs)
+				self.on_success()
+				return ret
+			except Exception as e:
+				kind = classify_error(e)
+				retry_after = getattr(e, "retry_after", None)
+				if kind == FATAL:
+					self.count("fatal")
+					log.error(f"{self.name}: {description} failed with a non-retryable error: {e}")
+					raise
+				delay = self.backoff(attempt, retry_after)
+				if kind == RATE_LIMITED:
+					self.on_rate_limited(delay)
+				if attempt == self.attempts:
+					self.count("gave_up")
+					log.error(f"{self.name}: {description} failed after {attempt} attempts: {e}")
+					raise
+				self.count("retries")
+				run_timings().count_current(f"{self.name}_retries")
+				log.warning(f"{self.name}: attempt {attempt} of {description} failed ({kind}): {e}; retrying in {delay:.1f}s")
+				time.sleep(delay)
+				run_timings().add_seconds_current(f"{self.name}_retry_sleep", delay)
+
+	def summary(self) -> str:
+		with self.condition:
+			return f"{self.name} limiter: final concurrency {int(self.limit)}/{self.max_limit}; " + ", ".join(f"{k}={v}" for k, v in self.metrics.items())
@@ -0,0 +1,338 @@
+import base64
+import datetime
+import hashlib
+import json
+import logging
+import os
+import re
+import tarfile
+import threading
+from urllib.parse import urljoin
+
+import requests
+
+from timings import run_timings
+from utils import HttpError
+from utils import cache_dir
+from utils import http_session
+from utils import load_yaml
+from utils import parse_retry_after
+
+log = logging.getLogger("oci")
+
+# Media types used by helm >= 3.8 when pushing charts to OCI registries
+OCI_MANIFEST_MEDIA_TYPE = "application/vnd.oci.image.manifest.v1+json"
+HELM_CONFIG_MEDIA_TYPE = "application/vnd.cncf.helm.config.v1+json"
+HELM_CHART_CONTENT_MEDIA_TYPE = "application/vnd.cncf.helm.chart.content.v1.tar+gzip"
+
+singleton_client: "OciClient | None" = None
+singleton_client_lock = threading.Lock()
+singleton_blob_locations: "BlobLocations | None" = None
+singleton_blob_locations_lock = threading.Lock()
+
+
+class RegistryError(HttpError):
+	pass
+
+
+def sha256_digest(data: bytes) -> str:
+	return f"sha256:{hashlib.sha256(data).hexdigest()}"
+
+
+def sha256_file_digest(path: str) -> str:
+	h = hashlib.sha256()
+	with open(path, "rb") as f:
+		for chunk in iter(lambda: f.read(1024 * 1024), b""):
+			h.update(chunk)
+	return f"sha256:{h.hexdigest()}"
+
+
+def version_to_tag(version: str) -> str:
+	# OCI tags can't contain '+'; helm replaces it with '_' when pushing (and back when pulling)
+	return version.replace("+", "_")
+
+
+def split_oci_ref(oci_ref: str) -> tuple[str, str]:
+	# "ghcr.io/org/repo/chart" -> ("ghcr.io", "org/repo/chart")
+	if "://" in oci_ref:
+		raise Exception(f"OCI reference should not include a scheme: '{oci_ref}'")
+	host, _, path = oci_ref.partition("/")
+	if not path:
+		raise Exception(f"OCI reference without repository path: '{oci_ref}'")
+	return host, path
+
+
+def read_chart_yaml_from_tgz(chart_tgz_fullpath: str) -> dict:
+	# Chart.yaml is at <chart-dir>/Chart.yaml, the first one at depth 1 is the chart's own (others are subcharts)
+	with tarfile.open(chart_tgz_fullpath, "r:gz") as tar:
+		for member in tar:
+			parts = member.name.split("/")
+			if member.isfile() and len(parts) == 2 and parts[1] == "Chart.yaml":
+				return load_yaml(tar.extractfile(member))
+	raise Exception(f"No Chart.yaml found in '{chart_tgz_fullpath}'")
+
+
+def docker_config_credentials(registry: str) -> tuple[str, str] | None:
+	# docker/login-action (and `docker login`) store base64 user:pass in ~/.docker/config.json
+	config_dir = os.environ.get("DOCKER_CONFIG", os.path.expanduser("~/.docker"))
+	config_file = f"{config_dir}/config.json"
+	if not os.path.exists(config_file):
+		return None
+	with open(config_file) as f:
+		config = json.load(f)
+	for key, entry in config.get("auths", {}).items():
+		if key.removeprefix("https://").removeprefix("http://").rstrip("/") != registry:
+			continue
+		if "auth" not in entry:
+			continue
+		username, _, password = base64.b64decode(entry["auth"]).decode("utf-8").partition(":")
+		return username, password
+	return None
+
+
+def registry_error(message: str, response: requests.Response) -> RegistryError:
+	return RegistryError(f"{message}: {response.status_code} {response.text}", response.status_code, parse_retry_after(response.headers.get("Retry-After")))
+
+
+class OciClient:
+	session: requests.Session
+	tokens: dict[tuple[str, str], str]  # (registry, scope) -> bearer token
+	challenges: dict[str, dict[str, str]]  # registry -> parsed WWW-Authenticate Bearer challenge
+	credentials: dict[str, tuple[str, str] | None]
+
+	def __init__(self, session: requests.Session):
+		self.session = session
+		self.tokens = {}
+		self.challenges = {}
+		self.credentials = {}
+		self.lock = threading.Lock()
+
+	def base_url(self, registry: str) -> str:
+		host = registry.split(":")[0]
+		plain_http = host in ("localhost", "127.0.0.1") or os.environ.get("OCI_PLAIN_HTTP", "no") == "yes"
+		return f"{'http' if plain_http else 'https'}://{registry}"
+
+	def registry_credentials(self, registry: str) -> tuple[str, str] | None:
+		with self.lock:
+			if registry not in self.credentials:
+				if os.environ.get("OCI_USERNAME") and os.environ.get("OCI_PASSWORD"):
+					self.credentials[registry] = (os.environ["OCI_USERNAME"], os.environ["OCI_PASSWORD"])
+				else:
+					self.credentials[registry] = docker_config_credentials(registry)
+			return self.credentials[registry]
+
+	def fetch_token(self, registry: str, scope: str) -> str | None:
+		with self.lock:
+			if (registry, scope) in self.tokens:
+				return self.tokens[(registry, scope)]
+			challenge = self.challenges.get(registry)
+		if challenge is None:
+			return None  # no challenge seen yet; first request goes anonymous
+
+		params = {"scope": scope.split(" ")}  # one scope param per repository
+		if "service" in challenge:
+			params["service"] = challenge["service"]
+		auth = self.registry_credentials(registry)
+		log.debug(f"Fetching token for registry '{registry}' scope '{scope}'")
+		response = self.session.get(challenge["realm"], params=params, auth=auth, timeout=30)
+		if response.status_code != 200:
+			raise registry_error(f"Token request to '{challenge['realm']}' for scope '{scope}' failed", response)
+		body = response.json()
+		token = body.get("token") or body.get("access_token")
+		with self.lock:
+			self.tokens[(registry, scope)] = token
+		return token
+
+	def parse_challenge(self, registry: str, header: str):
+		if not header.lower().startswith("bearer "):
+			raise RegistryError(f"Unsupported auth challenge from '{registry}': '{header}'", 401)
+		challenge = dict(re.findall(r'(\w+)="([^"]*)"', header))
+		with self.lock:
+			self.challenges[registry] = challenge
+
+	def request(self, method: str, registry: str, repository: str, url: str, mount_from: str | None = None, **kwargs) -> requests.Response:
+		scope = f"repository:{repository}:pull,push"
+		if mount_from:
+			scope += f" repository:{mount_from}:pull"  # a cross-repository mount needs pull access to the source too
+		if not url.startswith("http"):
+			url = f"{self.base_url(registry)}{url}"
+		kwargs.setdefault("timeout", 60)
+		for attempt in ("cached", "refreshed"):
+			headers = dict(kwargs.pop("headers", {}))
+			token = self.fetch_token(registry, scope)
+			if token:
+				headers["Authorization"] = f"Bearer {token}"
+			response = self.session.request(method, url, headers=headers, **kwargs)
+			kwargs["headers"] = headers
+			if response.status_code != 401 or attempt == "refreshed":
+				return response
+			# 401: (re)learn the challenge and drop the cached token, then try once more
+			self.parse_challenge(registry, response.headers.get("WWW-Authenticate", ""))
+			with self.lock:
+				self.tokens.pop((registry, scope), None)
+			if hasattr(kwargs.get("data"), "seek"):
+				kwargs["data"].seek(0)
+		return response
+
+	def blob_exists(self, registry: str, repository: str, digest: str) -> bool:
+		response = self.request("HEAD", registry, repository, f"/v2/{repository}/blobs/{digest}")
+		return response.status_code == 200
+
+	def upload_blob(self, registry: str, repository: str, digest: str, data, mount_from: str | None = None) -> str:
+		# returns how the blob got there: "present", "mounted" (cross-repository mount from mount_from) or "uploaded"
+		if self.blob_exists(registry, repository, digest):
+			log.debug(f"Blob '{digest}' already present in '{registry}/{repository}'")
+			return "present"
+
+		response = None
+		if mount_from:
+			response = self.request("POST", registry, repository, f"/v2/{repository}/blobs/uploads/?mount={digest}&from={mount_from}", mount_from=mount_from)
+			if response.status_code == 201:
+				log.debug(f"Blob '{digest}' mounted into '{registry}/{repository}' from '{mount_from}'")
+				return "mounted"
+			if response.status_code != 202:  # 202: mount refused, but the registry opened a regular upload session instead
+				log.debug(f"Mounting blob '{digest}' from '{mount_from}' failed ({response.status_code}); uploading")
+				response = None
+		if response is None:
+			response = self.request("POST", registry, repository, f"/v2/{repository}/blobs/uploads/")
+		if response.status_code != 202:
+			raise registry_error(f"Starting blob upload to '{registry}/{repository}' failed", response)
+		location = urljoin(f"{self.base_url(registry)}/", response.headers["Location"])
+		location = f"{location}{'&' if '?' in location else '?'}digest={digest}"
+
+		response = self.request("PUT", registry, repository, location, data=data, headers={"Content-Type": "application/octet-stream"})
+		if response.status_code != 201:
+			raise registry_error(f"Uploading blob '{digest}' to '{registry}/{repository}' failed", response)
+		return "uploaded"
+
+	def place_blob(self, registry: str, repository: str, digest: str, data) -> str:
+		# upload_blob(), mounting from another repository of the same registry that is known to have the blob, if any;
+		# identical charts pushed under several paths (eg: bitnami-classic and bitnami-relic) are only uploaded once
+		locations = blob_locations()
+		outcome = self.upload_blob(registry, repository, digest, data, mount_from=locations.find(registry, digest, repository))
+		locations.add(registry, digest, repository)
+		run_timings().count_current(f"blobs_{outcome}")
+		return outcome
+
+	def put_manifest(self, registry: str, repository: str, tag: str, manifest: bytes) -> str:
+		response = self.request("PUT", registry, repository, f"/v2/{repository}/manifests/{tag}", data=manifest, headers={"Content-Type": OCI_MANIFEST_MEDIA_TYPE})
+		if response.status_code != 201:
+			raise registry_error(f"Putting manifest '{registry}/{repository}:{tag}' failed", response)
+		return response.headers.get("Docker-Content-Digest", sha256_digest(manifest))
+
+	def list_tags(self, registry: str, repository: str, page_size: int = 1000) -> list[str]:
+		# GET /v2/<name>/tags/list, following the Link: <...>; rel="next" pagination; a missing repository has no tags
+		tags: list[str] = []
+		url = f"/v2/{repository}/tags/list?n={page_size}"
+		while url:
+			response = self.request("GET", registry, repository, url)
+			if response.status_code == 404:
+				return []
+			if response.status_code != 200:
+				raise registry_error(f"Listing tags of '{registry}/{repository}' failed", response)
+			tags.extend(response.json().get("tags") or [])
+			next_link = response.links.get("next", {}).get("url")
+			url = urljoin(f"{self.base_url(registry)}/", next_link) if next_link else None
+		return tags
+
+	def get_manifest(self, registry: str, repository: str, tag: str) -> dict | None:
+		response = self.request("GET", registry, repository, f"/v2/{repository}/manifests/{tag}", headers={"Accept": OCI_MANIFEST_MEDIA_TYPE})
+		if response.status_code == 404:
+			return None
+		if response.status_code != 200:
+			raise registry_error(f"Getting manifest '{registry}/{repository}:{tag}' failed", response)
+		return response.json()
+
+	def push_chart(self, chart_tgz_fullpath: str, oci_target: str) -> str:
+		# Equivalent of `helm push <chart.tgz> oci://<oci_target>`: pushes to <oci_target>/<chart name>:<version>
+		chart_yaml = read_chart_yaml_from_tgz(chart_tgz_fullpath)
+		registry, base_repository = split_oci_ref(oci_target)
+		repository = f"{base_repository}/{chart_yaml['name']}"
+		tag = version_to_tag(str(chart_yaml["version"]))
+
+		config = json.dumps(chart_yaml, separators=(",", ":"), default=str).encode("utf-8")
+		config_digest = sha256_digest(config)
+		layer_digest = sha256_file_digest(chart_tgz_fullpath)
+		layer_size = os.path.getsize(chart_tgz_fullpath)
+
+		self.place_blob(registry, repository, config_digest, config)
+		with open(chart_tgz_fullpath, "rb") as f:
+			self.place_blob(registry, repository, layer_digest, f)
+
+		manifest = json.dumps({
+			"schemaVersion": 2,
+			"mediaType": OCI_MANIFEST_MEDIA_TYPE,
+			"config": {"mediaType": HELM_CONFIG_MEDIA_TYPE, "digest": config_digest, "size": len(config)},
+			"layers": [{"mediaType": HELM_CHART_CONTENT_MEDIA_TYPE, "digest": layer_digest, "size": layer_size}],
+			"annotations": self.chart_annotations(chart_yaml),
+		}, separators=(",", ":")).encode("utf-8")
+		manifest_digest = self.put_manifest(registry, repository, tag, manifest)
+		log.info(f"Pushed '{chart_tgz_fullpath}' to '{registry}/{repository}:{tag}' ({manifest_digest})")
+		return manifest_digest
+
+	@staticmethod
+	def chart_annotations(chart_yaml: dict) -> dict[str, str]:
+		# same annotations helm adds, so `helm show chart oci://...` and friends are happy
+		annotations = {str(k): str(v) for k, v in (chart_yaml.get("annotations") or {}).items()}
+		annotations["org.opencontainers.image.title"] = str(chart_yaml["name"])
+		annotations["org.opencontainers.image.version"] = str(chart_yaml["version"])
+		annotations["org.opencontainers.image.created"] = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+		if chart_yaml.get("description"):
+			annotations["org.opencontainers.image.description"] = str(chart_yaml["description"])
+		if chart_yaml.get("home"):
+			annotations["org.opencontainers.image.url"] = str(chart_yaml["home"])
+		if chart_yaml.get("sources"):
+			annotations["org.opencontainers.image.source"] = str(chart_yaml["sources"][0])
+		return annotations
+
+
+class BlobLocations:
+	# Persistent index of where blobs are known to exist: (registry, digest) -> one repository holding it.
+	# Lives next to the chart blob cache (see blobcache.py), so it is shared across repos, jobs and runs; a stale entry
+	# (eg: package deleted) only costs a refused mount, after which the blob is uploaded as usual.
+	path: str
+	locations: dict[tuple[str, str], str]
+
+	def __init__(self, path: str):
+		self.path = path
+		self.locations = {}
+		self.lock = threading.Lock()
+		if os.path.exists(path):
+			with open(path) as f:
+				for line in f:
+					try:
+						entry = json.loads(line)
+					except json.JSONDecodeError:
+						continue  # a line cut short by a killed run
+					self.locations[(entry["registry"], entry["digest"])] = entry["repository"]
+		log.info(f"Blob locations '{self.path}': {len(self.locations)} known blobs")
+
+	def find(self, registry: str, digest: str, repository: str) -> str | None:
+		with self.lock:
+			location = self.locations.get((registry, digest))
+		return location if location != repository else None
+
+	def add(self, registry: str, digest: str, repository: str):
+		with self.lock:
+			if (registry, digest) in self.locations:
+				return  # keep the first known location; any one will do for a mount
+			self.locations[(registry, digest)] = repository
+			with open(self.path, "a") as f:
+				f.write(json.dumps({"registry": registry, "digest": digest, "repository": repository}) + "\n")
+
+
+def blob_locations() -> BlobLocations:
+	global singleton_blob_locations
+	with singleton_blob_locations_lock:
+		if singleton_blob_locations is None:
+			singleton_blob_locations = BlobLocations(f"{cache_dir('blobs/locations')}/locations.jsonl")
+		return singleton_blob_locations
+
+
+def oci_client() -> OciClient:
+	# one client (one pooled session + token cache) shared by all worker threads
+	global singleton_client
+	with singleton_client_lock:
+		if singleton_client is None:
+			singleton_client = OciClient(http_session())
+		return singleton_client
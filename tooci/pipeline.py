@@ -0,0 +1,233 @@
+import asyncio
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import time
+
+from journal import FETCHED
+from journal import PUSHED
+from journal import TRANSFORMED
+from processors import rewrite_chart_tgz_named
+from scheduler import ScheduleResult
+from scheduler import graceful_shutdown
+from timings import run_timings
+from utils import setup_logging
+
+log = logging.getLogger("pipeline")
+
+OUTCOMES = ("processed", "skipped", "failed", "not_started")
+
+
+def init_transform_worker():
+	# worker processes are spawned (not forked from a process full of threads and open connections); give them the same logging
+	setup_logging("processors")
+
+
+class PipelineItem:
+	cv: object  # HelmChartVersion
+	stage: str | None  # last journaled stage reached; see journal.py
+	filename: str | None
+	queued_at: float  # when it was put on its current stage's queue
+
+	def __init__(self, cv):
+		self.cv = cv
+		self.stage = None
+		self.filename = None
+		self.queued_at = time.monotonic()
+
+
+class ChartCompletion:
+	# Reports each chart once all of its versions are done, in plan order: a chart is only reported after every chart
+	# planned before it, so the log reads like the serial runs did, even though versions finish out of order.
+	remaining: dict[str, int]
+	outcomes: dict[str, dict[str, int]]
+	order: list[str]
+
+	def __init__(self, chart_versions: list):
+		self.remaining = {}
+		self.outcomes = {}
+		for cv in chart_versions:
+			key = cv.chart.name_in_helm
+			self.remaining[key] = self.remaining.get(key, 0) + 1
+			self.outcomes.setdefault(key, dict.fromkeys(OUTCOMES, 0))
+		self.order = list(self.remaining)  # first appearance in the plan
+		self.next = 0
+
+	def done(self, cv, outcome: str):
+		key = cv.chart.name_in_helm
+		self.remaining[key] -= 1
+		self.outcomes[key][outcome] += 1
+		while self.next < len(self.order) and self.remaining[self.order[self.next]] == 0:
+			key = self.order[self.next]
+			self.next += 1
+			counts = ", ".join(f"{k}={v}" for k, v in self.outcomes[key].items() if v)
+			log.info(f"Chart '{key}' complete: {counts}")
+
+
+class Pipeline:
+	# Staged alternative to Scheduler.run(): fetch -> transform -> push, each stage with its own concurrency, connected by
+	# bounded asyncio queues. A slow upstream no longer holds push capacity hostage (and vice-versa), and CPU-bound
+	# processor repacking runs in a process pool instead of competing with network waits for the GIL.
+	# Backpressure: a full queue blocks the stage feeding it, so at most downloads + queue_size + transforms + queue_size +
+	# pushes versions have a temp dir on disk at any time, however big the repo.
+	# Blocking work (fetch, push, record) still goes through the shared limiters, on a thread pool sized for both stages.
+	# On a graceful shutdown request, only pushes already started may finish (until the drain deadline); everything
+	# else stops where it is, its progress kept in the work journal for the next run.
+	downloads: int
+	transforms: int
+	pushes: int
+	queue_size: int
+	deadline: float | None
+
+	def __init__(self, max_workers: int, time_budget_seconds: float | None = None):
+		self.downloads = int(os.getenv("PIPELINE_DOWNLOADS", max_workers))
+		self.transforms = int(os.getenv("PIPELINE_TRANSFORMS", multiprocessing.cpu_count()))
+		self.pushes = int(os.getenv("PIPELINE_PUSHES", max_workers))
+		self.queue_size = int(os.getenv("PIPELINE_QUEUE_SIZE", max_workers))
+		self.deadline = (time.monotonic() + time_budget_seconds) if time_budget_seconds else None
+		self.budget_warned = False
+
+	def budget_exhausted(self) -> bool:
+		if (self.deadline is None or time.monotonic() < self.deadline) and not graceful_shutdown().requested():
+			return False
+		if not self.budget_warned:
+			self.budget_warned = True
+			log.warning("Time budget exhausted or shutdown requested; not starting remaining chart versions, draining the ones in flight")
+		return True
+
+	async def run_blocking(self, fn, *args):
+		return await self.loop.run_in_executor(self.executor, fn, *args)
+
+	def run(self, chart_versions: list) -> ScheduleResult:
+		return asyncio.run(self.run_async(chart_versions))
+
+	async def run_async(self, chart_versions: list) -> ScheduleResult:
+		self.result = ScheduleResult()
+		self.completion = ChartCompletion(chart_versions)
+		self.loop = asyncio.get_running_loop()
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.downloads + self.pushes, thread_name_prefix="Pipeline")
+		self.process_pool = None
+		if any(cv.repo.processors for cv in chart_versions):
+			context = multiprocessing.get_context("spawn")
+			self.process_pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.transforms, mp_context=context, initializer=init_transform_worker)
+		log.info(f"Pipelining {len(chart_versions)} chart versions: {self.downloads} downloads, {self.transforms} transforms, {self.pushes} pushes, queues of {self.queue_size}")
+
+		to_fetch = asyncio.Queue(maxsize=self.downloads)
+		to_transform = asyncio.Queue(maxsize=self.queue_size)
+		to_push = asyncio.Queue(maxsize=self.queue_size)
+		stages = asyncio.gather(
+			self.feed(chart_versions, to_fetch),
+			self.stage(self.downloads, to_fetch, to_transform, self.transforms, self.fetch),
+			self.stage(self.transforms, to_transform, to_push, self.pushes, self.transform),
+			self.stage(self.pushes, to_push, None, 0, self.push),
+		)
+		abandoned = False
+		try:
+			while not stages.done():
+				await asyncio.wait([stages], timeout=1)
+				if not stages.done() and graceful_shutdown().deadline_passed():
+					log.warning("Shutdown drain deadline passed; abandoning the chart versions still in flight")
+					stages.cancel()
+					abandoned = True
+					try:
+						await stages  # returns right away: the threads are not waited for, only the coroutines awaiting them
+					except asyncio.CancelledError:
+						pass
+					break
+			if not abandoned:
+				stages.result()  # re-raise unexpected errors
+		finally:
+			self.executor.shutdown(wait=not abandoned, cancel_futures=True)
+			if self.process_pool is not None:
+				self.process_pool.shutdown(wait=not abandoned, cancel_futures=True)
+
+		result = self.result
+		finished = {id(cv) for cv in result.processed + result.skipped + result.not_started} | {id(cv) for cv, _ in result.failed}
+		for cv in chart_versions:
+			if id(cv) not in finished:  # abandoned in flight; the journal has its progress
+				self.finish(PipelineItem(cv), "not_started")
+		log.info(f"Pipelined run done: {len(result.processed)} processed, {len(result.skipped)} skipped, {len(result.failed)} failed, {len(result.not_started)} not started")
+		return result
+
+	async def feed(self, chart_versions: list, outbox: asyncio.Queue):
+		for i, cv in enumerate(chart_versions):
+			if self.budget_exhausted():
+				for left in chart_versions[i:]:
+					self.finish(PipelineItem(left), "not_started")
+				break
+			await outbox.put(PipelineItem(cv))  # blocks while the fetch stage is saturated
+		for _ in range(self.downloads):
+			await outbox.put(None)
+
+	async def stage(self, workers: int, inbox: asyncio.Queue, outbox: asyncio.Queue | None, next_workers: int, step):
+		# runs step() on items from inbox with `workers` concurrent coroutines; forwards the item if step() returns True.
+		# None is the end-of-stream marker: once all of this stage's workers got one, pass one on to each next-stage worker
+		async def worker():
+			while (item := await inbox.get()) is not None:
+				run_timings().add_seconds(item.cv, "queue_wait", time.monotonic() - item.queued_at)
+				try:
+					forward = await step(item)
+				except Exception as e:
+					log.error(f"Failed processing target '{item.cv.oci_target_version}': {e}", exc_info=e)
+					self.result.failed.append((item.cv, e))
+					self.finish(item, "failed")
+					continue
+				if forward:
+					item.queued_at = time.monotonic()
+					await outbox.put(item)
+
+		await asyncio.gather(*(worker() for _ in range(workers)))
+		for _ in range(next_workers):
+			await outbox.put(None)
+
+	def finish(self, item: PipelineItem, outcome: str):
+		if outcome != "failed":
+			getattr(self.result, outcome).append(item.cv)
+		self.completion.done(item.cv, outcome)
+
+	async def fetch(self, item: PipelineItem) -> bool:
+		cv = item.cv
+		if self.budget_exhausted():  # queued before the budget ran out, but not started yet
+			self.finish(item, "not_started")
+			return False
+		if cv.already_processed():
+			self.finish(item, "skipped")
+			return False
+		log.info(f"Processing target '{cv.oci_target_version}'")
+		item.stage, item.filename = await self.run_blocking(cv.resume)
+		if item.stage is None:
+			item.filename = await self.run_blocking(cv.fetch_stage, cv.repo.journal.work_dir(cv.state_key))
+			await self.run_blocking(cv.repo.journal.log, cv.state_key, FETCHED, item.filename)
+			item.stage = FETCHED
+		return True
+
+	async def transform(self, item: PipelineItem) -> bool:
+		processor_names = [p.name for p in item.cv.repo.processors]
+		if not processor_names or item.stage != FETCHED:
+			return True
+		if graceful_shutdown().requested():
+			self.finish(item, "not_started")
+			return False
+		log.info(f"Running processors '{', '.join(processor_names)}' for chart '{item.cv.chart.name_in_helm}' version '{item.cv.version}'")
+		start = time.monotonic()
+		changed = await self.loop.run_in_executor(self.process_pool, rewrite_chart_tgz_named, item.filename, processor_names)
+		run_timings().add_seconds(item.cv, "transform", time.monotonic() - start)
+		log.info(f"Processors {'rewrote' if changed else 'made no changes to'} '{item.filename}'")
+		await self.run_blocking(item.cv.repo.journal.log, item.cv.state_key, TRANSFORMED, item.filename)
+		item.stage = TRANSFORMED
+		return True
+
+	async def push(self, item: PipelineItem) -> bool:
+		cv = item.cv
+		if item.stage in (FETCHED, TRANSFORMED):
+			if graceful_shutdown().requested():  # not started yet; only pushes already under way get drained
+				self.finish(item, "not_started")
+				return False
+			await self.run_blocking(cv.push_stage, item.filename)
+			await self.run_blocking(cv.repo.journal.log, cv.state_key, PUSHED)
+			item.stage = PUSHED
+		await self.run_blocking(cv.record_stage)
+		log.info(f"Processed target '{cv.oci_target_version}' OK")
+		self.finish(item, "processed")
+		return False
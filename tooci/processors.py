@@ -0,0 +1,155 @@
+import concurrent.futures
+import difflib
+import gzip
+import io
+import logging
+import os
+import struct
+import tarfile
+import threading
+import zlib
+from dataclasses import dataclass
+from typing import Callable
+
+log = logging.getLogger("processors")
+
+# Repacked charts are deterministic: same members + same settings = same bytes, so same digest (and blob dedup/mounts)
+GZIP_LEVEL = int(os.environ.get("REPACK_GZIP_LEVEL", "6"))  # what `helm package` (Go's DefaultCompression) uses
+GZIP_THREADS = int(os.environ.get("REPACK_GZIP_THREADS", "1"))  # >1: block-parallel (pigz-style) gzip on a thread pool
+GZIP_BLOCK_BYTES = 128 * 1024  # pigz's default block size
+GZIP_DICT_BYTES = 32 * 1024  # deflate window; each block is primed with the tail of the previous one, like pigz
+REPACK_MTIME = int(os.environ.get("SOURCE_DATE_EPOCH", "0"))
+
+singleton_gzip_pool: concurrent.futures.ThreadPoolExecutor | None = None
+singleton_gzip_pool_lock = threading.Lock()
+
+
+@dataclass(frozen=True)
+class MemberProcessor:
+	name: str  # as used in repos.yaml 'processors:'
+	matches: Callable[[str], bool]  # tar member name -> should transform be applied?
+	transform: Callable[[str, bytes], bytes]  # (tar member name, content) -> new content
+	required: bool  # fail if no member of the chart matches
+
+
+# All known processors, by name; populated by the @member_processor decorator below
+PROCESSORS: dict[str, MemberProcessor] = {}
+
+
+def member_processor(name: str, matches: Callable[[str], bool], required: bool = False):
+	def register(transform: Callable[[str, bytes], bytes]):
+		PROCESSORS[name] = MemberProcessor(name=name, matches=matches, transform=transform, required=required)
+		return transform
+
+	return register
+
+
+def get_processors(names: list[str]) -> list[MemberProcessor]:
+	unknown = [name for name in names if name not in PROCESSORS]
+	if unknown:
+		raise Exception(f"Processor(s) {unknown} not found; known processors: {sorted(PROCESSORS)}")
+	return [PROCESSORS[name] for name in names]
+
+
+def is_values_yaml(member_name: str) -> bool:
+	return os.path.basename(member_name) == "values.yaml"
+
+
+# Main bit of hackery; plain byte replaces (not YAML parsing), as some old charts have not-really-YAML values.yaml files
+@member_processor("bitnami_legacy_process", matches=is_values_yaml, required=True)
+def bitnami_legacy_process(member_name: str, content: bytes) -> bytes:
+	content = content.replace(b"repository: bitnami/", b"repository: bitnamilegacy/")
+	content = content.replace(b"allowInsecureImages: false", b"allowInsecureImages: true")
+	return content
+
+
+def log_member_diff(member_name: str, before: bytes, after: bytes):
+	diff = difflib.unified_diff(
+		before.decode("utf-8", errors="replace").splitlines(), after.decode("utf-8", errors="replace").splitlines(),
+		fromfile=f"a/{member_name}", tofile=f"b/{member_name}", n=1, lineterm="")
+	log.info(f"Changes to '{member_name}':\n" + "\n".join(diff))
+
+
+def gzip_pool() -> concurrent.futures.ThreadPoolExecutor:
+	global singleton_gzip_pool
+	with singleton_gzip_pool_lock:
+		if singleton_gzip_pool is None:
+			singleton_gzip_pool = concurrent.futures.ThreadPoolExecutor(max_workers=GZIP_THREADS, thread_name_prefix="Gzip")
+		return singleton_gzip_pool
+
+
+def deflate_block(data: memoryview, start: int, level: int) -> bytes:
+	# one block of a pigz-style stream: raw deflate, primed with the previous 32KiB, ending byte-aligned (sync flush)
+	# so blocks can be concatenated; only the last one is a final block. zlib releases the GIL while compressing.
+	end = min(start + GZIP_BLOCK_BYTES, len(data))
+	if start == 0:
+		compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+	else:
+		compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=data[max(0, start - GZIP_DICT_BYTES):start])
+	return compressor.compress(data[start:end]) + compressor.flush(zlib.Z_FINISH if end == len(data) else zlib.Z_SYNC_FLUSH)
+
+
+def gzip_bytes(data: bytes, level: int = GZIP_LEVEL, threads: int = GZIP_THREADS) -> bytes:
+	# gzip with a fixed header (mtime 0, no file name): the output only depends on data, level and mode.
+	# Block-parallel mode produces one regular gzip member (what pigz does), readable by any gunzip, helm included;
+	# its bytes depend on the block size, not on the number of threads.
+	if threads <= 1 or len(data) <= GZIP_BLOCK_BYTES:
+		return gzip.compress(data, compresslevel=level, mtime=0)
+	view = memoryview(data)
+	blocks = gzip_pool().map(lambda start: deflate_block(view, start, level), range(0, len(data), GZIP_BLOCK_BYTES))
+	extra_flags = 2 if level == 9 else (4 if level == 1 else 0)
+	header = b"\x1f\x8b\x08\x00" + struct.pack("<L", 0) + bytes([extra_flags, 255])
+	return header + b"".join(blocks) + struct.pack("<LL", zlib.crc32(data), len(data) & 0xffffffff)
+
+
+def normalize_member(member: tarfile.TarInfo) -> tarfile.TarInfo:
+	# nothing of the machine or moment of the repack ends up in the archive
+	member.mtime = REPACK_MTIME
+	member.uid = member.gid = 0
+	member.uname = member.gname = ""
+	member.pax_headers = {}  # atime/ctime/sub-second mtimes from the original; long names get a fresh one
+	return member
+
+
+def rewrite_chart_tgz(input_tgz: str, output_tgz: str, processors: list[MemberProcessor], level: int = GZIP_LEVEL, threads: int = GZIP_THREADS) -> bool:
+	# Streams input_tgz member by member; matching members are rewritten in memory (no extraction to disk). Returns
+	# False (and writes nothing) if no member changed, so the caller can keep the original bytes and skip recompression
+	# entirely. Otherwise repacks deterministically: members sorted by name, fixed mtime/owner, fixed gzip header.
+	matched: set[str] = set()
+	changed = False
+	members: list[tuple[tarfile.TarInfo, bytes | None]] = []  # charts are small; sorting needs them all anyway
+	with tarfile.open(input_tgz, "r|gz") as tar_in:
+		for member in tar_in:
+			content = tar_in.extractfile(member).read() if member.isfile() else None
+			for processor in [p for p in processors if member.isfile() and p.matches(member.name)]:
+				matched.add(processor.name)
+				after = processor.transform(member.name, content)
+				if after != content:
+					changed = True
+					log_member_diff(member.name, content, after)
+				content = after
+			members.append((member, content))
+
+	missing = [p.name for p in processors if p.required and p.name not in matched]
+	if missing:
+		raise Exception(f"Processor(s) {missing} found no matching members in '{input_tgz}'")
+	if not changed:
+		return False
+
+	tar_bytes = io.BytesIO()
+	with tarfile.open(fileobj=tar_bytes, mode="w", format=tarfile.PAX_FORMAT) as tar_out:
+		for member, content in sorted(members, key=lambda m: m[0].name):
+			normalize_member(member)
+			if content is not None:
+				member.size = len(content)
+			tar_out.addfile(member, io.BytesIO(content) if content is not None else None)
+	with open(f"{output_tgz}.partial", "wb") as f:
+		f.write(gzip_bytes(tar_bytes.getbuffer(), level, threads))
+	os.replace(f"{output_tgz}.partial", output_tgz)
+	return True
+
+
+def rewrite_chart_tgz_named(chart_tgz: str, processor_names: list[str]) -> bool:
+	# In-place rewrite for worker processes (see pipeline.py): processors are looked up by name, so only strings cross
+	# the process boundary
+	return rewrite_chart_tgz(chart_tgz, chart_tgz, get_processors(processor_names))
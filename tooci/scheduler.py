@@ -0,0 +1,173 @@
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from timings import run_timings
+
+log = logging.getLogger("scheduler")
+
+singleton_shutdown: "GracefulShutdown | None" = None
+singleton_shutdown_lock = threading.Lock()
+
+
+def default_max_workers() -> int:
+	# double the number of cpu cores, but not more than 16; MAX_WORKERS overrides
+	max_workers = 16 if ((multiprocessing.cpu_count() * 2) > 16) else (multiprocessing.cpu_count() * 2)
+	return int(os.getenv("MAX_WORKERS", max_workers))
+
+
+class HostLimits:
+	# Caps concurrent operations per host (an upstream chart repo host, or an OCI registry), across all repos/threads
+	name: str
+	per_host: int
+	semaphores: dict[str, threading.BoundedSemaphore]
+
+	def __init__(self, name: str, per_host: int):
+		self.name = name
+		self.per_host = per_host
+		self.semaphores = {}
+		self.lock = threading.Lock()
+
+	@contextmanager
+	def slot(self, host: str):
+		with self.lock:
+			if host not in self.semaphores:
+				self.semaphores[host] = threading.BoundedSemaphore(self.per_host)
+			semaphore = self.semaphores[host]
+		with semaphore:
+			yield
+
+
+class ShutdownRequested(Exception):
+	# raised between stages of a version when a graceful shutdown was requested; the version counts as not started
+	pass
+
+
+class GracefulShutdown:
+	# Set from the SIGTERM/SIGINT handler (see cli.py): no new fetches or pushes are started; pushes already in flight
+	# get until the deadline to finish and be recorded, then the schedulers stop waiting. Unfinished work is in the
+	# journal (see journal.py) for the next run.
+	requested_at: float | None
+	deadline: float | None
+
+	def __init__(self):
+		self.requested_at = None
+		self.deadline = None
+
+	def request(self, drain_seconds: float):
+		if self.requested_at is None:
+			self.requested_at = time.monotonic()
+			self.deadline = self.requested_at + drain_seconds
+
+	def requested(self) -> bool:
+		return self.requested_at is not None
+
+	def deadline_passed(self) -> bool:
+		return self.deadline is not None and time.monotonic() >= self.deadline
+
+
+def graceful_shutdown() -> GracefulShutdown:
+	global singleton_shutdown
+	with singleton_shutdown_lock:
+		if singleton_shutdown is None:
+			singleton_shutdown = GracefulShutdown()
+		return singleton_shutdown
+
+
+class ScheduleResult:
+	processed: list  # [HelmChartVersion] pushed in this run
+	skipped: list  # [HelmChartVersion] found already processed
+	failed: list  # [(HelmChartVersion, Exception)]
+	not_started: list  # [HelmChartVersion] left out because the time budget ran out
+
+	def __init__(self):
+		self.processed = []
+		self.skipped = []
+		self.failed = []
+		self.not_started = []
+
+	def repo_counts(self, repo_id: str) -> dict[str, int]:
+		counts = {}
+		for kind in ("processed", "skipped", "failed", "not_started"):
+			items = getattr(self, kind)
+			counts[kind] = len([x for x in items if (x[0] if kind == "failed" else x).repo.repo_id == repo_id])
+		return counts
+
+	def repo_complete(self, repo_id: str) -> bool:
+		counts = self.repo_counts(repo_id)
+		return counts["failed"] == 0 and counts["not_started"] == 0
+
+
+class Scheduler:
+	# Runs HelmChartVersion.process() for versions of one or many repos on one shared thread pool.
+	# Submission is incremental (at most max_workers in flight), so a time budget can stop cleanly: no new work is started once
+	# the budget is spent, in-flight versions finish and get recorded, the rest is reported as not started.
+	max_workers: int
+	deadline: float | None
+
+	def __init__(self, max_workers: int, time_budget_seconds: float | None = None):
+		self.max_workers = max_workers
+		self.deadline = (time.monotonic() + time_budget_seconds) if time_budget_seconds else None
+
+	@staticmethod
+	def fair_order(pending_by_repo: dict[str, list]) -> list:
+		# largest backlog first, then round-robin across repos: the biggest repo starts right away, while small repos
+		# get an equal share of every round and finish early instead of queueing behind thousands of versions
+		queues = sorted(pending_by_repo.values(), key=len, reverse=True)
+		ordered = []
+		for i in range(max((len(q) for q in queues), default=0)):
+			ordered.extend(q[i] for q in queues if i < len(q))
+		return ordered
+
+	def budget_exhausted(self) -> bool:
+		return (self.deadline is not None and time.monotonic() >= self.deadline) or graceful_shutdown().requested()
+
+	def process_one(self, cv, queued_at: float) -> bool:
+		run_timings().add_seconds(cv, "queue_wait", time.monotonic() - queued_at)
+		log.info(f"Processing target '{cv.oci_target_version}'")
+		ret = cv.process()
+		log.info(f"Processed target '{cv.oci_target_version}' OK")
+		return ret
+
+	def run(self, chart_versions: list) -> ScheduleResult:
+		result = ScheduleResult()
+		queue = list(reversed(chart_versions))  # pop() from the end
+		queued_at = time.monotonic()
+		log.info(f"Scheduling {len(chart_versions)} chart versions on {self.max_workers} workers")
+
+		def collect(future: concurrent.futures.Future, cv):
+			try:
+				(result.processed if future.result() else result.skipped).append(cv)
+			except ShutdownRequested:
+				result.not_started.append(cv)
+			except Exception as e:
+				log.exception(f"Failed processing target '{cv.oci_target_version}'")
+				result.failed.append((cv, e))
+
+		executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
+		in_flight: dict[concurrent.futures.Future, object] = {}
+		while queue or in_flight:
+			while queue and len(in_flight) < self.max_workers and not self.budget_exhausted():
+				cv = queue.pop()
+				in_flight[executor.submit(self.process_one, cv, queued_at)] = cv
+			if queue and self.budget_exhausted():
+				log.warning(f"Time budget exhausted or shutdown requested; not starting {len(queue)} remaining chart versions, draining {len(in_flight)} in flight")
+				result.not_started.extend(reversed(queue))
+				queue = []
+			if not in_flight:
+				break
+			if graceful_shutdown().deadline_passed():
+				log.warning(f"Shutdown drain deadline passed; giving up on {len(in_flight)} chart versions in flight")
+				result.not_started.extend(in_flight.values())
+				break
+			done, _ = concurrent.futures.wait(in_flight, timeout=1, return_when=concurrent.futures.FIRST_COMPLETED)
+			for future in done:
+				collect(future, in_flight.pop(future))
+		executor.shutdown(wait=not in_flight, cancel_futures=True)
+
+		log.info(f"Scheduled run done: {len(result.processed)} processed, {len(result.skipped)} skipped, {len(result.failed)} failed, {len(result.not_started)} not started")
+		return result
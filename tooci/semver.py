@@ -0,0 +1,84 @@
+import functools
+import logging
+import re
+
+log = logging.getLogger("semver")
+
+# SemVer 2.0.0, loosened the way helm (Masterminds/semver) is: optional leading "v", optional minor/patch
+RE_SEMVER = re.compile(
+	r"^v?(?P<major>0|[1-9]\d*)(?:\.(?P<minor>0|[1-9]\d*))?(?:\.(?P<patch>0|[1-9]\d*))?"
+	r"(?:-(?P<prerelease>[0-9A-Za-z.-]+))?(?:\+(?P<build>[0-9A-Za-z.-]+))?$"
+)
+RE_CONSTRAINT = re.compile(r"^(?P<op>>=|<=|!=|>|<|=|\^|~)?\s*(?P<version>\S+)$")
+RE_CONSTRAINT_PART = re.compile(r"(?:(?:>=|<=|!=|>|<|=|\^|~)\s*)?[^\s,]+")  # an operator goes with the version after it, spaced or not
+
+
+@functools.lru_cache(maxsize=None)
+def version_key(version: str) -> tuple:
+	# Sort key implementing SemVer precedence: release > its prereleases; prerelease identifiers compared one by one,
+	# numeric ones numerically and below alphanumeric ones; a shorter prefix sorts first. Build metadata is only a
+	# tie-breaker, for a stable order. Unparseable versions sort before all valid ones, among themselves by string.
+	# Cached: the same version strings are compared over and over when sorting/filtering big indexes.
+	m = RE_SEMVER.match(version.strip())
+	if not m:
+		log.debug(f"Not a semantic version: '{version}'")
+		return (0, (), (), version)
+	release = (int(m["major"]), int(m["minor"] or 0), int(m["patch"] or 0))
+	if m["prerelease"] is None:
+		prerelease = ((2,),)  # sorts after any prerelease tuple, which all start with 0 or 1
+	else:
+		prerelease = tuple((0, int(part), "") if part.isdigit() else (1, 0, part) for part in m["prerelease"].split("."))
+	return (1, release, prerelease, m["build"] or "")
+
+
+def is_prerelease(version: str) -> bool:
+	key = version_key(version)
+	return key[0] == 1 and key[2] != ((2,),)
+
+
+def is_valid(version: str) -> bool:
+	return version_key(version)[0] == 1
+
+
+def release_key(version: str) -> tuple:
+	# major.minor.patch only, for range comparisons: "<2.0.0" should exclude 2.0.0-rc.1 as well
+	return version_key(version)[1]
+
+
+def satisfies(version: str, constraint: str) -> bool:
+	# Version ranges, as in repos.yaml 'version-range': comparisons (>=, >, <=, <, =, !=, ^, ~) separated by spaces or
+	# commas all have to hold; alternatives separated by "||". Eg: ">=1.2.0 <3", "^2.1 || ~1.9.4", ">= 1.2, < 2".
+	if not is_valid(version):
+		return False
+	return any(all(satisfies_one(version, part) for part in RE_CONSTRAINT_PART.findall(alternative))
+		for alternative in constraint.split("||"))
+
+
+@functools.lru_cache(maxsize=None)
+def satisfies_one(version: str, constraint: str) -> bool:
+	m = RE_CONSTRAINT.match(constraint)
+	if not m or not is_valid(m["version"]):
+		raise Exception(f"Invalid version constraint '{constraint}'")
+	op, bound = m["op"] or "=", m["version"]
+	key, bound_key = version_key(version), version_key(bound)
+	if op == "=":
+		return key[:3] == bound_key[:3]
+	if op == "!=":
+		return key[:3] != bound_key[:3]
+	if op == ">=":
+		return key >= bound_key
+	if op == ">":
+		return key > bound_key
+	if op == "<=":
+		return key <= bound_key
+	if op == "<":
+		# a prerelease of the bound is not "< bound" in the usual sense of a range (">=1 <2" shouldn't take 2.0.0-rc.1)
+		return key < bound_key and release_key(version) < release_key(bound)
+	major, minor, patch = bound_key[1]
+	parts = len(re.findall(r"\d+", bound.split("-")[0].split("+")[0]))
+	if op == "~":  # ~1.2.3: >=1.2.3 <1.3.0; ~1: >=1.0.0 <2.0.0
+		upper = (major + 1, 0, 0) if parts == 1 else (major, minor + 1, 0)
+	else:  # ^1.2.3: >=1.2.3 <2.0.0; ^0.2.3: <0.3.0; ^0.0.3: <0.0.4
+		upper = (major + 1, 0, 0) if major > 0 else ((0, minor + 1, 0) if minor > 0 or parts < 3 else (0, 0, patch + 1))
+	return key >= bound_key and release_key(version) < upper
+
@@ -0,0 +1,151 @@
+import glob
+import hashlib
+import json
+import logging
+import os
+import threading
+from typing import Callable
+
+from utils import atomic_write
+
+log = logging.getLogger("state")
+
+
+def record_key(record: dict) -> str:
+	# "<chart>--<version>", same as the legacy info/<repo-id>/<chart>--<version>.json file names
+	chart_name = record["chart.name_target"].split("/", 1)[1]
+	return f"{chart_name}--{record['version']}"
+
+
+class ProcessedState:
+	# Processed-version state of one repo: info/<repo-id>.jsonl, one JSON record per line, sorted by key when compacted.
+	# Loaded once into a dict for O(1) membership; new records are appended (under a lock) as soon as they're pushed.
+	# Sharded runs write to their own segment, info/<repo-id>.<segment>.jsonl, so concurrent shards never touch the
+	# same file; an unsharded run folds all segments back into the main file when compacting.
+	repo_id: str
+	main_file: str
+	state_file: str  # the file this instance appends to: main_file, or its segment
+	segment: str | None
+	legacy_dir: str  # info/<repo-id>/<chart>--<version>.json, the old one-file-per-version layout
+	records: dict[str, dict | None]  # key -> record; None for versions only known from a legacy file name
+	own_records: dict[str, dict]  # records in this instance's segment
+	on_add: Callable[[], None] | None  # called after each new record is appended, eg: StateCheckpointer.added
+
+	def __init__(self, base_path: str, repo_id: str, segment: str | None = None):
+		self.repo_id = repo_id
+		self.segment = segment
+		self.main_file = f"{base_path}/info/{repo_id}.jsonl"
+		self.state_file = self.main_file if segment is None else f"{base_path}/info/{repo_id}.{segment}.jsonl"
+		self.legacy_dir = f"{base_path}/info/{repo_id}"
+		self.records = {}
+		self.own_records = {}
+		self.on_add = None
+		self.lock = threading.Lock()
+		self.load()
+
+	def segment_files(self) -> list[str]:
+		return sorted(glob.glob(f"{glob.escape(self.main_file[:-len('.jsonl')])}.*.jsonl"))
+
+	def load(self):
+		for state_file in [self.main_file] + self.segment_files():
+			if not os.path.exists(state_file):
+				continue
+			with open(state_file) as f:
+				for line in f:
+					if line.strip():
+						record = json.loads(line)
+						self.records[record_key(record)] = record
+						if state_file == self.state_file and self.segment is not None:
+							self.own_records[record_key(record)] = record
+		if os.path.isdir(self.legacy_dir):
+			# not migrated yet; a single listdir, no per-version stat()
+			for file_name in os.listdir(self.legacy_dir):
+				if file_name.endswith(".json"):
+					self.records.setdefault(file_name[:-len(".json")], None)
+		log.info(f"Loaded processed state for repo '{self.repo_id}': {len(self.records)} versions")
+
+	def __contains__(self, key: str) -> bool:
+		return key in self.records
+
+	def __len__(self) -> int:
+		return len(self.records)
+
+	def fingerprint(self, key_filter: Callable[[str], bool] | None = None) -> str:
+		# of the recorded version keys (optionally only some), not of the file: the same whether records sit in the main
+		# file or a segment, and however the file got there (checkpoint + commit-state, or a plain commit)
+		with self.lock:
+			keys = sorted(key for key in self.records if key_filter is None or key_filter(key))
+		return hashlib.sha256("\n".join(keys).encode("utf-8")).hexdigest()
+
+	def add(self, record: dict):
+		key = record_key(record)
+		line = json.dumps(record, separators=(",", ":")) + "\n"
+		with self.lock:
+			os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
+			with open(self.state_file, "a") as f:
+				f.write(line)
+			self.records[key] = record
+			if self.segment is not None:
+				self.own_records[key] = record
+		if self.on_add is not None:
+			self.on_add()
+
+	def merge(self, records: list[dict]) -> int:
+		# fold in records from elsewhere (see checkpoint.commit_state); a key already recorded keeps its record, so the
+		# result doesn't depend on how often, or in which order, the same records are merged. Returns how many were new.
+		merged = 0
+		with self.lock:
+			for record in records:
+				key = record_key(record)
+				if self.records.get(key) is None:
+					self.records[key] = record
+					merged += 1
+		return merged
+
+	def read_state_file(self) -> bytes:
+		# consistent copy of the file this instance writes: never half a line, never mid-compaction
+		with self.lock:
+			if not os.path.exists(self.state_file):
+				return b""
+			with open(self.state_file, "rb") as f:
+				return f.read()
+
+	def write_sorted(self) -> int:
+		# caller holds self.lock; records only known from legacy file names are not written
+		records = self.records if self.segment is None else self.own_records
+		lines = [json.dumps(records[key], separators=(",", ":")) + "\n" for key in sorted(records) if records[key] is not None]
+		atomic_write(self.state_file, "".join(lines).encode("utf-8"))
+		return len(lines)
+
+	def compact(self, force: bool = False):
+		# rewrite sorted and de-duplicated; keeps diffs in git small and stable. force: write even if there's no file yet (merged records)
+		with self.lock:
+			segment_files = self.segment_files() if self.segment is None else []
+			if not force and not os.path.exists(self.state_file) and not segment_files:
+				return
+			written = self.write_sorted()
+			for segment_file in segment_files:  # folded into the main file
+				os.remove(segment_file)
+		log.info(f"Compacted '{self.state_file}' to {written} records")
+
+	def migrate_legacy(self, delete_legacy: bool = True) -> int:
+		# one-time: fold info/<repo-id>/*.json into info/<repo-id>.jsonl
+		if not os.path.isdir(self.legacy_dir):
+			return 0
+		legacy_files = sorted(f for f in os.listdir(self.legacy_dir) if f.endswith(".json"))
+		migrated = 0
+		with self.lock:
+			for file_name in legacy_files:
+				with open(f"{self.legacy_dir}/{file_name}") as f:
+					record = json.load(f)
+				if self.records.get(record_key(record)) is None:
+					self.records[record_key(record)] = record
+					migrated += 1
+			self.write_sorted()
+		log.info(f"Migrated {migrated} legacy info files of repo '{self.repo_id}' into '{self.state_file}'")
+		if delete_legacy:
+			for file_name in legacy_files:
+				os.remove(f"{self.legacy_dir}/{file_name}")
+			if not os.listdir(self.legacy_dir):
+				os.rmdir(self.legacy_dir)
+		return migrated
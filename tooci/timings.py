@@ -0,0 +1,198 @@
+import json
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+log = logging.getLogger("timings")
+
+singleton_run_timings: "RunTimings | None" = None
+singleton_run_timings_lock = threading.Lock()
+
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(values: list[float], p: int) -> float:
+	# nearest-rank; values must be sorted
+	if not values:
+		return 0.0
+	return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def version_id(cv) -> tuple[str, str]:
+	return cv.repo.repo_id, cv.state_key
+
+
+class RunTimings:
+	# Collects where a run spends its time: per chart version, seconds per stage (fetch, transform, push, record, queue
+	# wait, retry sleeps, shell commands...) and counters (bytes, retries); plus repo-level operations (index fetches).
+	# Code running on behalf of a version (shell(), http_download(), limiter retries) finds it via a thread-local set
+	# by stage(), so the low-level helpers don't need a HelmChartVersion passed around.
+	versions: dict[tuple[str, str], dict[str, dict[str, float]]]  # (repo id, state key) -> {"seconds": {}, "counts": {}}
+	operations: dict[str, list[float]]  # eg: "index t1" -> [seconds, ...]
+
+	def __init__(self):
+		self.started = time.time()
+		self.started_monotonic = time.monotonic()
+		self.versions = {}
+		self.operations = {}
+		self.lock = threading.Lock()
+		self.local = threading.local()
+
+	def current(self):
+		return getattr(self.local, "current", None)
+
+	def version(self, cv) -> dict[str, dict[str, float]]:
+		return self.versions.setdefault(version_id(cv), {"seconds": {}, "counts": {}})
+
+	def add_seconds(self, cv, name: str, seconds: float):
+		with self.lock:
+			seconds_by_name = self.version(cv)["seconds"]
+			seconds_by_name[name] = seconds_by_name.get(name, 0.0) + seconds
+
+	def count(self, cv, name: str, value: float = 1):
+		with self.lock:
+			counts = self.version(cv)["counts"]
+			counts[name] = counts.get(name, 0) + value
+
+	def count_current(self, name: str, value: float = 1):
+		# attribute to the version the calling thread is working on, if any
+		if (cv := self.current()) is not None:
+			self.count(cv, name, value)
+
+	def add_seconds_current(self, name: str, seconds: float):
+		if (cv := self.current()) is not None:
+			self.add_seconds(cv, name, seconds)
+
+	@contextmanager
+	def stage(self, cv, name: str):
+		previous = self.current()
+		self.local.current = cv
+		start = time.monotonic()
+		try:
+			yield
+		finally:
+			self.add_seconds(cv, name, time.monotonic() - start)
+			self.local.current = previous
+
+	@contextmanager
+	def span(self, name: str):
+		# an operation not tied to one stage (a shell command, an index fetch); also attributed to the current version
+		start = time.monotonic()
+		try:
+			yield
+		finally:
+			elapsed = time.monotonic() - start
+			with self.lock:
+				self.operations.setdefault(name, []).append(elapsed)
+			self.add_seconds_current(name, elapsed)
+
+	def report(self, result) -> dict:
+		# result: a ScheduleResult; gives each version its outcome
+		outcomes: dict[tuple[str, str], str] = {}
+		for kind in ("processed", "skipped", "failed", "not_started"):
+			for item in getattr(result, kind):
+				outcomes[version_id(item[0] if kind == "failed" else item)] = kind
+
+		with self.lock:
+			versions = [
+				{"repo": repo_id, "version": key, "outcome": outcomes.get((repo_id, key), "unknown"), **metrics}
+				for (repo_id, key), metrics in sorted(self.versions.items())
+			]
+			operations = {name: self.stats(values) for name, values in sorted(self.operations.items())}
+
+		repos = {}
+		for repo_id in sorted({v["repo"] for v in versions} | {repo_id for repo_id, _ in outcomes}):
+			repo_versions = [v for v in versions if v["repo"] == repo_id]
+			seconds: dict[str, list[float]] = {}
+			counts: dict[str, float] = {}
+			for v in repo_versions:
+				for name, value in v["seconds"].items():
+					seconds.setdefault(name, []).append(value)
+				for name, value in v["counts"].items():
+					counts[name] = counts.get(name, 0) + value
+			outcome_counts = {}
+			for (outcome_repo, _), outcome in outcomes.items():
+				if outcome_repo == repo_id:
+					outcome_counts[outcome] = outcome_counts.get(outcome, 0) + 1
+			repos[repo_id] = {"outcomes": outcome_counts, "stages": {name: self.stats(values) for name, values in sorted(seconds.items())}, "counts": counts}
+
+		return {
+			"started": self.started,
+			"wall_seconds": time.monotonic() - self.started_monotonic,
+			"repos": repos,
+			"operations": operations,
+			"versions": versions,
+		}
+
+	@staticmethod
+	def stats(values: list[float]) -> dict[str, float]:
+		values = sorted(values)
+		stats = {"count": len(values), "total": sum(values), "max": values[-1] if values else 0.0}
+		for p in PERCENTILES:
+			stats[f"p{p}"] = percentile(values, p)
+		return stats
+
+
+def openmetrics(report: dict) -> str:
+	# OpenMetrics text exposition of the per-repo aggregates (not per version; that's what the JSON is for)
+	lines = [
+		"# TYPE tooci_stage_seconds summary",
+		"# UNIT tooci_stage_seconds seconds",
+		"# HELP tooci_stage_seconds Per chart version time spent in each stage",
+	]
+	for repo_id, repo in report["repos"].items():
+		for stage, stats in repo["stages"].items():
+			labels = f'repo="{repo_id}",stage="{stage}"'
+			for p in PERCENTILES:
+				lines.append(f'tooci_stage_seconds{{{labels},quantile="{p / 100}"}} {stats[f"p{p}"]:.6f}')
+			lines.append(f"tooci_stage_seconds_sum{{{labels}}} {stats['total']:.6f}")
+			lines.append(f"tooci_stage_seconds_count{{{labels}}} {stats['count']}")
+	lines += ["# TYPE tooci_versions counter", "# HELP tooci_versions Chart versions by outcome"]
+	for repo_id, repo in report["repos"].items():
+		for outcome, count in repo["outcomes"].items():
+			lines.append(f'tooci_versions_total{{repo="{repo_id}",outcome="{outcome}"}} {count}')
+	lines += ["# TYPE tooci_events counter", "# HELP tooci_events Bytes transferred, retries, and other per-version counters"]
+	for repo_id, repo in report["repos"].items():
+		for name, value in repo["counts"].items():
+			lines.append(f'tooci_events_total{{repo="{repo_id}",event="{name}"}} {value}')
+	lines += ["# TYPE tooci_run_seconds gauge", f"tooci_run_seconds {report['wall_seconds']:.3f}", "# EOF"]
+	return "\n".join(lines) + "\n"
+
+
+def markdown_summary(report: dict) -> str:
+	# GitHub Actions step summary: one latency percentile table per repo
+	md = [f"### tooci run: {report['wall_seconds']:.0f}s", ""]
+	for repo_id, repo in report["repos"].items():
+		outcomes = ", ".join(f"{k}: {v}" for k, v in repo["outcomes"].items())
+		md += [f"#### {repo_id} ({outcomes or 'nothing scheduled'})", ""]
+		if repo["stages"]:
+			md += ["| stage | count | p50 | p90 | p99 | max | total |", "|---|---:|---:|---:|---:|---:|---:|"]
+			for stage, s in repo["stages"].items():
+				md.append(f"| {stage} | {s['count']} | {s['p50']:.2f}s | {s['p90']:.2f}s | {s['p99']:.2f}s | {s['max']:.2f}s | {s['total']:.1f}s |")
+			md.append("")
+		if repo["counts"]:
+			md += [", ".join(f"{k}: {v:g}" for k, v in repo["counts"].items()), ""]
+	if report["operations"]:
+		md += ["#### operations", "", "| operation | count | p50 | p99 | total |", "|---|---:|---:|---:|---:|"]
+		for name, s in report["operations"].items():
+			md.append(f"| {name} | {s['count']} | {s['p50']:.2f}s | {s['p99']:.2f}s | {s['total']:.1f}s |")
+		md.append("")
+	return "\n".join(md) + "\n"
+
+
+def write_report(report: dict, report_dir: str):
+	with open(f"{report_dir}/run-report.json", "w") as f:
+		json.dump(report, f, indent=1)
+	with open(f"{report_dir}/run-report.om.txt", "w") as f:
+		f.write(openmetrics(report))
+	log.info(f"Wrote run report to '{report_dir}': {len(report['versions'])} versions, {report['wall_seconds']:.1f}s")
+
+
+def run_timings() -> RunTimings:
+	global singleton_run_timings
+	with singleton_run_timings_lock:
+		if singleton_run_timings is None:
+			singleton_run_timings = RunTimings()
+		return singleton_run_timings
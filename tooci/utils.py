@@ -1,17 +1,70 @@
 # Pay attention, work step by step, use modern (3.10+) Python syntax and features.
 
+import codecs
+import email.utils
+import hashlib
 import json
 import logging
 import os
 import string
 import subprocess
+import tempfile
+import threading
+import time
+from typing import Callable
 
+import requests
+from requests.adapters import HTTPAdapter
 from rich.console import Console
 from rich.logging import RichHandler
 
+from timings import run_timings
+
 log = logging.getLogger("utils")
 
 singleton_console: Console | None = None
+singleton_http_session: requests.Session | None = None
+singleton_http_session_lock = threading.Lock()
+
+
+class HttpError(Exception):
+	status_code: int | None
+	retry_after: float | None  # seconds, from a Retry-After header
+
+	def __init__(self, message: str, status_code: int | None = None, retry_after: float | None = None):
+		super().__init__(message)
+		self.status_code = status_code
+		self.retry_after = retry_after
+
+
+class DigestMismatchError(Exception):
+	# a download whose sha256 isn't the one index.yaml publishes; downloading again gets the same bytes, so not retryable
+	actual_sha256: str
+
+	def __init__(self, message: str, actual_sha256: str):
+		super().__init__(message)
+		self.actual_sha256 = actual_sha256
+
+
+class ShellError(Exception):
+	# a command exiting non-zero (eg: `helm push` losing its connection, or hitting `timeout`)
+	returncode: int
+
+	def __init__(self, message: str, returncode: int):
+		super().__init__(message)
+		self.returncode = returncode
+
+
+def parse_retry_after(value: str | None) -> float | None:
+	# Retry-After is either delta-seconds or an HTTP-date
+	if not value:
+		return None
+	if value.strip().isdigit():
+		return float(value.strip())
+	try:
+		return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+	except (TypeError, ValueError):
+		return None
 
 
 def set_gha_output(name, value):
@@ -26,16 +79,123 @@ def set_gha_output(name, value):
 	log.info(f"Set GHA output '{name}' to ({length} bytes) '{value}'")
 
 
-def shell(arg_list: list[string]):
-	# execute a shell command, passing the shell-escaped arg list; throw and exception if the exit code is not 0
+def add_gha_step_summary(markdown: str):
+	if os.environ.get('GITHUB_STEP_SUMMARY') is None:
+		log.debug("Environment variable GITHUB_STEP_SUMMARY is not set; not writing the step summary")
+		return
+
+	with open(os.environ['GITHUB_STEP_SUMMARY'], 'a') as fh:
+		print(markdown, file=fh)
+
+
+class ShellResult:
+	arg_list: list[str]
+	returncode: int
+	stderr_tail: str  # the last STDERR_TAIL_BYTES of stderr
+	stdout_bytes: int
+	wall_seconds: float
+	max_rss_kib: int  # peak resident set size of the child, from wait4(); Linux counts the forked parent's image too
+
+	def __init__(self, arg_list: list[str], returncode: int, stderr_tail: str, stdout_bytes: int, wall_seconds: float, max_rss_kib: int):
+		self.arg_list = arg_list
+		self.returncode = returncode
+		self.stderr_tail = stderr_tail
+		self.stdout_bytes = stdout_bytes
+		self.wall_seconds = wall_seconds
+		self.max_rss_kib = max_rss_kib
+
+
+STREAM_CHUNK_BYTES = 256 * 1024
+STDERR_TAIL_BYTES = 64 * 1024
+
+
+def shell_stream(arg_list: list[string], consumer: Callable[[bytes], None] | None = None, env: dict[str, str] | None = None) -> ShellResult:
+	# execute a command, handing its stdout to consumer chunk by chunk as it arrives; nothing is accumulated here.
+	# stderr is drained by a helper thread into a bounded tail (a chatty child can't block on a full pipe, nor grow
+	# memory); the child is reaped with wait4() for its peak RSS. The exit code is returned, not checked.
 	log.info(f"shell: {arg_list}")
-	result = subprocess.run(arg_list, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	program = os.path.basename(next((arg for arg in arg_list if arg != "timeout" and not arg.isdigit()), arg_list[0]))
+	stderr_tail = bytearray()
+
+	def drain_stderr():
+		while chunk := proc.stderr.read(STREAM_CHUNK_BYTES):
+			stderr_tail.extend(chunk)
+			if len(stderr_tail) > STDERR_TAIL_BYTES:
+				del stderr_tail[:len(stderr_tail) - STDERR_TAIL_BYTES]
+
+	stdout_bytes = 0
+	with run_timings().span(f"shell {program}"):
+		start = time.monotonic()
+		proc = subprocess.Popen(arg_list, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=0, env=env)
+		stderr_thread = threading.Thread(target=drain_stderr, name=f"{threading.current_thread().name}-stderr", daemon=True)
+		stderr_thread.start()
+		try:
+			while chunk := proc.stdout.read(STREAM_CHUNK_BYTES):  # unbuffered: whatever the pipe has, up to the chunk size
+				stdout_bytes += len(chunk)
+				if consumer is not None:
+					consumer(chunk)
+		except:
+			proc.kill()  # the consumer gave up; don't leave the child blocked on a full pipe
+			raise
+		finally:
+			proc.stdout.close()
+			stderr_thread.join()
+			proc.stderr.close()
+			_, status, rusage = os.wait4(proc.pid, 0)
+			proc.returncode = os.waitstatus_to_exitcode(status)  # reaped here; keeps Popen from trying again
+		wall_seconds = time.monotonic() - start
+
+	result = ShellResult(arg_list, proc.returncode, stderr_tail.decode("utf-8", errors="replace"), stdout_bytes, wall_seconds, rusage.ru_maxrss)
+	log.info(f"shell: {program} exited {result.returncode} in {wall_seconds:.2f}s, max RSS {rusage.ru_maxrss / 1024:.1f} MiB, {stdout_bytes} bytes of stdout")
+	return result
+
+
+class JsonStreamDecoder:
+	# shell_stream() consumer for commands printing JSON: one document, or several back to back / one per line.
+	# Bytes are decoded incrementally and each value is handed to on_value once complete; the output is never held
+	# as bytes, str and a log record at once. Decoding is only retried once the buffer has doubled, so a single huge
+	# document arriving in many chunks is still parsed in linear time.
+	def __init__(self, on_value: Callable[[any], None]):
+		self.on_value = on_value
+		self.text = codecs.getincrementaldecoder("utf-8")()
+		self.json = json.JSONDecoder()
+		self.buffer = ""
+		self.retry_at = 0
+
+	def __call__(self, chunk: bytes):
+		self.buffer += self.text.decode(chunk)
+		if len(self.buffer) >= self.retry_at:
+			self.drain()
+
+	def drain(self):
+		while True:
+			self.buffer = self.buffer.lstrip()
+			if not self.buffer:
+				return
+			try:
+				value, end = self.json.raw_decode(self.buffer)
+			except json.JSONDecodeError:
+				self.retry_at = 2 * len(self.buffer)  # incomplete (or invalid; close() tells)
+				return
+			self.on_value(value)
+			self.buffer = self.buffer[end:]
+			self.retry_at = 0
+
+	def close(self):
+		self.buffer += self.text.decode(b"", final=True)
+		self.drain()
+		if self.buffer:
+			raise Exception(f"Invalid or truncated JSON output: '{self.buffer[:200]}'")
+
+
+def shell(arg_list: list[string], env: dict[str, str] | None = None) -> str:
+	# execute a shell command, passing the shell-escaped arg list; throw and exception if the exit code is not 0
+	chunks: list[bytes] = []
+	result = shell_stream(arg_list, chunks.append, env)
 	if result.returncode != 0:
-		raise Exception(
-			f"shell command failed: {arg_list} with return code {result.returncode} and stderr {result.stderr}")
-	utf8_stdout = result.stdout.decode("utf-8")
-	log.debug(f"shell: {arg_list} exitcode: {result.returncode} stdout:\n{utf8_stdout}")
-	return utf8_stdout
+		raise ShellError(
+			f"shell command failed: {arg_list} with return code {result.returncode} and stderr {result.stderr_tail}", result.returncode)
+	return b"".join(chunks).decode("utf-8")
 
 
 def shell_passthrough(arg_list: list[string], ignore_exit_code: bool = False):
@@ -45,30 +205,97 @@ def shell_passthrough(arg_list: list[string], ignore_exit_code: bool = False):
 	# run the process. let it inherit stdin/stdout/stderr
 	result = subprocess.run(arg_list)
 	if (result.returncode != 0) and (not ignore_exit_code):
-		raise Exception(
-			f"shell command failed: {arg_list} with return code {result.returncode} ")
+		raise ShellError(
+			f"shell command failed: {arg_list} with return code {result.returncode} ", result.returncode)
 	log.debug(f"shell: {arg_list} exitcode: {result.returncode}")
 
 
 def shell_all_info(arg_list: list[string]) -> dict[str, str]:
-	log.debug(f"shell: {arg_list}")
-	result = subprocess.run(arg_list, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-	utf8_stdout = result.stdout.decode("utf-8")
-	utf8_stderr = result.stderr.decode("utf-8")
-	log.debug(f"shell: {arg_list} exitcode: {result.returncode} stdout:\n{utf8_stdout} stderr:\n{utf8_stderr}")
-	return {"stdout": utf8_stdout, "stderr": utf8_stderr, "exitcode": result.returncode}
+	# stderr is only the tail, see shell_stream()
+	chunks: list[bytes] = []
+	result = shell_stream(arg_list, chunks.append)
+	return {"stdout": b"".join(chunks).decode("utf-8"), "stderr": result.stderr_tail, "exitcode": result.returncode}
 
 
 def skopeo_inspect_remote_ref(oci_ref):
 	log.debug(f"skopeo_inspect_remote_ref: {oci_ref}")
-	output = shell_all_info(["docker", "run", "quay.io/skopeo/stable:latest", "inspect", f"docker://{oci_ref}"])
-	log.debug(f"skopeo_inspect_remote_ref: {output}")
-	if output["exitcode"] != 0:
-		if "manifest unknown" in output["stderr"] or "manifest unknown" in output["stdout"]:
+	values = []
+	decoder = JsonStreamDecoder(values.append)
+	result = shell_stream(["docker", "run", "quay.io/skopeo/stable:latest", "inspect", f"docker://{oci_ref}"], decoder)
+	if result.returncode != 0:
+		if "manifest unknown" in result.stderr_tail:
 			log.debug(f"skopeo_inspect_remote_ref: manifest unknown, returning None")
 			return None
-		raise Exception(f"skopeo_inspect_remote_ref: failed: {output}")
-	return json.loads(output["stdout"])
+		raise Exception(f"skopeo_inspect_remote_ref: failed with exit code {result.returncode}: {result.stderr_tail}")
+	decoder.close()
+	return values[0]
+
+
+def cache_dir(name: str) -> str:
+	# persistent (across runs, via actions/cache) cache directory; TOOCI_CACHE_DIR overrides the default ./.cache/tooci
+	base = os.environ.get("TOOCI_CACHE_DIR", f"{os.getcwd()}/.cache/tooci")
+	path = f"{base}/{name}"
+	os.makedirs(path, exist_ok=True)
+	return path
+
+
+def atomic_write(path: str, data: bytes):
+	# write to a temp file in the same directory, then rename over; readers never see a partial file
+	fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=f".{os.path.basename(path)}.")
+	try:
+		with os.fdopen(fd, "wb") as f:
+			f.write(data)
+		os.replace(tmp_path, path)
+	except:
+		os.unlink(tmp_path)
+		raise
+
+
+def load_yaml(stream) -> any:
+	# PyYAML (libyaml-backed loader where available) is only imported when some YAML actually has to be parsed: a run
+	# with a fresh inventory snapshot and unchanged upstream indexes never needs it
+	import yaml
+	return yaml.load(stream, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+
+
+def pretty(obj: any) -> str:
+	# rich.pretty costs ~30ms of imports; only paid when something is actually dumped
+	from rich.pretty import pretty_repr
+	return pretty_repr(obj)
+
+
+def http_session() -> requests.Session:
+	# a single pooled (keep-alive) HTTP session, shared by all worker threads
+	global singleton_http_session
+	with singleton_http_session_lock:
+		if singleton_http_session is None:
+			pool_size = int(os.environ.get("HTTP_POOL_SIZE", "32"))
+			session = requests.Session()
+			adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+			session.mount("https://", adapter)
+			session.mount("http://", adapter)
+			session.headers["User-Agent"] = "tooci/helm-oci"
+			singleton_http_session = session
+		return singleton_http_session
+
+
+def http_download(url: str, dest_path: str, expected_sha256: str | None = None) -> int:
+	# stream url to dest_path; verify the sha256 (as found in index.yaml 'digest') if given; returns the number of bytes
+	log.info(f"Downloading '{url}' to '{dest_path}'")
+	sha256 = hashlib.sha256()
+	size = 0
+	with http_session().get(url, stream=True, timeout=60) as response:
+		if response.status_code != 200:
+			raise HttpError(f"Downloading '{url}' failed: {response.status_code} {response.reason}", response.status_code, parse_retry_after(response.headers.get("Retry-After")))
+		with open(dest_path, "wb") as f:
+			for chunk in response.iter_content(chunk_size=1024 * 1024):
+				sha256.update(chunk)
+				size += len(chunk)
+				f.write(chunk)
+	if expected_sha256 and sha256.hexdigest() != expected_sha256.removeprefix("sha256:"):
+		raise DigestMismatchError(f"Digest mismatch for '{url}': expected '{expected_sha256}', got '{sha256.hexdigest()}'", sha256.hexdigest())
+	run_timings().count_current("bytes_downloaded", size)
+	return size
 
 
 def global_console() -> Console: